@@ -0,0 +1,136 @@
+'''Local admin socket of the running service
+
+  The CLI sends one JSON line {"command": ..., "args": [...]} and gets one
+  JSON line back, {"result": ...} or {"error": ...}. Commands run against
+  the network and wallets the service already has, the socket file is only
+  accessible to the user running the service
+'''
+import os
+import json
+import fcntl
+import socket
+import asyncio
+import logging
+
+# Seconds a CLI waits for a command, long enough for a wallet to sync
+CLIENT_TIMEOUT = 120
+
+def is_running(path):
+  sock = connect(path)
+  if sock is None:
+    return False
+  sock.close()
+  return True
+
+def connect(path):
+  '''Socket connected to the running service, None if no service is running'''
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except (FileNotFoundError, ConnectionRefusedError):
+    # No socket or one left behind by a stopped service
+    sock.close()
+    return None
+  return sock
+
+def request(sock, command, *args):
+  '''Result of command run by the service on sock, raises its error'''
+  sock.settimeout(CLIENT_TIMEOUT)
+  with sock, sock.makefile('rwb') as stream:
+    stream.write(json.dumps({'command': command, 'args': args}).encode() + b'\n')
+    stream.flush()
+    line = stream.readline()
+  if not line:
+    raise Exception('Service closed the admin socket')
+  response = json.loads(line)
+  if 'error' in response:
+    raise Exception(response['error'])
+  return response['result']
+
+class AdminServer:
+  '''Serves commands, name -> coroutine function taking the command args'''
+
+  def __init__(self, path, commands):
+    self.path = path
+    self.commands = commands
+    self.server = None
+    # Held while serving, so a single worker binds the socket
+    self.lock_fd = None
+    # (st_dev, st_ino) of the socket file bound by this worker
+    self.inode = None
+
+  def _lock(self):
+    '''Take the lock file of the socket, False if another worker holds it'''
+    fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      os.close(fd)
+      return False
+    self.lock_fd = fd
+    return True
+
+  def _unlock(self):
+    if self.lock_fd is not None:
+      os.close(self.lock_fd)
+      self.lock_fd = None
+
+  async def start(self):
+    '''Listen on path, unless another worker of the service already does'''
+    if not self._lock():
+      logging.info('Admin socket %s served by another worker', self.path)
+      return False
+    try:
+      try:
+        # Left behind by a stopped service, the lock holder owns the path
+        os.unlink(self.path)
+      except FileNotFoundError:
+        pass
+      # Only the owner may connect, commands take wallet passwords, so the socket never exists with wider access
+      umask = os.umask(0o077)
+      try:
+        self.server = await asyncio.start_unix_server(self.handle, path = self.path)
+      finally:
+        os.umask(umask)
+      stat = os.stat(self.path)
+      self.inode = (stat.st_dev, stat.st_ino)
+    except Exception as e:
+      self._unlock()
+      raise e
+    logging.info('Admin socket listening on %s', self.path)
+    return True
+
+  async def stop(self):
+    if self.server:
+      self.server.close()
+      await self.server.wait_closed()
+      self.server = None
+      try:
+        stat = os.stat(self.path)
+        # Never remove a socket another worker bound since
+        if (stat.st_dev, stat.st_ino) == self.inode:
+          os.unlink(self.path)
+      except FileNotFoundError:
+        pass
+      self.inode = None
+    self._unlock()
+
+  async def handle(self, reader, writer):
+    try:
+      line = await reader.readline()
+      if not line:
+        # is_running probe
+        return
+      try:
+        message = json.loads(line)
+        if message.get('command') not in self.commands:
+          raise Exception('Unknown admin command: {}'.format(message.get('command')))
+        response = {'result': await self.commands[message['command']](*message.get('args', []))}
+      except Exception as e:
+        response = {'error': '{}'.format(e)}
+      writer.write(json.dumps(response).encode() + b'\n')
+      await writer.drain()
+    except Exception as e:
+      logging.error('Admin socket: %s', e)
+    finally:
+      writer.close()
@@ -0,0 +1,95 @@
+import time
+import logging
+import electrum
+
+class BalanceMonitor:
+  '''Keeps the wallets whose balance is asked for attached to the network
+    and holds a balance snapshot per wallet, updated from electrum callbacks
+    so balance requests are answered from memory. At most max_size wallets
+    are monitored, the least recently asked for is dropped first, and
+    wallets not asked for in max_idle seconds are dropped by expire
+  '''
+
+  def __init__(self, wallet_cache, max_size = 16, max_idle = 3600):
+    self.wallet_cache = wallet_cache
+    self.max_size = max_size
+    self.max_idle = max_idle
+    self.network = None
+    # All keyed by wallet file path
+    self.wallets = {}
+    self.snapshots = {}
+    self.last_used = {}
+
+  def start(self, network):
+    self.network = network
+    electrum.util.register_callback(self.on_wallet_event, ['wallet_updated', 'new_transaction', 'verified'])
+    electrum.util.register_callback(self.on_blockchain_event, ['blockchain_updated'])
+    for wallet in self.wallets.values():
+      self._attach(wallet)
+
+  def _attach(self, wallet):
+    self.attach(wallet)
+    self.update(wallet)
+
+  def attach(self, wallet):
+    '''Sync wallet with the network while it stays in the wallet cache, without monitoring it'''
+    if self.network and not wallet.network:
+      wallet.start_network(self.network)
+
+  def register(self, wallet):
+    wallet_path = wallet.storage.path
+    self.last_used[wallet_path] = time.monotonic()
+    if self.wallets.get(wallet_path) is wallet:
+      return
+    logging.info('Monitoring balance of %s', wallet)
+    self.wallets[wallet_path] = wallet
+    # Attached wallets stay loaded, evicting them would drop their sync state
+    self.wallet_cache.pin(wallet_path)
+    if self.network:
+      self._attach(wallet)
+    while len(self.wallets) > self.max_size:
+      self.unregister(min(self.wallets, key = lambda path: self.last_used.get(path, 0)))
+
+  def unregister(self, wallet_path):
+    '''Stop monitoring, the wallet cache stops the wallet once it drops it'''
+    wallet = self.wallets.pop(wallet_path, None)
+    self.snapshots.pop(wallet_path, None)
+    self.last_used.pop(wallet_path, None)
+    self.wallet_cache.unpin(wallet_path)
+    if wallet:
+      logging.info('Stopped monitoring balance of %s', wallet)
+
+  def expire(self):
+    '''Drop the wallets whose balance was not asked for in max_idle seconds'''
+    now = time.monotonic()
+    for wallet_path in [wallet_path for wallet_path in self.wallets
+        if now - self.last_used.get(wallet_path, 0) > self.max_idle]:
+      self.unregister(wallet_path)
+
+  def update(self, wallet):
+    confirmed, unconfirmed, unmatured = wallet.get_balance()[:3]
+    self.snapshots[wallet.storage.path] = {
+      'confirmed': confirmed,
+      'unconfirmed': unconfirmed,
+      'unmatured': unmatured,
+      'sync_height': wallet.get_local_height(),
+      'up_to_date': wallet.is_up_to_date(),
+      'updated_timestamp': int(time.time())
+    }
+
+  def on_wallet_event(self, event, wallet, *args):
+    if self.wallets.get(wallet.storage.path) is wallet:
+      self.update(wallet)
+
+  def on_blockchain_event(self, event, *args):
+    # Confirmations of every wallet move with a new block
+    for wallet in list(self.wallets.values()):
+      self.update(wallet)
+
+  def get_balance(self, wallet):
+    '''Balance snapshot of a registered wallet'''
+    snapshot = self.snapshots.get(wallet.storage.path)
+    if snapshot is None:
+      self.update(wallet)
+      snapshot = self.snapshots[wallet.storage.path]
+    return snapshot
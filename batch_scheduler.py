@@ -0,0 +1,128 @@
+import time
+import heapq
+import asyncio
+import logging
+import threading
+import electrum
+
+class BatchScheduler:
+  '''Priority queue of the next batch evaluation of each wallet
+
+    A wallet is evaluated at its send_frequency tick, where an unmet ratio
+    raises its threshold, and woken earlier by fee changes, new blocks and
+    new queued sends so a batch goes out as soon as its ratio is met.
+    Wallets without queued sends are never scheduled, when nothing is due
+    the scheduler sleeps until the next tick or wake up
+  '''
+  # Shortest time between two ticks of a wallet, the period of the old polling loop
+  MIN_INTERVAL = 10
+
+  def __init__(self):
+    # Batch state per wallet id: threshold_multiplier, last_batch_send_try, open, fa_ratio, fa_ratio_limit
+    self.wallets = {}
+    # Unconfirmed last batch tx per wallet id, replaced to append sends (rbf_append)
+    self.inflight = {}
+    # (time, wallet_id) heap, entries not matching due are stale
+    self.heap = []
+    # wallet_id -> time of its next tick
+    self.due = {}
+    # Wallets to evaluate before their tick, None for all
+    self.woken = set()
+    self.lock = threading.Lock()
+    self.loop = None
+    self.event = None
+    self.running = False
+    # Run loop of an earlier start exits instead of running along a new one
+    self.generation = 0
+
+  def start(self, evaluate):
+    '''Run evaluate(ticks, woken) on the running loop whenever wallets are due or woken'''
+    self.loop = asyncio.get_running_loop()
+    self.event = asyncio.Event()
+    self.running = True
+    self.generation += 1
+    electrum.util.register_callback(self.on_blockchain_event, ['blockchain_updated'])
+    asyncio.ensure_future(self.run(evaluate, self.generation))
+
+  def stop(self):
+    '''Stop after the evaluation in progress, if any, and forget every schedule'''
+    if not self.running:
+      return
+    self.running = False
+    electrum.util.unregister_callback(self.on_blockchain_event)
+    with self.lock:
+      self.heap = []
+      self.due = {}
+      self.woken = set()
+    self.event.set()
+    self.loop = None
+
+  def _notify(self):
+    if self.loop:
+      # Callbacks may come from other threads
+      self.loop.call_soon_threadsafe(self.event.set)
+
+  def schedule(self, wallet_id, when):
+    '''Tick wallet_id at when, unless it already ticks earlier'''
+    wallet_id = str(wallet_id)
+    with self.lock:
+      if wallet_id in self.due and self.due[wallet_id] <= when:
+        return
+      self.due[wallet_id] = when
+      heapq.heappush(self.heap, (when, wallet_id))
+    self._notify()
+
+  def unschedule(self, wallet_ids):
+    '''Forget the ticks and wake ups of wallet_ids'''
+    with self.lock:
+      for wallet_id in wallet_ids:
+        # Its heap entry is stale from now on
+        self.due.pop(str(wallet_id), None)
+        if self.woken is not None:
+          self.woken.discard(str(wallet_id))
+
+  def wake(self, wallet_ids = None):
+    '''Evaluate wallet_ids, or every wallet if None, without waiting for their tick'''
+    with self.lock:
+      if wallet_ids is None or self.woken is None:
+        self.woken = None
+      else:
+        self.woken.update(str(wallet_id) for wallet_id in wallet_ids)
+    self._notify()
+
+  def on_blockchain_event(self, event, *args):
+    # New confirmed coins and fee levels come with a new block
+    self.wake()
+
+  def next_tick(self, wallet_id):
+    return self.due.get(str(wallet_id))
+
+  def _take(self, now):
+    '''Pop wallets whose tick is due and the woken ones'''
+    with self.lock:
+      ticks = set()
+      while self.heap and self.heap[0][0] <= now:
+        when, wallet_id = heapq.heappop(self.heap)
+        if self.due.get(wallet_id) == when:
+          del self.due[wallet_id]
+          ticks.add(wallet_id)
+      woken = self.woken
+      self.woken = set()
+      timeout = self.heap[0][0] - now if self.heap else None
+    return ticks, woken, timeout
+
+  async def run(self, evaluate, generation):
+    event = self.event
+    while self.running and generation == self.generation:
+      event.clear()
+      ticks, woken, timeout = self._take(time.time())
+      if ticks or woken is None or woken:
+        try:
+          await evaluate(ticks, woken)
+        except Exception as e:
+          logging.error('Batch evaluation failed: %s', e)
+        continue
+      try:
+        await asyncio.wait_for(event.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
@@ -0,0 +1,104 @@
+'''Cold start time of CLI config commands and listwallets
+
+  Runs getapiconfig, setapiconfig and listwallets in a scratch directory
+  under python -X importtime, reports wall time and the slowest imports,
+  and fails if a heavy module (electrum, the DB, HTTP client) is imported
+  or the median start exceeds the budget. listwallets may import the DB
+  layer but not the schema migrations, and has a budget of its own.
+  Usage: python benchmarks/cli_startup.py [--runs 10] [--budget-ms 300] [--db-budget-ms 1000]
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(REPO_DIR, 'wallet_service_cli.py')
+
+CONFIG = '''[SYSTEM]
+wallet_dir = wallets
+use_testnet = True
+fee_level = 1
+
+[USER]
+api_password = benchmark
+fa_ratio_min = 5
+fa_ratio_max = 50
+send_frequency = 5
+'''
+
+COMMANDS = [['getapiconfig'], ['setapiconfig', 'fee_level', '1']]
+# Read the wallet registry in the DB, run once before timing so the registry exists
+DB_COMMANDS = [['listwallets']]
+
+# Top level packages config commands must not import
+HEAVY_MODULES = ['electrum', 'electrum_cmd_util', 'sqlalchemy', 'db_manager', 'db_model', 'db_migrate',
+  'cryptography', 'cryptocode', 'requests', 'aiohttp', 'sanic']
+# Of those, the ones DB commands may import
+DB_MODULES = ['sqlalchemy', 'db_manager', 'db_model']
+
+def percentile(values, pct):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def parse_importtime(stderr):
+  '''{module: (self us, cumulative us)} of an -X importtime run'''
+  imports = {}
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    self_us, cumulative_us, module = line[len('import time:'):].split('|')
+    imports[module.strip()] = (int(self_us), int(cumulative_us))
+  return imports
+
+def run(command):
+  start = time.perf_counter()
+  result = subprocess.run([sys.executable, '-X', 'importtime', CLI] + command, capture_output = True, text = True)
+  elapsed = time.perf_counter() - start
+  if result.returncode != 0:
+    raise Exception('{} failed: {}'.format(' '.join(command), result.stderr[-2000:]))
+  return elapsed, parse_importtime(result.stderr)
+
+if __name__ == '__main__':
+  ap = argparse.ArgumentParser(description = 'Benchmark cold start of CLI config commands')
+  ap.add_argument('--runs', type = int, default = 10)
+  ap.add_argument('--budget-ms', type = float, default = 300, help = 'maximum median wall time of a config command')
+  ap.add_argument('--db-budget-ms', type = float, default = 1000, help = 'maximum median wall time of listwallets')
+  ap.add_argument('--top', type = int, default = 10, help = 'slowest imports to list')
+  args = ap.parse_args()
+
+  os.chdir(tempfile.mkdtemp())
+  with open('config.ini', 'w') as f:
+    f.write(CONFIG)
+  os.mkdir('wallets')
+
+  failures = []
+  print('{:<26} {:>10} {:>10} {:>12} {:>8}'.format('command', 'p50 ms', 'max ms', 'imports ms', 'modules'))
+  for command in DB_COMMANDS:
+    run(command)
+  for command, budget_ms, allowed in [(command, args.budget_ms, []) for command in COMMANDS] + \
+      [(command, args.db_budget_ms, DB_MODULES) for command in DB_COMMANDS]:
+    times = []
+    for _ in range(args.runs):
+      elapsed, imports = run(command)
+      times.append(elapsed)
+    name = ' '.join(command)
+    total_us = sum(self_us for self_us, cumulative_us in imports.values())
+    print('{:<26} {:>10.1f} {:>10.1f} {:>12.1f} {:>8}'.format(name, percentile(times, 50) * 1000,
+      max(times) * 1000, total_us / 1000, len(imports)))
+    heavy = sorted(module for module in imports
+      if module.split('.')[0] in HEAVY_MODULES and module.split('.')[0] not in allowed)
+    if heavy:
+      failures.append('{} imports {}'.format(name, ', '.join(heavy)))
+    if percentile(times, 50) * 1000 > budget_ms:
+      failures.append('{} takes {:.1f} ms, budget {:.1f} ms'.format(name, percentile(times, 50) * 1000, budget_ms))
+
+  print('\nSlowest imports of {} (cumulative ms):'.format(' '.join(COMMANDS[0])))
+  for module, (self_us, cumulative_us) in sorted(run(COMMANDS[0])[1].items(), key = lambda item: -item[1][1])[:args.top]:
+    print('  {:<40} {:>8.1f}'.format(module, cumulative_us / 1000))
+
+  if failures:
+    print('\nFAILED:\n  ' + '\n  '.join(failures))
+    sys.exit(1)
@@ -0,0 +1,86 @@
+'''Query times of DbManager lookups on a large transactions table
+
+  Fills a scratch DB with historical sends plus a small queue per wallet,
+  then times the queue and history queries before and after the index
+  migration. Usage: python benchmarks/db_queries.py [--rows 1000000]
+'''
+import os
+import sys
+import time
+import uuid
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_manager
+import db_migrate
+from db_manager import DbManager
+from db_model import Transactions
+
+def fill(engine, rows, wallets, queued):
+  now = int(time.time())
+  batch = []
+  with engine.begin() as conn:
+    for i in range(rows + wallets * queued):
+      sent = i < rows
+      batch.append({
+        'sr_id': uuid.uuid4().hex,
+        'txid': uuid.uuid4().hex * 2 if sent else None,
+        'address': 'tb1qbenchmark{}'.format(i),
+        'amount': 10000 + i % 1000,
+        'wallet_id': i % wallets,
+        'fee': 150 if sent else None,
+        'sr_timestamp': now - rows + i,
+        'tx_timestamp': now - rows + i + 60 if sent else None,
+        'wallet_password': None,
+        # As set by migration 6, so queries find the same rows with and without indexes
+        'status': 'sent' if sent else 'queued'
+      })
+      if len(batch) == 10000:
+        conn.execute(Transactions.__table__.insert(), batch)
+        batch = []
+    if batch:
+      conn.execute(Transactions.__table__.insert(), batch)
+
+def timed(func, repeat):
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    func()
+    timings.append(time.perf_counter() - start)
+  return min(timings) * 1000
+
+def run_queries(wallets, repeat):
+  results = {}
+  with DbManager() as db:
+    results['get_unsent'] = timed(lambda: [db.get_unsent(wallet_id) for wallet_id in range(wallets)], repeat) / wallets
+    results['get_sent_txs(100)'] = timed(lambda: db.get_sent_txs(100), repeat)
+    results['wallet page(100)'] = timed(lambda: db.get_sent_txs(100, 1, (int(time.time()), '')), repeat)
+  return results
+
+if __name__ == '__main__':
+  ap = argparse.ArgumentParser(description = 'Benchmark transactions table queries')
+  ap.add_argument('--rows', type = int, default = 1000000, help = 'historical sent rows')
+  ap.add_argument('--wallets', type = int, default = 20)
+  ap.add_argument('--queued', type = int, default = 50, help = 'unsent rows per wallet')
+  ap.add_argument('--repeat', type = int, default = 5)
+  args = ap.parse_args()
+
+  db_dir = tempfile.mkdtemp()
+  # Shared by DbManager and the migrations, db_url of a config.ini in the working directory is not used
+  engine = db_manager.get_engine(url = 'sqlite:///' + os.path.join(db_dir, 'benchmark_db'))
+  db_migrate.migrate(target = 1)
+  print('Filling {} rows...'.format(args.rows + args.wallets * args.queued))
+  fill(engine, args.rows, args.wallets, args.queued)
+
+  before = run_queries(args.wallets, args.repeat)
+  start = time.perf_counter()
+  db_migrate.migrate()
+  migrate_time = time.perf_counter() - start
+  after = run_queries(args.wallets, args.repeat)
+
+  print('Index migration took {:.1f} s'.format(migrate_time))
+  print('{:<20} {:>14} {:>14}'.format('query (ms)', 'no indexes', 'indexed'))
+  for query in before:
+    print('{:<20} {:>14.2f} {:>14.2f}'.format(query, before[query], after[query]))
@@ -0,0 +1,89 @@
+'''Latency of quick requests while blocking work runs on the event loop
+
+  Queues sends (password sealing and DB insert, as in /api/send) from
+  concurrent clients while other clients poll single send requests (as in
+  /api/detail). Compares the poll latency when the blocking work runs
+  inline on the event loop and when it goes through WalletExecutor.
+  Usage: python benchmarks/event_loop_latency.py [--senders 4] [--sends 20]
+'''
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_manager
+import db_migrate
+from db_manager import DbManager
+from wallet_executor import WalletExecutor
+import wallet_keyring
+
+def insert(wallet_id):
+  # Key derivation of the credential envelope, the blocking crypto of a send bringing a new password
+  wallet_keyring.seal('benchmark password')
+  with DbManager() as db:
+    return db.insert_transaction('tb1qbenchmark', 10000, wallet_id).sr_id
+
+def lookup(sr_id):
+  with DbManager() as db:
+    return db.get_tx(sr_id)
+
+def percentile(values, pct):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def run(executor, senders, sends, pollers, interval = 0.01):
+  async def call(func, *args):
+    if executor:
+      return await executor.run(func, *args)
+    return func(*args)
+
+  sr_id = insert(0)
+  latencies = []
+  done = asyncio.Event()
+
+  async def sender(wallet_id):
+    for _ in range(sends):
+      await call(insert, wallet_id)
+      await asyncio.sleep(0)
+
+  async def poller():
+    # Polls arrive on a fixed schedule, latency counts from arrival so time
+    # spent waiting for a blocked event loop is included
+    arrival = time.perf_counter()
+    while not done.is_set():
+      await asyncio.sleep(max(0, arrival - time.perf_counter()))
+      await call(lookup, sr_id)
+      latencies.append(time.perf_counter() - arrival)
+      arrival += interval
+
+  polls = [asyncio.ensure_future(poller()) for _ in range(pollers)]
+  start = time.perf_counter()
+  await asyncio.gather(*[sender(wallet_id) for wallet_id in range(senders)])
+  elapsed = time.perf_counter() - start
+  done.set()
+  await asyncio.gather(*polls)
+  return elapsed, latencies
+
+if __name__ == '__main__':
+  ap = argparse.ArgumentParser(description = 'Benchmark request latency under concurrent sends')
+  ap.add_argument('--senders', type = int, default = 4)
+  ap.add_argument('--sends', type = int, default = 20, help = 'sends per sender')
+  ap.add_argument('--pollers', type = int, default = 4)
+  ap.add_argument('--threads', type = int, default = 8)
+  args = ap.parse_args()
+
+  # Shared by DbManager and the migrations, db_url of a config.ini in the working directory is not used
+  db_manager.get_engine(url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark_db'))
+  db_migrate.migrate()
+
+  print('{:<12} {:>10} {:>12} {:>12} {:>12}'.format('mode', 'sends/s', 'poll p50 ms', 'poll p99 ms', 'poll max ms'))
+  for mode, executor in [('inline', None), ('executor', WalletExecutor(max_threads = args.threads))]:
+    elapsed, latencies = asyncio.run(run(executor, args.senders, args.sends, args.pollers))
+    print('{:<12} {:>10.1f} {:>12.2f} {:>12.2f} {:>12.2f}'.format(mode, args.senders * args.sends / elapsed,
+      percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, max(latencies) * 1000))
+    if executor:
+      executor.shutdown()
@@ -0,0 +1,397 @@
+'''Stand-in for the electrum package used by the offline benchmarks
+
+  Implements only what the wallet service calls, deterministically and
+  without network or real keys: wallets are JSON files holding a synthetic
+  UTXO set, coin selection is largest first and the network accepts every
+  broadcast after a fixed delay. Password checks and signing burn a fixed
+  amount of key derivation work so their cost still shows in results
+'''
+import os
+import json
+import types
+import asyncio
+import hashlib
+from decimal import Decimal
+
+COIN = 100000000
+DUST_THRESHOLD = 546
+KDF_ITERATIONS = 1024
+
+def _kdf(password, salt):
+  return hashlib.pbkdf2_hmac('sha512', str(password).encode(), salt.encode(), KDF_ITERATIONS).hex()
+
+# electrum.util
+
+_callbacks = {}
+
+def register_callback(func, events):
+  for event in events:
+    _callbacks.setdefault(event, []).append(func)
+
+def unregister_callback(func):
+  for callbacks in _callbacks.values():
+    if func in callbacks:
+      callbacks.remove(func)
+
+def trigger_callback(event, *args):
+  for func in list(_callbacks.get(event, [])):
+    if asyncio.iscoroutinefunction(func):
+      asyncio.ensure_future(func(event, *args))
+    else:
+      func(event, *args)
+
+def create_and_start_event_loop():
+  raise Exception('Offline electrum runs on the caller event loop')
+
+util = types.SimpleNamespace(register_callback = register_callback, unregister_callback = unregister_callback,
+  trigger_callback = trigger_callback, create_and_start_event_loop = create_and_start_event_loop)
+
+constants = types.SimpleNamespace(set_testnet = lambda: None)
+
+# electrum.bitcoin
+
+def address_to_script(address):
+  digest = hashlib.sha256(address.encode()).hexdigest()
+  if address.startswith(('bc1q', 'tb1q')) and len(address) == 42:
+    return '0014' + digest[:40]
+  if address.startswith(('bc1q', 'tb1q')) and len(address) == 62:
+    return '0020' + digest
+  if address.startswith(('1', 'm', 'n')):
+    return '76a914' + digest[:40] + '88ac'
+  if address.startswith(('3', '2')):
+    return 'a914' + digest[:40] + '87'
+  raise Exception('Invalid bitcoin address: {}'.format(address))
+
+def make_address(seed):
+  '''Deterministic p2wpkh style address for synthetic data'''
+  return 'bc1q' + hashlib.sha256(str(seed).encode()).hexdigest()[:38]
+
+bitcoin = types.SimpleNamespace(address_to_script = address_to_script, COIN = COIN)
+
+# electrum.commands
+
+def satoshis(amount):
+  return int(COIN * Decimal(amount)) if amount is not None else None
+
+def satoshis_or_max(amount):
+  return '!' if amount == '!' else satoshis(amount)
+
+# electrum.transaction
+
+class TxOutpoint:
+
+  def __init__(self, txid, out_idx):
+    # bytes, as in electrum
+    self.txid = txid
+    self.out_idx = out_idx
+
+  def to_str(self):
+    return '{}:{}'.format(self.txid.hex(), self.out_idx)
+
+class PartialTxInput:
+
+  def __init__(self, prevout, value, block_height = None):
+    self.prevout = prevout
+    self._value = value
+    self.block_height = block_height
+
+  def value_sats(self):
+    return self._value
+
+class PartialTxOutput:
+
+  def __init__(self, scriptpubkey, value):
+    self.scriptpubkey = scriptpubkey
+    self.value = value
+
+  @classmethod
+  def from_address_and_value(cls, address, value):
+    return cls(bytes.fromhex(address_to_script(address)), value)
+
+class Transaction:
+
+  def __init__(self, raw):
+    self.raw = raw
+    data = json.loads(raw)
+    self._inputs = [PartialTxInput(TxOutpoint(bytes.fromhex(txid), n), value) for txid, n, value in data['inputs']]
+    self._outputs = [PartialTxOutput(bytes.fromhex(script), value) for script, value in data['outputs']]
+    self.is_change = data['change']
+
+  def inputs(self):
+    return self._inputs
+
+  def outputs(self):
+    return self._outputs
+
+  def txid(self):
+    return hashlib.sha256(self.raw.encode()).hexdigest()
+
+  def serialize(self):
+    return self.raw
+
+  def estimated_size(self):
+    # p2wpkh inputs, segwit overhead rounded up
+    return 11 + 68 * len(self._inputs) + sum(9 + len(output.scriptpubkey) for output in self._outputs)
+
+transaction = types.SimpleNamespace(PartialTxOutput = PartialTxOutput, PartialTxInput = PartialTxInput,
+  Transaction = Transaction, TxOutpoint = TxOutpoint)
+
+commands = types.SimpleNamespace(satoshis = satoshis, satoshis_or_max = satoshis_or_max)
+
+# electrum.simple_config
+
+class SimpleConfig:
+  # sat/vB by confirmation target the stand-in network reports
+  FEE_ESTIMATES = {2: 20000, 5: 10000, 10: 5000, 25: 2000}
+
+  def __init__(self, options = None):
+    self.options = options or {}
+    self.fee_estimates = dict(self.FEE_ESTIMATES)
+
+  def is_dynfee(self):
+    return True
+
+  def fee_per_kb(self):
+    return self.fee_estimates[5]
+
+  def estimate_fee(self, size, allow_fallback_to_static_rates = False):
+    return size * self.fee_per_kb() // 1000
+
+  def estimate_fee_for_feerate(self, fee_per_kb, size):
+    return size * fee_per_kb // 1000
+
+class Commands:
+
+  def __init__(self, config = None):
+    self.config = config
+    self.network = None
+    self.wallet = None
+
+# electrum.network
+
+class Network:
+  _instance = None
+  BROADCAST_LATENCY = 0.05
+
+  def __init__(self, config = None):
+    self.config = config
+    self.asyncio_loop = None
+    self.connected = False
+    self.broadcasts = []
+    Network._instance = self
+
+  @classmethod
+  def get_instance(cls):
+    return cls._instance
+
+  def start(self, jobs = None):
+    self.asyncio_loop = asyncio.get_event_loop()
+    self.connected = True
+
+  async def stop(self, full_shutdown = True):
+    self.connected = False
+
+  def is_connected(self):
+    return self.connected
+
+  def get_status_value(self, key):
+    return 'connected' if self.connected else 'disconnected'
+
+  def get_fee_estimates(self):
+    return dict(SimpleConfig.FEE_ESTIMATES)
+
+  def get_local_height(self):
+    return 800000
+
+  async def broadcast_transaction(self, tx, timeout = None):
+    await asyncio.sleep(self.BROADCAST_LATENCY)
+    self.broadcasts.append(tx.txid())
+
+  async def get_transaction(self, tx_hash, timeout = None):
+    if tx_hash not in self.broadcasts:
+      raise Exception('No such mempool or blockchain transaction. Use gettransaction for wallet transactions.')
+    return tx_hash
+
+class TxBroadcastError(Exception):
+  pass
+
+class TxBroadcastServerReturnedError(TxBroadcastError):
+  pass
+
+network = types.SimpleNamespace(Network = Network, TxBroadcastError = TxBroadcastError,
+  TxBroadcastServerReturnedError = TxBroadcastServerReturnedError)
+
+# electrum.storage, electrum.wallet_db, electrum.wallet
+
+def write_wallet_file(path, password, utxos):
+  '''Create a stand-in wallet file holding utxos, a list of sat amounts'''
+  salt = os.path.basename(path)
+  data = {
+    'password_hash': _kdf(password, salt),
+    'utxos': {'{}:0'.format(hashlib.sha256('{}{}'.format(path, i).encode()).hexdigest()): value
+      for i, value in enumerate(utxos)},
+    'txs': {}
+  }
+  with open(path, 'w') as f:
+    json.dump(data, f)
+
+class WalletStorage:
+
+  def __init__(self, path):
+    self.path = path
+    self.decrypted = False
+
+  def file_exists(self):
+    return os.path.exists(self.path)
+
+  def decrypt(self, password):
+    with open(self.path) as f:
+      data = json.load(f)
+    if _kdf(password, os.path.basename(self.path)) != data['password_hash']:
+      raise Exception('Invalid password')
+    self.password = password
+    self.decrypted = True
+
+  def read(self):
+    with open(self.path) as f:
+      return f.read()
+
+  def write(self, data):
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write(data)
+    os.replace(tmp_path, self.path)
+
+class WalletDB:
+
+  def __init__(self, raw, manual_upgrades = False):
+    self.data = json.loads(raw)
+
+  def dump(self):
+    return json.dumps(self.data)
+
+  def get_transaction(self, txid):
+    return self.data['txs'].get(txid)
+
+wallet_db = types.SimpleNamespace(WalletDB = WalletDB)
+
+class Wallet:
+  txin_type = 'p2wpkh'
+
+  def __init__(self, db, storage, config = None):
+    self.db = db
+    self.storage = storage
+    self.config = config
+    self.network = None
+
+  def __str__(self):
+    return os.path.basename(self.storage.path)
+
+  def start_network(self, network):
+    self.network = network
+    trigger_callback('wallet_updated', self)
+
+  async def stop(self):
+    self.network = None
+
+  def is_up_to_date(self):
+    return self.network is not None
+
+  def get_local_height(self):
+    return 800000
+
+  def get_balance(self):
+    return sum(self.db.data['utxos'].values()), 0, 0
+
+  def get_spendable_coins(self, domain = None):
+    coins = []
+    for outpoint, value in self.db.data['utxos'].items():
+      txid, n = outpoint.split(':')
+      # Change of wallet txs is unconfirmed, funding coins are mined
+      height = 0 if txid in self.db.data['txs'] else self.get_local_height() - 100
+      coins.append(PartialTxInput(TxOutpoint(bytes.fromhex(txid), int(n)), value, block_height = height))
+    return coins
+
+  def get_full_history(self):
+    return {}
+
+  def get_master_public_key(self):
+    return 'xpub' + hashlib.sha256(self.storage.path.encode()).hexdigest()
+
+  def get_unused_address(self):
+    return make_address(self.storage.path)
+
+  def create_transaction(self, outputs, *, fee = None, feerate = None, change_addr = None, domain_addr = None,
+      domain_coins = None, unsigned = False, rbf = None, password = None, locktime = None):
+    if any(output.value == '!' for output in outputs):
+      raise Exception('Max amount is not supported offline')
+    needed = sum(output.value for output in outputs) + (fee or 0)
+    selected = []
+    coins = self.get_spendable_coins() if domain_coins is None else domain_coins
+    for coin in sorted(coins, key = lambda coin: -coin.value_sats()):
+      if sum(txin.value_sats() for txin in selected) >= needed:
+        break
+      selected.append(coin)
+    change = sum(txin.value_sats() for txin in selected) - needed
+    if change < 0:
+      raise Exception('Insufficient funds')
+    tx_outputs = [[output.scriptpubkey.hex(), output.value] for output in outputs]
+    if change > DUST_THRESHOLD:
+      tx_outputs.append([address_to_script(make_address(len(self.db.data['txs']))), change])
+    if not unsigned:
+      if _kdf(password, os.path.basename(self.storage.path)) != self.db.data['password_hash']:
+        raise Exception('Invalid password')
+      for _ in selected:
+        _kdf(password, 'sign')
+    return Transaction(json.dumps({
+      'inputs': [[txin.prevout.txid.hex(), txin.prevout.out_idx, txin.value_sats()] for txin in selected],
+      'outputs': tx_outputs,
+      'change': change > DUST_THRESHOLD,
+      'rbf': rbf
+    }, sort_keys = True))
+
+  def get_tx_height(self, txid):
+    # Nothing is ever mined offline
+    return types.SimpleNamespace(height = 0 if txid in self.db.data['txs'] else -2, conf = 0)
+
+  def add_transaction(self, tx):
+    utxos = self.db.data['utxos']
+    spent = {}
+    for txin in tx.inputs():
+      outpoint = txin.prevout.to_str()
+      if outpoint in utxos:
+        spent[outpoint] = utxos.pop(outpoint)
+    change = None
+    if tx.is_change:
+      change = '{}:{}'.format(tx.txid(), len(tx.outputs()) - 1)
+      utxos[change] = tx.outputs()[-1].value
+    self.db.data['txs'][tx.txid()] = {'spent': spent, 'change': change}
+    return True
+
+  def get_depending_transactions(self, txid):
+    children = set()
+    for child_txid, entry in self.db.data['txs'].items():
+      if any(outpoint.startswith(txid + ':') for outpoint in entry['spent']):
+        children.add(child_txid)
+        children |= self.get_depending_transactions(child_txid)
+    return children
+
+  def remove_transaction(self, txid):
+    entry = self.db.data['txs'].pop(txid, None)
+    if not entry:
+      return
+    utxos = self.db.data['utxos']
+    utxos.update(entry['spent'])
+    if entry['change']:
+      utxos.pop(entry['change'], None)
+
+  def save_db(self):
+    self.storage.write(self.db.dump())
+
+def create_new_wallet(path, config = None, password = None, **kwargs):
+  write_wallet_file(path, password, [])
+  storage = WalletStorage(path)
+  storage.decrypt(password)
+  return {'wallet': Wallet(WalletDB(storage.read()), storage, config = config)}
+
+wallet = types.SimpleNamespace(create_new_wallet = create_new_wallet, Wallet = Wallet)
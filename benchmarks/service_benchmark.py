@@ -0,0 +1,211 @@
+'''Offline throughput benchmark of the wallet service
+
+  Runs the API handlers and the batch loop in process against the stand-in
+  electrum of benchmarks/offline: N wallets with a synthetic UTXO set and
+  M queued sends each. Reports throughput, latency percentiles and memory
+  per phase and saves them as JSON to compare releases.
+  Usage: python benchmarks/service_benchmark.py [--wallets 10] [--sends 50] [--batch-max-outputs 1000]
+    [--output results.json] [--compare previous.json]
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import types
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+# Stand-in electrum first, then the service modules
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, 'offline'))
+
+API_PASSWORD = 'benchmark'
+WALLET_PASSWORD = 'benchmark wallet password'
+
+CONFIG = '''[SYSTEM]
+wallet_dir = wallets
+use_testnet = False
+fee_level = 1
+batch_max_outputs = {}
+
+[USER]
+api_password = {}
+fa_ratio_min = 100
+fa_ratio_max = 100
+send_frequency = 0
+'''
+
+def percentile(values, pct):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def summarize(latencies, elapsed):
+  return {
+    'requests': len(latencies),
+    'throughput': len(latencies) / elapsed if elapsed else 0,
+    'p50_ms': percentile(latencies, 50) * 1000,
+    'p90_ms': percentile(latencies, 90) * 1000,
+    'p99_ms': percentile(latencies, 99) * 1000,
+    'max_ms': max(latencies) * 1000,
+    'elapsed_s': elapsed,
+    'traced_peak_mb': tracemalloc.get_traced_memory()[1] / 1e6,
+    # Linux reports KB
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+  }
+
+def setup_workdir(wallets, utxos, batch_max_outputs):
+  import electrum
+  workdir = tempfile.mkdtemp(prefix = 'wallet_service_benchmark_')
+  os.chdir(workdir)
+  with open('config.ini', 'w') as f:
+    f.write(CONFIG.format(batch_max_outputs, API_PASSWORD))
+  os.mkdir('wallets')
+  rng = random.Random(42)
+  for wallet_id in range(wallets):
+    electrum.write_wallet_file(os.path.join('wallets', 'wallet_{}'.format(wallet_id)), WALLET_PASSWORD,
+      [rng.randint(100000, 10000000) for _ in range(utxos)])
+  return workdir
+
+async def run_phase(name, calls, concurrency):
+  '''Run call() coroutines with at most concurrency in flight, returns stats'''
+  semaphore = asyncio.Semaphore(concurrency)
+  latencies = []
+
+  async def timed(call):
+    async with semaphore:
+      start = time.perf_counter()
+      response = await call()
+      latencies.append(time.perf_counter() - start)
+      if response.status != 200:
+        raise Exception('{} failed: {}'.format(name, response.body))
+
+  tracemalloc.reset_peak()
+  start = time.perf_counter()
+  await asyncio.gather(*[timed(call) for call in calls])
+  stats = summarize(latencies, time.perf_counter() - start)
+  print('{:<10} {:>8} req {:>9.1f} req/s  p50 {:>8.2f} ms  p99 {:>8.2f} ms  peak {:>6.1f} MB'.format(
+    name, stats['requests'], stats['throughput'], stats['p50_ms'], stats['p99_ms'], stats['traced_peak_mb']))
+  return stats
+
+def request(json_body = None, args = None):
+  return types.SimpleNamespace(json = json_body, args = args or {}, ctx = types.SimpleNamespace())
+
+async def benchmark(args):
+  import electrum
+  import db_migrate
+  import wallet_service_api as api
+
+  electrum.Network.BROADCAST_LATENCY = args.broadcast_latency
+  db_migrate.migrate()
+  await api.start_service()
+  # Sends the batches as the holder of the only shard, without the lease loop
+  api.cmd_manager.shards.shards.add(0)
+
+  rng = random.Random(7)
+  sends = [{
+      'addr': electrum.make_address('{}-{}'.format(wallet_id, i)),
+      'btc_amount': rng.randint(10000, 200000) / 1.0e8,
+      'wallet_id': wallet_id,
+      'wallet_password': WALLET_PASSWORD,
+      'api_password': API_PASSWORD
+    } for i in range(args.sends) for wallet_id in range(args.wallets)]
+
+  results = {}
+  results['presend'] = await run_phase('presend',
+    [lambda body = body: api.presend(request(dict(body))) for body in sends], args.concurrency)
+  results['send'] = await run_phase('send',
+    [lambda body = body: api.send(request(dict(body))) for body in sends], args.concurrency)
+  results['queue'] = await run_phase('queue',
+    [lambda: api.queue(request()) for _ in range(args.reads)], args.concurrency)
+
+  # One tick of every queued wallet, every batch meets the ratio
+  tracemalloc.reset_peak()
+  start = time.perf_counter()
+  await api.cmd_util.send_batch()
+  elapsed = time.perf_counter() - start
+  broadcasts = len(electrum.Network.get_instance().broadcasts)
+  results['send_batch'] = {
+    'wallets': args.wallets,
+    'broadcasts': broadcasts,
+    'elapsed_s': elapsed,
+    'throughput': args.wallets * args.sends / elapsed,
+    'traced_peak_mb': tracemalloc.get_traced_memory()[1] / 1e6
+  }
+  print('{:<10} {:>8} tx  {:>9.2f} s {:>9.1f} sends/s'.format('send_batch', broadcasts, elapsed,
+    results['send_batch']['throughput']))
+  expected = args.wallets * -(-args.sends // args.batch_max_outputs)
+  if broadcasts != expected:
+    raise Exception('Expected {} batch broadcasts, got {}'.format(expected, broadcasts))
+
+  results['history'] = await run_phase('history',
+    [lambda: api.history(request(args = {'limit': '100'})) for _ in range(args.reads)], args.concurrency)
+  return results
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = REPO_DIR).decode().strip()
+  except Exception:
+    return None
+
+def compare(previous_file, results):
+  with open(previous_file) as f:
+    previous = json.load(f)
+  print('\nCompared to {} ({})'.format(previous_file, previous['meta'].get('revision')))
+  for phase, stats in results.items():
+    old = previous['phases'].get(phase)
+    if not old:
+      continue
+    for key in ['throughput', 'p99_ms', 'elapsed_s', 'traced_peak_mb']:
+      if key in stats and old.get(key):
+        print('{:<10} {:<15} {:>10.2f} -> {:>10.2f} ({:+.1f}%)'.format(
+          phase, key, old[key], stats[key], (stats[key] / old[key] - 1) * 100))
+
+if __name__ == '__main__':
+  ap = argparse.ArgumentParser(description = 'Offline wallet service benchmark')
+  ap.add_argument('--wallets', type = int, default = 10)
+  ap.add_argument('--sends', type = int, default = 50, help = 'queued sends per wallet')
+  ap.add_argument('--utxos', type = int, default = 50, help = 'UTXOs per wallet')
+  ap.add_argument('--reads', type = int, default = 200, help = 'queue and history requests')
+  ap.add_argument('--concurrency', type = int, default = 16, help = 'requests in flight')
+  ap.add_argument('--batch-max-outputs', type = int, default = 1000, help = 'outputs per batch transaction')
+  ap.add_argument('--broadcast-latency', type = float, default = 0.05, help = 'seconds per broadcast')
+  ap.add_argument('--output', help = 'save results to this JSON file')
+  ap.add_argument('--compare', help = 'JSON results of a previous run to compare with')
+  ap.add_argument('--keep', action = 'store_true', help = 'keep the scratch directory')
+  args = ap.parse_args()
+  output = os.path.abspath(args.output) if args.output else None
+  previous = os.path.abspath(args.compare) if args.compare else None
+
+  workdir = setup_workdir(args.wallets, args.utxos, args.batch_max_outputs)
+  tracemalloc.start()
+  try:
+    phases = asyncio.run(benchmark(args))
+  finally:
+    os.chdir(REPO_DIR)
+    if not args.keep:
+      shutil.rmtree(workdir, ignore_errors = True)
+
+  results = {
+    'meta': {
+      'revision': git_revision(),
+      'timestamp': int(time.time()),
+      'python': platform.python_version(),
+      'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'keep')}
+    },
+    'phases': phases
+  }
+  if output:
+    with open(output, 'w') as f:
+      json.dump(results, f, indent = 2)
+    print('Results saved to {}'.format(output))
+  if previous:
+    compare(previous, results)
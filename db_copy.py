@@ -0,0 +1,56 @@
+'''One-shot copy of the SQLite DB of a single host install to the DB of db_url
+
+  Stop the service first. Both DBs are migrated to the latest schema, then
+  the wallets, wallet credentials, batch states and sends are copied in one
+  DB transaction of the target, which must not have any sends yet. Leases
+  are not copied, the first process started takes them.
+  Usage: set db_url in config.ini, then `python db_copy.py [sqlite_url]`
+'''
+import sys
+import time
+from sqlalchemy import select, func
+import db_migrate
+from db_manager import DB_URL, create_db_engine, get_engine
+from db_model import Transactions, WalletCredentials, Wallets, BatchState, Lease
+
+# Rows read and inserted at a time
+CHUNK_SIZE = 1000
+
+TABLES = [Wallets, WalletCredentials, BatchState, Transactions]
+
+def copy(source_url = DB_URL, target = None):
+  '''Copy the rows of TABLES from source_url to target (the db_url engine by default),
+    returns {table name: rows copied}
+  '''
+  source = create_db_engine(source_url)
+  target = target or get_engine()
+  if source.url == target.url:
+    raise Exception('db_url must point to the new DB, not to {}'.format(source_url))
+  db_migrate.migrate(engine = source)
+  db_migrate.migrate(engine = target)
+  counts = {}
+  with source.connect() as source_conn:
+    leases = Lease.__table__
+    held = source_conn.execute(select(leases).where(leases.c.expires_timestamp >= int(time.time()))).first()
+    if held:
+      raise Exception('Lease {} is held by {}, stop the service first'.format(held.name, held.holder))
+    with target.begin() as target_conn:
+      if target_conn.execute(select(func.count()).select_from(Transactions.__table__)).scalar():
+        raise Exception('Target DB already has sends, copy into an empty DB')
+      for model in TABLES:
+        table = model.__table__
+        # Wallet files the target's own migration registered, the source registry replaces them
+        target_conn.execute(table.delete())
+        counts[table.name] = 0
+        result = source_conn.execution_options(yield_per = CHUNK_SIZE).execute(select(table))
+        for rows in result.partitions():
+          target_conn.execute(table.insert(), [dict(row._mapping) for row in rows])
+          counts[table.name] += len(rows)
+      db_migrate.reset_wallet_id_sequence(target_conn)
+  source.dispose()
+  return counts
+
+if __name__ == '__main__':
+  source_url = sys.argv[1] if len(sys.argv) > 1 else DB_URL
+  for table, count in copy(source_url).items():
+    print('{}: {} rows copied'.format(table, count))
@@ -1,35 +1,184 @@
-from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, or_, and_, cast, exists, select, BigInteger
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm.exc import NoResultFound
-from db_model import Transactions
+from db_model import Transactions, WalletCredentials, Wallets, BatchState, Lease
+from sqlalchemy.exc import IntegrityError
+import configparser
+import threading
 import time
 import uuid
-import cryptocode
+import metrics
+
+CONFIG_FILE = 'config.ini'
+# Default of db_url, a SQLite file in the working directory
+DB_URL = 'sqlite:///wallet_service_db'
+
+# Most sr_ids in one IN list, far below the bound parameter limit of SQLite
+IN_CHUNK_SIZE = 1000
+
+_engine = None
+_engine_url = None
+_session_factory = None
+_engine_lock = threading.Lock()
+
+def _fee_share(total_fee_sat, total_amount):
+  '''Fee of a send in sat, its part of the batch amount. Computed in 64 bits'''
+  return cast(Transactions.amount, BigInteger) * total_fee_sat // total_amount
+
+def _claim_statement(wallet_id, sr_ids):
+  '''Queued sends sr_ids of wallet, row locked. Rows locked by another transaction are skipped'''
+  return select(Transactions.sr_id).where(Transactions.wallet_id == wallet_id, Transactions.status == 'queued',
+    Transactions.sr_id.in_(sr_ids)).with_for_update(skip_locked = True)
+
+def _chunks(values, size = IN_CHUNK_SIZE):
+  values = list(values)
+  for i in range(0, len(values), size):
+    yield values[i:i + size]
+
+def _read_db_config():
+  config = configparser.ConfigParser()
+  config.read(CONFIG_FILE)
+  if 'SYSTEM' not in config:
+    config['SYSTEM'] = {}
+  return config['SYSTEM']
+
+def get_wallet_dir():
+  return _read_db_config().get('wallet_dir', 'wallets')
+
+def get_wallet_network():
+  '''Network new wallets are created on'''
+  return 'testnet' if _read_db_config().get('use_testnet') == 'True' else 'mainnet'
+
+def wallet_path(wallet_id):
+  return get_wallet_dir() + '/wallet_' + str(wallet_id)
+
+def _pool_args(db_config):
+  return {
+    'poolclass': QueuePool,
+    'pool_size': int(db_config.get('db_pool_size', 5)),
+    'max_overflow': int(db_config.get('db_pool_overflow', 10)),
+    'pool_pre_ping': True
+  }
+
+def _postgresql_connect_args(busy_timeout):
+  # A statement waiting busy_timeout ms for a row lock fails instead of waiting forever
+  return {'options': '-c lock_timeout={}'.format(busy_timeout)}
+
+def create_db_engine(db_url, echo_mode=False):
+  '''Pooled engine of db_url, a SQLite or PostgreSQL URL. SQLite
+    connections are tuned for concurrent readers and writers (WAL journal,
+    busy timeout), PostgreSQL ones wait as long for a row lock
+  '''
+  db_config = _read_db_config()
+  busy_timeout = int(db_config.get('db_busy_timeout', 5000))
+  if db_url.startswith('postgresql'):
+    # Needs a driver, e.g. pip install psycopg2-binary
+    return create_engine(db_url, echo=echo_mode, connect_args=_postgresql_connect_args(busy_timeout),
+      **_pool_args(db_config))
+  if not db_url.startswith('sqlite'):
+    raise Exception('db_url must be a sqlite:// or postgresql:// URL')
+  synchronous = db_config.get('db_synchronous', 'NORMAL').upper()
+  if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+    raise Exception('db_synchronous must be one of OFF, NORMAL, FULL, EXTRA')
+  engine = create_engine(db_url, echo=echo_mode,
+    connect_args={'check_same_thread': False, 'timeout': busy_timeout / 1000}, **_pool_args(db_config))
+
+  @event.listens_for(engine, 'connect')
+  def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA busy_timeout={}'.format(busy_timeout))
+    cursor.execute('PRAGMA synchronous={}'.format(synchronous))
+    cursor.close()
+
+  return engine
+
+def get_engine(echo_mode=False, url=None):
+  '''Return the engine of db_url shared by every DbManager in this process,
+    created on first use. url overrides db_url, e.g. for a scratch DB
+  '''
+  global _engine, _engine_url, _session_factory
+  with _engine_lock:
+    if _engine is None:
+      _engine_url = url or _read_db_config().get('db_url', DB_URL)
+      _engine = create_db_engine(_engine_url, echo_mode)
+      # Loaded rows are used after the block ends, keep them readable
+      _session_factory = sessionmaker(bind=_engine, expire_on_commit=False)
+    elif url and url != _engine_url:
+      raise Exception('DB engine already created for another URL')
+  return _engine
 
 class DbManager:
 
-  def __init__(self, echo_mode=False):
-    Base = declarative_base()
-    engine = create_engine('sqlite:///wallet_service_db', echo=echo_mode)
-    Base.metadata.bind = engine
-    self.session = sessionmaker(bind=engine)()
- 
+  def __init__(self, echo_mode=False, url=None):
+    get_engine(echo_mode, url)
+    self.session = _session_factory()
+
   def __del__(self):
-    self.session.close()
-  
+    session = getattr(self, 'session', None)
+    if session is not None:
+      session.close()
+
   def __exit__(self, *err):
-    pass
-  
+    # Returns the connection to the shared pool
+    if err[0] is not None:
+      self.session.rollback()
+    self.session.close()
+
   def __enter__(self):
     return self
 
   def close_session(self):
     self.session.close()    
 
-  def insert_transaction(self, address, amount, wallet_id, wallet_password):
+  @staticmethod
+  def new_sr_id():
+    return str(uuid.uuid4().hex)
+
+  def _lock_queue(self, wallet_id, queued = False):
+    '''Bump the queue version of wallet, first statement of a DB transaction
+      changing its queued sends. Its registry row stays locked until commit,
+      so concurrent changes of its queue wait for each other. With queued,
+      sends are queued and the wallet is flagged in the same statement.
+      A wallet file copied into wallet_dir by hand is registered on its first send
+    '''
+    wallet_id = int(wallet_id)
+    now = int(time.time())
+    wallets = Wallets.__table__
+    values = {'queue_version': wallets.c.queue_version + 1}
+    if queued:
+      values.update(has_queued = True, last_activity_timestamp = now)
+    result = self.session.execute(wallets.update().where(wallets.c.wallet_id == wallet_id).values(**values))
+    if result.rowcount == 0:
+      try:
+        self.session.execute(wallets.insert().values(wallet_id = wallet_id, path = wallet_path(wallet_id),
+          network = get_wallet_network(), created_timestamp = now, last_activity_timestamp = now,
+          has_queued = queued, queue_version = 1))
+      except IntegrityError:
+        # Registered by another worker meanwhile
+        self.session.rollback()
+        self._lock_queue(wallet_id, queued)
+
+  def _flag_queued(self, wallet_id):
+    '''Flag whether wallet still has sends waiting for a batch, last statement
+      of a DB transaction settling some
+    '''
+    wallet_id = int(wallet_id)
+    wallets = Wallets.__table__
+    transactions = Transactions.__table__
+    self.session.execute(wallets.update().where(wallets.c.wallet_id == wallet_id).values(
+      has_queued = exists().where(transactions.c.wallet_id == wallet_id, transactions.c.status == 'queued',
+        transactions.c.txid.is_(None)),
+      last_activity_timestamp = int(time.time())))
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'insert_transaction')
+  def insert_transaction(self, address, amount, wallet_id):
+    # Wallet ids come as str from requests and queue keys, PostgreSQL never compares them to integers
+    wallet_id = int(wallet_id)
     # Only sent transactions have txid and fee
-    sr_id = str(uuid.uuid4().hex)
+    sr_id = self.new_sr_id()
+    self._lock_queue(wallet_id, queued = True)
     obj = Transactions(
         sr_id = sr_id,
         txid = None,
@@ -39,34 +188,309 @@ class DbManager:
         fee = None,
         sr_timestamp = int(time.time()),
         tx_timestamp = None,
-        wallet_password = cryptocode.encrypt(wallet_password, sr_id)
+        status = 'queued'
       )
     self.session.add(obj)
     self.session.commit()
     return obj
 
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_unsent')
   def get_unsent(self, wallet_id):
-    return self.session.query(Transactions).filter(Transactions.txid == None, Transactions.wallet_id == wallet_id).all()
+    '''Queued sends of wallet, not those a batch is building'''
+    wallet_id = int(wallet_id)
+    # Queued sends have no txid either, so the partial index ix_transactions_pending serves it
+    return self.session.query(Transactions).filter(Transactions.status == 'queued', Transactions.txid == None,
+      Transactions.wallet_id == wallet_id).order_by(Transactions.sr_timestamp).all()
 
+  @metrics.DB_QUERY_SECONDS.time(query = 'insert_transactions')
+  def insert_transactions(self, wallet_id, sends):
+    '''Insert [sr_id, address, amount] sends of a wallet in one DB transaction'''
+    wallet_id = int(wallet_id)
+    sr_timestamp = int(time.time())
+    self._lock_queue(wallet_id, queued = True)
+    self.session.bulk_insert_mappings(Transactions, [{
+        'sr_id': sr_id,
+        'txid': None,
+        'address': address,
+        'amount': amount,
+        'wallet_id': wallet_id,
+        'fee': None,
+        'sr_timestamp': sr_timestamp,
+        'tx_timestamp': None,
+        'status': 'queued'
+      } for sr_id, address, amount in sends])
+    self.session.commit()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_credentials')
+  def get_credentials(self, wallet_id):
+    wallet_id = int(wallet_id)
+    return self.session.query(WalletCredentials).filter(WalletCredentials.wallet_id == wallet_id).one_or_none()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'set_credentials')
+  def set_credentials(self, wallet_id, envelope, salt):
+    wallet_id = int(wallet_id)
+    self.session.merge(WalletCredentials(wallet_id = wallet_id, envelope = envelope, salt = salt,
+      updated_timestamp = int(time.time())))
+    self.session.commit()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_all_unsent')
+  def get_all_unsent(self):
+    return self.session.query(Transactions.wallet_id, Transactions.sr_id, Transactions.address, Transactions.amount)\
+      .filter(Transactions.status == 'queued', Transactions.txid == None).order_by(Transactions.sr_timestamp).all()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_tx')
   def get_tx(self, sr_id):
     try:
       return self.session.query(Transactions).filter(Transactions.sr_id == sr_id).one()
     except Exception as e:
       return {}
 
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_all_txs')
   def get_all_txs(self, limit):
     return self.session.query(Transactions.txid, Transactions.sr_timestamp, Transactions.sr_id)\
       .order_by(Transactions.sr_timestamp).limit(limit).all()
 
-  def get_sent_txs(self, limit):
-    return self.session.query(Transactions.txid, Transactions.tx_timestamp, Transactions.sr_id)\
-      .filter(Transactions.txid != None).order_by(Transactions.tx_timestamp.desc()).limit(limit).all()
+  @staticmethod
+  def _sent_txs_query(query, wallet_id = None, cursor = None):
+    '''Sent transactions newest first, of wallet_id if given, after the
+      (tx_timestamp, sr_id) cursor if given
+    '''
+    query = query.filter(Transactions.status == 'sent')
+    if wallet_id is not None:
+      query = query.filter(Transactions.wallet_id == int(wallet_id))
+    if cursor is not None:
+      tx_timestamp, sr_id = cursor
+      query = query.filter(or_(Transactions.tx_timestamp < tx_timestamp,
+        and_(Transactions.tx_timestamp == tx_timestamp, Transactions.sr_id < sr_id)))
+    return query.order_by(Transactions.tx_timestamp.desc(), Transactions.sr_id.desc())
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_sent_txs')
+  def get_sent_txs(self, limit, wallet_id = None, cursor = None):
+    return self._sent_txs_query(self.session.query(Transactions.txid, Transactions.tx_timestamp, Transactions.sr_id),
+      wallet_id, cursor).limit(limit).all()
 
-  def update_transactions(self, wallet_id, txid, total_fee, total_amount):
-    objs = self.get_unsent(wallet_id)
+  def iter_sent_txs(self, wallet_id = None, batch_size = 1000):
+    '''Sent transactions newest first, in lists of at most batch_size rows
+      streamed from one cursor, so memory stays flat however many there are
+    '''
+    query = self._sent_txs_query(self.session.query(Transactions.tx_timestamp, Transactions.sr_id, Transactions.txid,
+      Transactions.wallet_id, Transactions.address, Transactions.amount, Transactions.fee), wallet_id)
+    result = self.session.execute(query.statement.execution_options(stream_results = True, yield_per = batch_size))
+    for rows in result.partitions():
+      yield rows
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'claim_transactions')
+  def claim_transactions(self, wallet_id, sr_ids):
+    '''Mark queued sends sr_ids of wallet as building a batch, returns the sr_ids claimed
+      On PostgreSQL the rows are locked first (SELECT ... FOR UPDATE SKIP LOCKED),
+      sends another node is claiming are skipped instead of waited for and
+      never claimed twice. SQLite has one writer at a time and ignores it
+    '''
+    wallet_id = int(wallet_id)
+    claimed = []
+    for chunk in _chunks(sr_ids):
+      locked = list(self.session.execute(_claim_statement(wallet_id, chunk)).scalars())
+      if not locked:
+        continue
+      self.session.query(Transactions).filter(Transactions.wallet_id == wallet_id, Transactions.sr_id.in_(locked))\
+        .update({Transactions.status: 'building'}, synchronize_session = False)
+      claimed += locked
+    self.session.commit()
+    return claimed
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'mark_broadcasting')
+  def mark_broadcasting(self, wallet_id, sr_ids, txid, total_fee, total_amount):
+    '''Record txid and the fee share of sends sr_ids of wallet before
+      broadcasting it, so a crash after the broadcast can still settle them
+    '''
+    wallet_id = int(wallet_id)
     total_fee_sat = int(total_fee * 1.0e8)
-    for obj in objs:
-      obj.txid = txid
-      obj.fee = int(total_fee_sat * (obj.amount / total_amount))
-      obj.tx_timestamp = int(time.time())
+    self._lock_queue(wallet_id)
+    for chunk in _chunks(sr_ids):
+      self.session.query(Transactions).filter(Transactions.wallet_id == wallet_id, Transactions.status == 'building',
+        Transactions.sr_id.in_(chunk)).update({
+          Transactions.status: 'broadcasting',
+          Transactions.txid: txid,
+          Transactions.fee: _fee_share(total_fee_sat, total_amount)
+        }, synchronize_session = False)
+    self._flag_queued(wallet_id)
+    self.session.commit()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'update_transactions')
+  def update_transactions(self, wallet_id, txid):
+    '''Mark the sends of wallet broadcast in txid as sent, returns their sr_ids'''
+    wallet_id = int(wallet_id)
+    condition = [Transactions.wallet_id == wallet_id, Transactions.txid == txid, Transactions.status == 'broadcasting']
+    self._lock_queue(wallet_id)
+    settled = [row.sr_id for row in self.session.query(Transactions.sr_id).filter(*condition)]
+    self.session.query(Transactions).filter(*condition).update({
+        Transactions.status: 'sent',
+        Transactions.tx_timestamp: int(time.time())
+      }, synchronize_session = False)
+    self._flag_queued(wallet_id)
+    self.session.commit()
+    return settled
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'release_transactions')
+  def release_transactions(self, wallet_id, sr_ids):
+    '''Queue sends sr_ids of wallet again, after their batch failed before it was sent'''
+    wallet_id = int(wallet_id)
+    self._lock_queue(wallet_id, queued = True)
+    for chunk in _chunks(sr_ids):
+      self.session.query(Transactions).filter(Transactions.wallet_id == wallet_id,
+        Transactions.status.in_(['building', 'broadcasting']), Transactions.sr_id.in_(chunk)).update({
+          Transactions.status: 'queued',
+          Transactions.txid: None,
+          Transactions.fee: None
+        }, synchronize_session = False)
+    self.session.commit()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_unsettled')
+  def get_unsettled(self):
+    '''(wallet_id, sr_id, txid, status) of sends left building or broadcasting'''
+    return self.session.query(Transactions.wallet_id, Transactions.sr_id, Transactions.txid, Transactions.status)\
+      .filter(Transactions.status.in_(['building', 'broadcasting'])).all()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'replace_transaction')
+  def replace_transaction(self, wallet_id, replaced_txid, txid, total_fee, total_amount):
+    '''Move sends of replaced_txid and the sends of wallet broadcast in txid,
+      the tx replacing it, to txid as sent. Returns the sr_ids newly marked sent
+    '''
+    wallet_id = int(wallet_id)
+    self._lock_queue(wallet_id)
+    settled = [row.sr_id for row in self.session.query(Transactions.sr_id).filter(Transactions.wallet_id == wallet_id,
+      Transactions.txid == txid, Transactions.status == 'broadcasting')]
+    total_fee_sat = int(total_fee * 1.0e8)
+    self.session.query(Transactions).filter(Transactions.wallet_id == wallet_id,
+      Transactions.txid.in_([replaced_txid, txid])).update({
+        Transactions.status: 'sent',
+        Transactions.txid: txid,
+        Transactions.fee: _fee_share(total_fee_sat, total_amount),
+        Transactions.tx_timestamp: int(time.time())
+      }, synchronize_session = False)
+    self._flag_queued(wallet_id)
+    self.session.commit()
+    return settled
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'revert_replacement')
+  def revert_replacement(self, wallet_id, txid, replaced_txid, sr_ids, total_fee, total_amount):
+    '''Undo the replacement of replaced_txid by txid once replaced_txid was
+      mined instead: its sends sr_ids go back to it, the other sends of
+      wallet sent in txid are queued again. Returns the sr_ids queued again
+    '''
+    wallet_id = int(wallet_id)
+    total_fee_sat = int(total_fee * 1.0e8)
+    condition = [Transactions.wallet_id == wallet_id, Transactions.txid == txid, Transactions.status == 'sent']
+    self._lock_queue(wallet_id, queued = True)
+    for chunk in _chunks(sr_ids):
+      self.session.query(Transactions).filter(*condition, Transactions.sr_id.in_(chunk)).update({
+          Transactions.txid: replaced_txid,
+          Transactions.fee: _fee_share(total_fee_sat, total_amount)
+        }, synchronize_session = False)
+    released = [row.sr_id for row in self.session.query(Transactions.sr_id).filter(*condition)]
+    self.session.query(Transactions).filter(*condition).update({
+        Transactions.status: 'queued',
+        Transactions.txid: None,
+        Transactions.fee: None,
+        Transactions.tx_timestamp: None
+      }, synchronize_session = False)
+    self.session.commit()
+    return released
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'add_wallet')
+  def add_wallet(self):
+    '''Register a new wallet, returns its id. Ids are never reused, its file is created afterwards'''
+    now = int(time.time())
+    while True:
+      wallet = Wallets(network = get_wallet_network(), created_timestamp = now, last_activity_timestamp = now,
+        has_queued = False, queue_version = 0)
+      self.session.add(wallet)
+      try:
+        self.session.flush()
+        break
+      except IntegrityError:
+        # PostgreSQL sequence behind a wallet registered with its own id, the next value is free
+        self.session.rollback()
+    wallet.path = wallet_path(wallet.wallet_id)
+    self.session.commit()
+    return wallet.wallet_id
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'remove_wallet')
+  def remove_wallet(self, wallet_id):
+    self.session.query(Wallets).filter(Wallets.wallet_id == int(wallet_id)).delete(synchronize_session = False)
+    self.session.commit()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_wallets')
+  def get_wallets(self):
+    return self.session.query(Wallets).order_by(Wallets.created_timestamp, Wallets.wallet_id).all()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_queue_versions')
+  def get_queue_versions(self, wallet_ids = ()):
+    '''(wallet_id, queue_version) of the wallets with queued sends and of wallet_ids'''
+    # Partial index of queued wallets, dormant ones are never read
+    rows = self.session.query(Wallets.wallet_id, Wallets.queue_version).filter(Wallets.has_queued == True).all()
+    for chunk in _chunks(int(wallet_id) for wallet_id in wallet_ids):
+      rows += self.session.query(Wallets.wallet_id, Wallets.queue_version).filter(Wallets.wallet_id.in_(chunk)).all()
+    return rows
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_batch_states')
+  def get_batch_states(self, shard = None, shard_count = 1):
+    '''Batch states of every wallet, or of the wallets of shard'''
+    query = self.session.query(BatchState)
+    if shard is not None:
+      query = query.filter(BatchState.wallet_id % shard_count == shard)
+    return query.all()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'save_batch_state')
+  def save_batch_state(self, wallet_id, state):
+    wallet_id = int(wallet_id)
+    self.session.merge(BatchState(
+      wallet_id = wallet_id,
+      threshold_multiplier = state['threshold_multiplier'],
+      last_batch_send_try = state['last_batch_send_try'],
+      open = state['open'],
+      fa_ratio = state.get('fa_ratio'),
+      fa_ratio_limit = state.get('fa_ratio_limit'),
+      updated_timestamp = int(time.time())))
+    self.session.commit()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'acquire_lease')
+  def acquire_lease(self, name, holder, ttl, url = None):
+    '''Take lease name for holder, at node url, if it is free or expired, or
+      renew it if holder has it. True if holder has it for the next ttl seconds
+    '''
+    now = int(time.time())
+    leases = Lease.__table__
+    # One conditional UPDATE, so two holders can never both take it
+    result = self.session.execute(leases.update()
+      .where(leases.c.name == name, or_(leases.c.holder == holder, leases.c.expires_timestamp < now))
+      .values(holder = holder, expires_timestamp = now + ttl, url = url))
+    if result.rowcount == 0:
+      try:
+        self.session.execute(leases.insert().values(name = name, holder = holder, expires_timestamp = now + ttl,
+          url = url))
+      except IntegrityError:
+        # Held by another holder
+        self.session.rollback()
+        return False
+    self.session.commit()
+    return True
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'release_lease')
+  def release_lease(self, name, holder):
+    leases = Lease.__table__
+    self.session.execute(leases.update().where(leases.c.name == name, leases.c.holder == holder)
+      .values(expires_timestamp = 0))
+    self.session.commit()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'get_leases')
+  def get_leases(self, prefix):
+    '''Leases named prefix... held now'''
+    return self.session.query(Lease).filter(Lease.name.startswith(prefix, autoescape = True),
+      Lease.expires_timestamp >= int(time.time())).all()
+
+  @metrics.DB_QUERY_SECONDS.time(query = 'delete_expired_leases')
+  def delete_expired_leases(self, prefix):
+    self.session.query(Lease).filter(Lease.name.startswith(prefix, autoescape = True),
+      Lease.expires_timestamp < int(time.time())).delete(synchronize_session = False)
     self.session.commit()
@@ -0,0 +1,154 @@
+'''Versioned schema migrations of the wallet service DB
+
+  Each migration is applied once, in order, and recorded in the
+  schema_version table. Run `python db_migrate.py` to upgrade the DB
+'''
+import os
+import re
+import sys
+import time
+import logging
+import cryptocode
+from sqlalchemy import inspect, select, text
+from sqlalchemy.schema import CreateTable
+from db_manager import get_engine, get_wallet_dir, get_wallet_network, wallet_path
+from db_model import Transactions, WalletCredentials, Wallets, BatchState, Lease, SchemaVersion
+import wallet_keyring
+
+def _create_transactions(conn):
+  # Table only, as shipped before versioning. Indexes come in later versions
+  conn.execute(CreateTable(Transactions.__table__, if_not_exists = True))
+
+def _index_transactions(conn):
+  # DBs created before versioning have the table but none of its indexes
+  for index in Transactions.__table__.indexes:
+    index.create(conn, checkfirst = True)
+
+def _wallet_credentials(conn):
+  WalletCredentials.__table__.create(conn, checkfirst = True)
+  transactions = Transactions.__table__
+  # One envelope per wallet, from the password of its latest queued send
+  rows = conn.execute(select(transactions.c.wallet_id, transactions.c.sr_id, transactions.c.wallet_password)
+    .where(transactions.c.txid.is_(None), transactions.c.wallet_password.isnot(None))
+    .order_by(transactions.c.sr_timestamp.desc())).fetchall()
+  wallet_ids = set()
+  for row in rows:
+    if row.wallet_id in wallet_ids:
+      continue
+    wallet_password = cryptocode.decrypt(row.wallet_password, row.sr_id)
+    if wallet_password is False:
+      logging.warning('Could not decrypt password of queued send %s', row.sr_id)
+      continue
+    envelope, salt = wallet_keyring.seal(wallet_password)
+    conn.execute(WalletCredentials.__table__.insert().values(wallet_id = row.wallet_id,
+      envelope = envelope, salt = salt, updated_timestamp = int(time.time())))
+    wallet_ids.add(row.wallet_id)
+  conn.execute(transactions.update().where(transactions.c.wallet_password.isnot(None)).values(wallet_password = None))
+
+def _index_history(conn):
+  for index in Transactions.__table__.indexes:
+    if index.name in ('ix_transactions_history', 'ix_transactions_wallet_history'):
+      index.create(conn, checkfirst = True)
+  # Covered by ix_transactions_history
+  conn.execute(text('DROP INDEX IF EXISTS ix_transactions_tx_timestamp'))
+
+def _batch_state(conn):
+  BatchState.__table__.create(conn, checkfirst = True)
+  Lease.__table__.create(conn, checkfirst = True)
+
+def _transaction_status(conn):
+  # Tables created from version 6 on already have it
+  if 'status' not in [column['name'] for column in inspect(conn).get_columns('transactions')]:
+    conn.execute(text('ALTER TABLE transactions ADD COLUMN status VARCHAR(16)'))
+  transactions = Transactions.__table__
+  conn.execute(transactions.update().where(transactions.c.status.is_(None), transactions.c.txid.is_(None))
+    .values(status = 'queued'))
+  conn.execute(transactions.update().where(transactions.c.status.is_(None)).values(status = 'sent'))
+
+def _wallet_registry(conn):
+  Wallets.__table__.create(conn, checkfirst = True)
+  wallet_dir = get_wallet_dir()
+  if not os.path.isdir(wallet_dir):
+    return
+  transactions = Transactions.__table__
+  queued = set(row.wallet_id for row in conn.execute(select(transactions.c.wallet_id)
+    .where(transactions.c.txid.is_(None)).distinct()))
+  # Wallet files created before the registry, by the CLI as wallet_<id>
+  for name in os.listdir(wallet_dir):
+    match = re.fullmatch(r'wallet_(\d+)', name)
+    if not match:
+      continue
+    wallet_id = int(match.group(1))
+    modified = int(os.path.getmtime(wallet_path(wallet_id)))
+    conn.execute(Wallets.__table__.insert().values(wallet_id = wallet_id, path = wallet_path(wallet_id),
+      network = get_wallet_network(), created_timestamp = modified, last_activity_timestamp = modified,
+      has_queued = wallet_id in queued, queue_version = 0))
+  reset_wallet_id_sequence(conn)
+
+def reset_wallet_id_sequence(conn):
+  '''After wallets were inserted with their own ids, new ones continue after the highest
+    SQLite AUTOINCREMENT already does
+  '''
+  if conn.dialect.name == 'postgresql':
+    conn.execute(text("SELECT setval(pg_get_serial_sequence('wallets', 'wallet_id'), "
+      "COALESCE(MAX(wallet_id), 0) + 1, false) FROM wallets"))
+
+def _lease_url(conn):
+  # Tables created from version 8 on already have it
+  if 'url' not in [column['name'] for column in inspect(conn).get_columns('leases')]:
+    conn.execute(text('ALTER TABLE leases ADD COLUMN url VARCHAR(250)'))
+
+# (version, description, function), append only
+MIGRATIONS = [
+  (1, 'create transactions table', _create_transactions),
+  (2, 'index transactions for queue and history lookups', _index_transactions),
+  (3, 'move wallet passwords of sends to wallet credentials', _wallet_credentials),
+  (4, 'index send history for cursor pagination', _index_history),
+  (5, 'create batch state and leases tables', _batch_state),
+  (6, 'add settlement status of sends', _transaction_status),
+  (7, 'create wallet registry from the wallet files', _wallet_registry),
+  (8, 'add node url of lease holders', _lease_url),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# PostgreSQL advisory lock key held while a migration is applied
+MIGRATION_LOCK = 7231
+
+def get_version(conn):
+  if not inspect(conn).has_table(SchemaVersion.__tablename__):
+    return 0
+  version = conn.execute(SchemaVersion.__table__.select()
+    .order_by(SchemaVersion.version.desc()).limit(1)).first()
+  return version.version if version else 0
+
+def _lock(conn):
+  '''On PostgreSQL, make nodes starting at once migrate one after the other'''
+  if conn.dialect.name == 'postgresql':
+    conn.execute(text('SELECT pg_advisory_xact_lock({})'.format(MIGRATION_LOCK)))
+
+def migrate(target = LATEST_VERSION, engine = None):
+  '''Apply pending migrations up to target version, returns the new version'''
+  engine = engine or get_engine()
+  with engine.begin() as conn:
+    _lock(conn)
+    SchemaVersion.__table__.create(conn, checkfirst = True)
+    version = get_version(conn)
+  for migration_version, description, func in MIGRATIONS:
+    if migration_version <= version or migration_version > target:
+      continue
+    # One DB transaction per migration, a failed step is not recorded
+    with engine.begin() as conn:
+      _lock(conn)
+      # Unless another node applied it meanwhile
+      if get_version(conn) < migration_version:
+        logging.info('Applying DB migration %s: %s', migration_version, description)
+        func(conn)
+        conn.execute(SchemaVersion.__table__.insert().values(
+          version = migration_version, applied_timestamp = int(time.time())))
+    version = migration_version
+  return version
+
+if __name__ == '__main__':
+  target = int(sys.argv[1]) if len(sys.argv) > 1 else LATEST_VERSION
+  print('DB schema version: {}'.format(migrate(target)))
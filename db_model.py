@@ -1,9 +1,6 @@
-from sqlalchemy import create_engine
-from sqlalchemy import String, Column, BigInteger, Integer
+from sqlalchemy import String, Column, BigInteger, Integer, Index, Boolean, Float
 from sqlalchemy.ext.declarative import declarative_base
 
-engine = create_engine('sqlite:///wallet_service_db')
-
 Base = declarative_base()
 
 class Transactions(Base):
@@ -16,6 +13,73 @@ class Transactions(Base):
     fee = Column(Integer)
     sr_timestamp = Column(BigInteger)
     tx_timestamp = Column(BigInteger)
+    # Empty since schema version 3, the password is in WalletCredentials
     wallet_password = Column(String(2000))
+    # queued -> building (claimed by a batch) -> broadcasting (txid and fee set) -> sent
+    status = Column(String(16), default = 'queued')
+    __table_args__ = (
+        # Lookup of sends by wallet and batch transaction
+        Index('ix_transactions_wallet_txid', 'wallet_id', 'txid'),
+        # Queued sends only, stays small however long the history grows
+        Index('ix_transactions_pending', 'wallet_id', 'sr_timestamp',
+            sqlite_where = txid.is_(None), postgresql_where = txid.is_(None)),
+        # Send history ordered by time, sr_id breaks ties for cursor pagination
+        Index('ix_transactions_history', 'tx_timestamp', 'sr_id'),
+        Index('ix_transactions_wallet_history', 'wallet_id', 'tx_timestamp', 'sr_id'),
+    )
+
+class WalletCredentials(Base):
+    __tablename__ = 'wallet_credentials'
+    wallet_id = Column(Integer, primary_key = True)
+    envelope = Column(String(2000))
+    salt = Column(String(64))
+    updated_timestamp = Column(BigInteger)
+
+class Wallets(Base):
+    __tablename__ = 'wallets'
+    # Never reused, ids of removed wallets stay taken
+    wallet_id = Column(Integer, primary_key = True)
+    path = Column(String(1000))
+    network = Column(String(16))
+    created_timestamp = Column(BigInteger)
+    # Last time its queued sends changed
+    last_activity_timestamp = Column(BigInteger)
+    # Has sends waiting for a batch
+    has_queued = Column(Boolean, default = False)
+    # Bumped with every change of its queued sends, workers reload a queue whose version moved
+    queue_version = Column(Integer, default = 0)
+    __table_args__ = (
+        # Wallets with queued sends only, however many dormant ones exist
+        Index('ix_wallets_queued', 'wallet_id',
+            sqlite_where = has_queued == True, postgresql_where = has_queued == True),
+        {'sqlite_autoincrement': True},
+    )
+
+class BatchState(Base):
+    __tablename__ = 'batch_state'
+    wallet_id = Column(Integer, primary_key = True)
+    threshold_multiplier = Column(Integer)
+    last_batch_send_try = Column(BigInteger)
+    # Past its send frequency tick, a batch meeting the ratio goes out right away
+    open = Column(Boolean)
+    fa_ratio = Column(Float)
+    fa_ratio_limit = Column(Float)
+    updated_timestamp = Column(BigInteger)
+
+class Lease(Base):
+    __tablename__ = 'leases'
+    name = Column(String(64), primary_key = True)
+    holder = Column(String(250))
+    expires_timestamp = Column(BigInteger)
+    # Node URL of the holder, other nodes redirect requests for wallets of its shards there
+    url = Column(String(250))
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key = True)
+    applied_timestamp = Column(BigInteger)
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+if __name__ == '__main__':
+    # Kept for older install instructions, schema is managed by db_migrate
+    import db_migrate
+    db_migrate.migrate()
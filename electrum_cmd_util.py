@@ -1,16 +1,41 @@
 import os
+import copy
 import configparser
 import electrum
 import time
 import asyncio
 import logging
 import logging.config
-import cryptocode
+import wallet_keyring
+import history_export
+import tx_size
+import metrics
 from threading import Thread
 from hashlib import sha256
+from decimal import Decimal
 from db_manager import DbManager
+from wallet_cache import WalletCache
+from wallet_writer import WalletWriter
+from wallet_executor import WalletExecutor
+from balance_monitor import BalanceMonitor
+from queue_state import QueueState
+from fee_cache import FeeCache
+from batch_scheduler import BatchScheduler
+from shard_leases import ShardLeases
+from wallet_keyring import WalletKeyring
 
 CONFIG_FILE = 'config.ini'
+# sat/vB a replacement pays on top of the replaced fee, Bitcoin Core default
+INCREMENTAL_RELAY_FEE = 1
+# Seconds before asking the network about a tx whose broadcast had no clear outcome
+BROADCAST_RECOVERY_DELAY = 60
+
+def sat_to_btc(amount_sat):
+  '''BTC amount of amount_sat, electrum parses it with Decimal(amount) so it has to be exact'''
+  return Decimal(amount_sat) / 100000000
+
+class BroadcastRejected(Exception):
+  '''The server refused the tx, it did not reach the network through it'''
 
 class ElectrumCmdUtil():
   '''Utility class for Electrum commands and helper methods'''
@@ -28,6 +53,45 @@ class ElectrumCmdUtil():
     self.cmd = electrum.Commands(config = self.conf)
     self.wallet = None
     self.wallet_password = None
+    self.wallet_cache = WalletCache(
+      max_size = int(self.config['SYSTEM'].get('wallet_cache_size', 32)),
+      max_idle = int(self.config['SYSTEM'].get('wallet_cache_idle', 600)))
+    self.balance_monitor = BalanceMonitor(self.wallet_cache,
+      max_size = int(self.config['SYSTEM'].get('balance_monitor_size', 16)),
+      max_idle = int(self.config['SYSTEM'].get('balance_monitor_idle', 3600)))
+    self.wallet_writer = WalletWriter(self.wallet_cache,
+      interval = float(self.config['SYSTEM'].get('wallet_flush_interval', 1)),
+      writable = self._writes_wallet)
+    self.queue_state = QueueState()
+    self.fee_cache = FeeCache(self.conf,
+      max_age = int(self.config['SYSTEM'].get('fee_max_age', 600)),
+      refresh_interval = int(self.config['SYSTEM'].get('fee_refresh_interval', 60)))
+    self.batch_scheduler = BatchScheduler()
+    self.keyring = WalletKeyring(ttl = int(self.config['SYSTEM'].get('keyring_ttl', 3600)))
+    # Last coin selection per wallet path, valid while the UTXO set is unchanged
+    self.coin_selections = {}
+    self.executor = WalletExecutor(
+      max_threads = int(self.config['SYSTEM'].get('executor_threads', 8)),
+      crypto_processes = int(self.config['SYSTEM'].get('executor_crypto_processes', 0)))
+    self.shards = ShardLeases(self.executor,
+      shard_count = int(self.config['SYSTEM'].get('shard_count', 1)),
+      ttl = int(self.config['SYSTEM'].get('leader_lease_ttl', 30)),
+      url = self.config['SYSTEM'].get('node_url'))
+
+  def _writes_wallet(self, wallet):
+    '''Only the holder of the shard of a wallet, the API worker or node sending
+      its batches, writes its file. Other workers would overwrite its batch txs
+    '''
+    return self.shards.holds(os.path.basename(wallet.storage.path).rsplit('_', 1)[-1])
+
+  def wallet_view(self):
+    '''Copy sharing config, network, caches and executor but with its own
+      current wallet, so concurrent requests never swap each other's wallet
+    '''
+    view = copy.copy(self)
+    view.wallet = None
+    view.wallet_password = None
+    return view
 
   def get_event_loop(self):
     try:
@@ -44,6 +108,7 @@ class ElectrumCmdUtil():
       self.network = electrum.Network(self.conf)
     self.network.start()
     self.cmd.network = self.network
+    self.balance_monitor.start(self.network)
 
   async def wait_for_connection(self):
     while not self.network.is_connected():
@@ -143,16 +208,32 @@ class ElectrumCmdUtil():
     seed = wallet.get_seed(wallet_password)
     return [xpub, seed]
 
+  @metrics.OPERATION_SECONDS.time(operation = 'load_wallet')
   def load_wallet(self, wallet_id, wallet_password):
     wallet_path = self._get_wallet_path(wallet_id)
+    wallet = self.wallet_cache.get(wallet_id, wallet_password, wallet_path)
+    if wallet:
+      return wallet
+    # Changes of a copy dropped from the cache must be on disk before reading it again
+    self.wallet_writer.flush_path(wallet_path)
     storage = electrum.WalletStorage(wallet_path)
     if not storage.file_exists():
       raise Exception('{} does not exist'.format(wallet_path))
     storage.decrypt(wallet_password)
     db = electrum.wallet_db.WalletDB(storage.read(), manual_upgrades=True)
     wallet = electrum.Wallet(db, storage, config=self.conf)
+    self.wallet_writer.attach(wallet)
+    self.wallet_cache.put(wallet_id, wallet_password, wallet_path, wallet)
     return wallet
 
+  def save_wallet(self, wallet = None):
+    # Written by the wallet writer, with other changes of the wallet
+    (wallet or self.wallet).save_db()
+
+  def flush_wallet(self, wallet = None):
+    '''Write the wallet file now if it has unwritten changes'''
+    self.wallet_writer.flush_wallet(wallet or self.wallet)
+
   def set_wallet(self, wallet_id, wallet_password):
     self.wallet_password = wallet_password
     self.wallet = self.load_wallet(wallet_id, wallet_password)
@@ -171,34 +252,129 @@ class ElectrumCmdUtil():
     if stop_on_complete:
       self.stop_network()
 
+  def _make_outputs(self, destination = None, amount = None, outputs = None):
+    final_outputs = []
+    if destination and amount:
+      amount_sat = electrum.commands.satoshis_or_max(amount)
+      final_outputs = [electrum.transaction.PartialTxOutput.from_address_and_value(destination, amount_sat)]
+    else:
+      for address, amount in outputs:
+        amount_sat = electrum.commands.satoshis_or_max(amount)
+        final_outputs.append(electrum.transaction.PartialTxOutput.from_address_and_value(address, amount_sat))
+    return final_outputs
+
+  def _make_unsigned_tx(self, final_outputs, fee):
+    # Coin selection only, no password needed and nothing is signed
+    return self.wallet.create_transaction(
+        final_outputs,
+        fee=fee,
+        feerate=None,
+        change_addr=None,
+        domain_addr=None,
+        domain_coins=None,
+        unsigned=True,
+        rbf=True,
+        password=None,
+        locktime=None)
+
+  def _get_coin_selection(self, amount, fee, make_outputs):
+    '''Inputs electrum selects to pay amount plus fee. The selection is
+      reused while the wallet UTXO set stays the same and still covers the
+      amount, else coins are selected again for the outputs from make_outputs
+    '''
+    coins = self.wallet.get_spendable_coins(None)
+    utxo_fingerprint = hash(frozenset(coin.prevout.to_str() for coin in coins))
+    selection = self.coin_selections.get(self.wallet.storage.path)
+    if selection and selection['utxo_fingerprint'] == utxo_fingerprint and selection['value'] >= amount + fee:
+      return selection
+    tx = self._make_unsigned_tx(make_outputs(), fee)
+    selection = {
+      'utxo_fingerprint': utxo_fingerprint,
+      'num_inputs': len(tx.inputs()),
+      'value': sum(txin.value_sats() for txin in tx.inputs())
+    }
+    self.coin_selections[self.wallet.storage.path] = selection
+    return selection
+
+  def _estimate_size(self, amount, num_outputs, outputs_size, make_outputs):
+    '''Size in vbytes and number of inputs of a tx paying amount to
+      num_outputs outputs of outputs_size bytes in total
+    '''
+    txin_type = getattr(self.wallet, 'txin_type', None)
+    if not tx_size.is_supported(txin_type):
+      # Fee here does not matter, but we have to provide it if not dynamic fee is available at the moment
+      tx = self._make_unsigned_tx(make_outputs(), fee=1)
+      return tx.estimated_size(), len(tx.inputs())
+    fee = 1
+    for _ in range(5):
+      selection = self._get_coin_selection(amount, fee, make_outputs)
+      size = tx_size.estimate_vsize_from_totals(txin_type, selection['num_inputs'], num_outputs, outputs_size)
+      fee = self.fee_cache.estimate_fee(size)
+      # Done once selected coins also cover the fee for the estimated size
+      if selection['value'] >= amount + fee:
+        return size, selection['num_inputs']
+    tx = self._make_unsigned_tx(make_outputs(), fee)
+    return tx.estimated_size(), len(tx.inputs())
+
+  def get_output_size(self, address):
+    script = electrum.bitcoin.address_to_script(address)
+    # Hex str in older electrum versions, bytes in current ones
+    return tx_size.output_size(len(script if isinstance(script, bytes) else bytes.fromhex(script)))
+
+  @metrics.OPERATION_SECONDS.time(operation = 'get_tx_size')
   def get_tx_size(self, destination = None, amount = None, outputs = None):
     try:
-      # Fee here does not matter, but we have to provide it if not dynamic fee is available at the moment
-      tx = self.create_tx(destination = destination, amount = amount, outputs = outputs, fee = 0.00000001)
-      tx = electrum.Transaction(tx)
-      tx_size = tx.estimated_size()
-      self.wallet.remove_transaction(tx.txid())
-      return tx_size
+      final_outputs = self._make_outputs(destination, amount, outputs)
+      if any(output.value == '!' for output in final_outputs):
+        return self._make_unsigned_tx(final_outputs, fee=1).estimated_size()
+      size, num_inputs = self._estimate_size(
+        sum(output.value for output in final_outputs),
+        len(final_outputs),
+        sum(tx_size.output_size(len(output.scriptpubkey)) for output in final_outputs),
+        lambda: final_outputs)
+      return size
     except Exception as e:
       raise Exception("Failed to estimate tx size for wallet: {} {}".format(self.wallet, e))
 
-  def create_tx(self, destination = None, amount = None, outputs = None, fee = None):
+  @metrics.OPERATION_SECONDS.time(operation = 'get_queue_tx_size')
+  def get_queue_tx_size(self, queue, outputs = None):
+    '''Size and number of inputs of the batch tx of a QueueState queue,
+      plus optional extra [address, btc amount] outputs. Uses the queue running totals, the
+      queued outputs are only built when coins have to be selected again
+    '''
     try:
-      final_outputs = []
-      if destination and amount:
-        amount_sat = electrum.commands.satoshis_or_max(amount)
-        final_outputs = [electrum.transaction.PartialTxOutput.from_address_and_value(destination, amount_sat)]
-      else:
-        for address, amount in outputs:
-          amount_sat = electrum.commands.satoshis_or_max(amount)
-          final_outputs.append(electrum.transaction.PartialTxOutput.from_address_and_value(address, amount_sat))
+      extra_outputs = self._make_outputs(outputs = outputs) if outputs else []
+      def make_outputs():
+        return self._make_outputs(outputs = [[address, sat_to_btc(amount_sat)]
+          for address, amount_sat, output_size in list(queue['outputs'].values())]) + extra_outputs
+      return self._estimate_size(
+        queue['amount'] + sum(output.value for output in extra_outputs),
+        len(queue['outputs']) + len(extra_outputs),
+        queue['outputs_size'] + sum(tx_size.output_size(len(output.scriptpubkey)) for output in extra_outputs),
+        make_outputs)
+    except Exception as e:
+      raise Exception("Failed to estimate tx size for wallet: {} {}".format(self.wallet, e))
+
+  @metrics.OPERATION_SECONDS.time(operation = 'create_tx')
+  def create_tx(self, destination = None, amount = None, outputs = None, fee = None, exclude_txids = None,
+      domain_prevouts = None):
+    '''Signed tx, with exclude_txids its inputs do not spend outputs of those txs,
+      with domain_prevouts it only spends those 'txid:n' coins
+    '''
+    try:
+      final_outputs = self._make_outputs(destination, amount, outputs)
+      domain_coins = None
+      if exclude_txids or domain_prevouts:
+        domain_coins = [coin for coin in self.wallet.get_spendable_coins(None)
+          if (not exclude_txids or coin.prevout.txid.hex() not in exclude_txids)
+          and (not domain_prevouts or coin.prevout.to_str() in domain_prevouts)]
       tx = self.wallet.create_transaction(
           final_outputs,
           fee=electrum.commands.satoshis(fee),
           feerate=None,
           change_addr=None,
           domain_addr=None,
-          domain_coins=None,
+          domain_coins=domain_coins,
           unsigned=False,
           rbf=True,
           password=self.wallet_password,
@@ -208,6 +384,21 @@ class ElectrumCmdUtil():
     except Exception as e:
       raise Exception("Failed to create tx for wallet: {} {}".format(self.wallet, e))
 
+  def is_unconfirmed(self, txid):
+    '''True while txid of the wallet is not mined, so it can still be replaced'''
+    if not self.wallet.db.get_transaction(txid):
+      return False
+    return self.wallet.get_tx_height(txid).conf <= 0
+
+  def is_mined(self, txid):
+    if not self.wallet.db.get_transaction(txid):
+      return False
+    return self.wallet.get_tx_height(txid).conf > 0
+
+  def has_descendants(self, txid):
+    '''True if other wallet txs spend outputs of txid, replacing it would drop them'''
+    return bool(self.wallet.get_depending_transactions(txid))
+
   def send_to(self, destination, amount):
     logging.info("Trying to send full balance of %s", self.wallet)
     tx = self.create_tx(destination = destination, amount = amount)
@@ -234,24 +425,176 @@ class ElectrumCmdUtil():
       self.wallet.remove_transaction(tx.txid())
       raise Exception("Failed to broadcast wallet: {} tx: {} {}".format(self.wallet, tx.txid(), e))
 
+  @metrics.OPERATION_SECONDS.time(operation = 'async_broadcast')
   async def async_broadcast(self, tx):
+    '''Broadcast serialized tx. If the server refuses it, it is removed from
+      the wallet and BroadcastRejected is raised. Other errors, like timeouts
+      and lost connections, leave it in the wallet: it may be on the network
+    '''
+    tx = electrum.Transaction(tx)
     try:
-      tx = electrum.Transaction(tx)
       logging.info('Trying to broadcast {}...'.format(tx.txid()))
       await self.network.broadcast_transaction(tx)
       logging.info("{} sent txid: {}".format(self.wallet, tx.txid()))
-    except Exception as e:
+    except electrum.network.TxBroadcastServerReturnedError as e:
       self.wallet.remove_transaction(tx.txid())
-      raise Exception("Failed to broadcast wallet: {} tx: {} {}".format(self.wallet, tx.txid(), e))
+      raise BroadcastRejected("Failed to broadcast wallet: {} tx: {} {}".format(self.wallet, tx.txid(), e))
+    except Exception as e:
+      raise Exception("Broadcast of wallet: {} tx: {} has no clear outcome: {}".format(self.wallet, tx.txid(), e))
 
 class APICmdUtil:
 
-  def __init__(self, cmd_manager, wallet_id = None, wallet_password = None):
+  def __init__(self, cmd_manager):
     self.cmd_manager = cmd_manager
-    self.wallets = {}
-    if wallet_id != None:
-      self.wallet_id = wallet_id
-      self.cmd_manager.set_wallet(wallet_id, wallet_password)
+    self.executor = cmd_manager.executor
+    # Batch state is shared by every util of the service
+    self.wallets = cmd_manager.batch_scheduler.wallets
+
+  @classmethod
+  async def open(cls, cmd_manager, wallet_id, wallet_password):
+    '''Util for a single wallet, loaded on the executor instead of the event loop'''
+    cmd_util = cls(cmd_manager)
+    cmd_util.wallet_id = wallet_id
+    cmd_util.cmd_manager = cmd_manager.wallet_view()
+    async with cmd_util.executor.wallet_lock(wallet_id):
+      await cmd_util._set_wallet(wallet_id, wallet_password)
+    return cmd_util
+
+  async def _set_wallet(self, wallet_id, wallet_password):
+    await self.executor.run(self.cmd_manager.set_wallet, wallet_id, wallet_password)
+    # Synced while cached, only wallets whose balance is asked for stay pinned
+    self.cmd_manager.balance_monitor.attach(self.cmd_manager.wallet)
+
+  @staticmethod
+  def _get_unsent(wallet_id):
+    with DbManager() as db_manager:
+      return db_manager.get_unsent(wallet_id)
+
+  @staticmethod
+  def _insert_transaction(addr, amount, wallet_id):
+    with DbManager() as db_manager:
+      return db_manager.insert_transaction(addr, amount, wallet_id).sr_id
+
+  @staticmethod
+  def _claim_transactions(wallet_id, sr_ids):
+    with DbManager() as db_manager:
+      return db_manager.claim_transactions(wallet_id, sr_ids)
+
+  @staticmethod
+  def _mark_broadcasting(wallet_id, sr_ids, txid, total_fee, total_amount):
+    with DbManager() as db_manager:
+      db_manager.mark_broadcasting(wallet_id, sr_ids, txid, total_fee, total_amount)
+
+  @staticmethod
+  def _update_transactions(wallet_id, txid):
+    with DbManager() as db_manager:
+      return db_manager.update_transactions(wallet_id, txid)
+
+  @staticmethod
+  def _release_transactions(wallet_id, sr_ids):
+    with DbManager() as db_manager:
+      db_manager.release_transactions(wallet_id, sr_ids)
+
+  @staticmethod
+  def _get_unsettled():
+    with DbManager() as db_manager:
+      return db_manager.get_unsettled()
+
+  @staticmethod
+  def _insert_transactions(wallet_id, sends):
+    with DbManager() as db_manager:
+      db_manager.insert_transactions(wallet_id, sends)
+
+  @staticmethod
+  def _get_credentials(wallet_id):
+    with DbManager() as db_manager:
+      return db_manager.get_credentials(wallet_id)
+
+  @staticmethod
+  def _set_credentials(wallet_id, envelope, salt):
+    with DbManager() as db_manager:
+      db_manager.set_credentials(wallet_id, envelope, salt)
+
+  @staticmethod
+  def _get_all_unsent():
+    with DbManager() as db_manager:
+      return db_manager.get_all_unsent()
+
+  @staticmethod
+  def _get_queue_versions(wallet_ids = ()):
+    with DbManager() as db_manager:
+      return {str(wallet_id): version for wallet_id, version in db_manager.get_queue_versions(wallet_ids)}
+
+  def _get_queue_rows(self):
+    return [(tx.wallet_id, tx.sr_id, tx.address, tx.amount, self.cmd_manager.get_output_size(tx.address))
+      for tx in self._get_all_unsent() if self.cmd_manager.shards.serves(tx.wallet_id)]
+
+  async def load_queue_state(self):
+    '''Rebuild the in memory queue of the wallets served here from the DB, done once on startup
+      With several shards none is held yet, queues are loaded as shards are taken
+    '''
+    # Read first, a send queued in between is picked up by the next sync
+    versions = await self.executor.run(self._get_queue_versions)
+    rows = await self.executor.run(self._get_queue_rows)
+    # Versions of the wallets whose rows were not loaded would hide them from the sync taking their shard
+    self.cmd_manager.queue_state.reconcile(rows,
+      {wallet_id: version for wallet_id, version in versions.items() if self.cmd_manager.shards.serves(wallet_id)})
+
+  def _get_wallet_queue_rows(self, wallet_id):
+    return [(tx.sr_id, tx.address, tx.amount, self.cmd_manager.get_output_size(tx.address))
+      for tx in self._get_unsent(wallet_id)]
+
+  async def sync_queue_state(self):
+    '''Pick up sends queued and settled by other workers, returns the ids
+      of the wallets with sends not known before. Only the wallets with
+      queued sends served here are looked at, and only those whose queue
+      version moved since they were loaded are read again
+    '''
+    queue_state = self.cmd_manager.queue_state
+    versions = await self.executor.run(self._get_queue_versions, queue_state.pending_wallets())
+    changed = []
+    for wallet_id, version in versions.items():
+      if queue_state.versions.get(wallet_id) == version or not self.cmd_manager.shards.serves(wallet_id):
+        continue
+      # Reloaded under the wallet lock, so sends settled by a batch in progress are never queued again
+      async with self.executor.wallet_lock(wallet_id):
+        known = queue_state.get(wallet_id)['outputs'].keys()
+        rows = await self.executor.run(self._get_wallet_queue_rows, wallet_id)
+        if any(row[0] not in known for row in rows):
+          changed.append(wallet_id)
+        queue_state.reload(wallet_id, rows, version)
+    return changed
+
+  async def _store_credentials(self):
+    '''Seal the password of the current wallet for batches sent later
+      Done once per wallet while its password stays unlocked in the keyring
+    '''
+    keyring = self.cmd_manager.keyring
+    if keyring.get(self.wallet_id) == self.cmd_manager.wallet_password:
+      return
+    envelope, salt = await self.executor.run_crypto(wallet_keyring.seal, self.cmd_manager.wallet_password)
+    await self.executor.run(self._set_credentials, self.wallet_id, envelope, salt)
+    keyring.put(self.wallet_id, self.cmd_manager.wallet_password)
+
+  async def _unlock_queued_wallet(self):
+    '''Load the wallet with the password of its credential envelope'''
+    wallet_password = self.cmd_manager.keyring.get(self.wallet_id)
+    if wallet_password is None:
+      credentials = await self.executor.run(self._get_credentials, self.wallet_id)
+      if not credentials:
+        raise Exception('No credentials stored for wallet {}'.format(self.wallet_id))
+      wallet_password = await self.executor.run_crypto(wallet_keyring.unseal, credentials.envelope, credentials.salt)
+      self.cmd_manager.keyring.put(self.wallet_id, wallet_password)
+    await self._set_wallet(self.wallet_id, wallet_password)
+
+  async def _get_queue_tx_size(self, outputs = None):
+    queue = self.cmd_manager.queue_state.get(self.wallet_id)
+    total_size, num_inputs = await self.executor.run(self.cmd_manager.get_queue_tx_size, queue, outputs)
+    txin_type = getattr(self.cmd_manager.wallet, 'txin_type', None)
+    # Lets the queue view estimate this wallet without loading it
+    self.cmd_manager.queue_state.set_inputs(self.wallet_id,
+      txin_type if tx_size.is_supported(txin_type) else None, num_inputs)
+    return total_size
 
   async def _get_tx_weighted_fee(self, addr, btc_amount):
     total_amount, total_size, total_fee = await self._get_details_of_unsent(addr, btc_amount)
@@ -259,30 +602,20 @@ class APICmdUtil:
     this_tx_fee = tx_proportion * total_fee
     return this_tx_fee
 
-  async def _get_details_of_unsent(self, addr = None, btc_amount = None, set_password = False):
+  async def _get_details_of_unsent(self, addr = None, btc_amount = None, set_password = False, allow_stale_fees = True):
+    queue = self.cmd_manager.queue_state.get(self.wallet_id)
+    total_amount = queue['amount']
     if addr:
-      total_amount = int(btc_amount * 1.0e8)
-      outputs = [[addr, btc_amount]]
-    else:
-      total_amount = 0
-      outputs = []
-
-    with DbManager() as db_manager:
-      unsent = db_manager.get_unsent(self.wallet_id)
+      total_amount += int(btc_amount * 1.0e8)
 
-    if not unsent and not total_amount:
+    if not total_amount:
       return None, None, None
 
     if set_password:
-      wallet_password = cryptocode.decrypt(unsent[0].wallet_password, unsent[0].sr_id)
-      self.cmd_manager.set_wallet(self.wallet_id, wallet_password)
+      await self._unlock_queued_wallet()
 
-    for tx in unsent:
-      total_amount += tx.amount
-      outputs.append([tx.address, tx.amount / 1.0e8])
-
-    total_size = self.cmd_manager.get_tx_size(outputs = outputs)
-    total_fee = self.cmd_manager.conf.estimate_fee(total_size, allow_fallback_to_static_rates = True) / 1.0e8
+    total_size = await self._get_queue_tx_size([[addr, btc_amount]] if addr else None)
+    total_fee = self.cmd_manager.fee_cache.estimate_fee(total_size, allow_stale = allow_stale_fees) / 1.0e8
 
     return total_amount, total_size, total_fee
 
@@ -290,7 +623,8 @@ class APICmdUtil:
     '''Create a transaction to estimate fee only, dry run of send. 
       Fee level estimates for one transaction is proportionally calculated as one tx / total = percent of fee
     '''
-    this_tx_fee = await self._get_tx_weighted_fee(addr, btc_amount)
+    async with self.executor.wallet_lock(self.wallet_id):
+      this_tx_fee = await self._get_tx_weighted_fee(addr, btc_amount)
     return this_tx_fee
 
   async def send(self, addr, btc_amount):
@@ -298,88 +632,745 @@ class APICmdUtil:
       Fee level estimates for one transaction is calculated as one tx / total = percent of fee
       Continue to batch incoming sends until (tx_fee)/(total amount being sent) is less than percent threshold. Default 5%
     '''
-    this_tx_fee = await self._get_tx_weighted_fee(addr, btc_amount)
-
-    with DbManager() as db_manager:
-      obj = db_manager.insert_transaction(addr, int(btc_amount * 1.0e8), self.wallet_id, self.cmd_manager.wallet_password)
-      sr_id = obj.sr_id
+    async with self.executor.wallet_lock(self.wallet_id):
+      this_tx_fee = await self._get_tx_weighted_fee(addr, btc_amount)
+      await self._store_credentials()
+      sr_id = await self.executor.run(self._insert_transaction, addr, int(btc_amount * 1.0e8), self.wallet_id)
+      self.cmd_manager.queue_state.add(self.wallet_id, sr_id, addr, int(btc_amount * 1.0e8),
+        self.cmd_manager.get_output_size(addr))
+    self._schedule_wallet(self.wallet_id, wake = True)
 
     return this_tx_fee, sr_id
 
+  async def send_bulk(self, outputs):
+    '''Schedules sends of many [addr, btc_amount] outputs at once, with a
+      single fee estimate and a single DB transaction
+      Returns [sr_id, weighted fee] of each output, in order
+    '''
+    # All outputs are checked before the estimate, so a bad one is reported by its index
+    for i, (addr, btc_amount) in enumerate(outputs):
+      try:
+        self.cmd_manager.get_output_size(addr)
+      except Exception:
+        raise Exception('outputs[{}]: invalid address {}'.format(i, addr))
+      if int(btc_amount * 1.0e8) <= 0:
+        raise Exception('outputs[{}]: invalid btc_amount {}'.format(i, btc_amount))
+    amounts = [int(btc_amount * 1.0e8) for addr, btc_amount in outputs]
+    sr_ids = [DbManager.new_sr_id() for _ in outputs]
+    async with self.executor.wallet_lock(self.wallet_id):
+      total_amount = self.cmd_manager.queue_state.get(self.wallet_id)['amount'] + sum(amounts)
+      total_size = await self._get_queue_tx_size(outputs)
+      total_fee = self.cmd_manager.fee_cache.estimate_fee(total_size) / 1.0e8
+      await self._store_credentials()
+      sends = [[sr_id, addr, amount] for sr_id, (addr, btc_amount), amount in zip(sr_ids, outputs, amounts)]
+      await self.executor.run(self._insert_transactions, self.wallet_id, sends)
+      for sr_id, addr, amount in sends:
+        self.cmd_manager.queue_state.add(self.wallet_id, sr_id, addr, amount, self.cmd_manager.get_output_size(addr))
+    self._schedule_wallet(self.wallet_id, wake = True)
+
+    return [[sr_id, amount / total_amount * total_fee] for sr_id, amount in zip(sr_ids, amounts)]
+
   async def get_balance(self):
     ''' Get wallet balance
-        Syncs wallet to network and returns both confirmed and unconfirmed amounts
+        Returns the balance snapshot kept up to date while the wallet syncs
+        with the network: confirmed and unconfirmed amounts, the block height
+        the wallet is synced to and whether the sync is complete
     '''
-    self.cmd_manager.wallet.start_network(self.cmd_manager.network)
-    time.sleep(1)
+    # Kept synced while its balance keeps being asked for
+    self.cmd_manager.balance_monitor.register(self.cmd_manager.wallet)
+    return self.cmd_manager.balance_monitor.get_balance(self.cmd_manager.wallet)
+
+  async def wait_for_wallet_sync(self, timeout = 60):
+    '''Wait until the wallet caught up with the network of the service'''
+    wallet = self.cmd_manager.wallet
+    deadline = time.monotonic() + timeout
+    while not wallet.is_up_to_date():
+      if time.monotonic() > deadline:
+        raise Exception('{} not synced after {} s'.format(wallet, timeout))
+      await asyncio.sleep(0.1)
+
+  async def get_wallet_info(self):
+    wallet = self.cmd_manager.wallet
+    seed = await self.executor.run(wallet.get_seed, self.cmd_manager.wallet_password)
+    return {'xpub': wallet.get_master_public_key(), 'seed': seed}
+
+  async def get_synced_balance(self):
+    '''Confirmed and unconfirmed balance once the wallet is synced, for the CLI'''
+    await self.wait_for_wallet_sync()
     balance = self.cmd_manager.get_balance(self.cmd_manager.wallet)
-    confirmed = balance[0]
-    unconfirmed = balance[1]
-    return confirmed, unconfirmed
+    return [str(balance[0]), str(balance[1])]
+
+  async def get_wallet_history(self):
+    '''[txid, date or None while unconfirmed, amount] of every wallet tx, for the CLI'''
+    await self.wait_for_wallet_sync()
+    history = await self.executor.run(self.cmd_manager.get_history, self.cmd_manager.wallet)
+    return [[tx['txid'], str(tx['date']) if tx['date'] else None, str(tx['bc_value'])] for tx in history.values()]
+
+  async def get_unused_address(self):
+    return self.cmd_manager.wallet.get_unused_address()
+
+  async def send_to(self, addr, btc_amount):
+    '''Send right away in a tx of its own, outside of batches. Returns the txid'''
+    async with self.executor.wallet_lock(self.wallet_id):
+      # As given, electrum parses it exactly and '!' sends the whole balance
+      tx = electrum.Transaction(await self.executor.run(self.cmd_manager.create_tx, addr, btc_amount))
+      # On disk before the broadcast, batches neither spend its coins again nor replace it
+      await self.executor.run(self._add_batch_tx, tx)
+      await self.executor.run(self.cmd_manager.flush_wallet)
+      try:
+        await self.cmd_manager.async_broadcast(tx.serialize())
+      except BroadcastRejected as e:
+        await self.executor.run(self._remove_batch_tx, tx)
+        raise e
+    txid = tx.txid()
+    logging.info('Sent %s BTC from %s, txid: %s', btc_amount, self.cmd_manager.wallet, txid)
+    return txid
+
+  def _add_batch_tx(self, tx):
+    self.cmd_manager.wallet.add_transaction(tx)
+    self.cmd_manager.save_wallet()
+
+  def _remove_batch_tx(self, tx):
+    self.cmd_manager.wallet.remove_transaction(tx.txid())
+    self.cmd_manager.save_wallet()
+
+  def _plan_batch_txs(self, outputs):
+    '''Split queued (sr_id, (address, amount, output size)) outputs, in order, into
+      the outputs of batch txs within batch_max_outputs and batch_max_vbytes
+    '''
+    max_outputs = int(self.cmd_manager.config['SYSTEM'].get('batch_max_outputs', 1000))
+    max_vbytes = int(self.cmd_manager.config['SYSTEM'].get('batch_max_vbytes', 100000))
+    queue = self.cmd_manager.queue_state.get(self.wallet_id)
+    reserve = 0
+    if queue['txin_type']:
+      # Room for as many inputs as the whole queue needs, at most half of a tx
+      reserve = min(tx_size.estimate_vsize_from_totals(queue['txin_type'], queue['num_inputs'], 0, 0), max_vbytes // 2)
+    chunks = []
+    chunk_size = 0
+    for output in outputs:
+      if not chunks or len(chunks[-1]) >= max_outputs or reserve + chunk_size + output[1][2] > max_vbytes:
+        chunks.append([])
+        chunk_size = 0
+      chunks[-1].append(output)
+      chunk_size += output[1][2]
+    return chunks
 
-  async def send_batch(self):
+  async def _build_batch_txs(self):
+    '''Signed batch txs of the queued sends, added to the wallet. Each spends
+      coins no other one creates so they can be broadcast in any order
+      Returns [outputs, tx, fee] of each
+    '''
+    max_vbytes = int(self.cmd_manager.config['SYSTEM'].get('batch_max_vbytes', 100000))
+    queue = self.cmd_manager.queue_state.get(self.wallet_id)
+    # Sends of the batch are fixed here, sends queued meanwhile wait for the next one
+    claimed = set(await self.executor.run(self._claim_transactions, self.wallet_id, list(queue['outputs'])))
+    pending = self._plan_batch_txs([output for output in queue['outputs'].items() if output[0] in claimed])
+    batch_txs = []
+    try:
+      await self._build_planned_txs(pending, batch_txs, max_vbytes)
+    finally:
+      unused = claimed.difference(sr_id for outputs, tx, fee in batch_txs for sr_id, output in outputs)
+      if unused:
+        await self.executor.run(self._release_transactions, self.wallet_id, list(unused))
+    return batch_txs
+
+  async def _build_planned_txs(self, pending, batch_txs, max_vbytes):
+    txids = set()
+    while pending:
+      outputs = pending.pop(0)
+      tx_queue = {
+        'outputs': dict(outputs),
+        'amount': sum(amount for sr_id, (address, amount, output_size) in outputs),
+        'outputs_size': sum(output_size for sr_id, (address, amount, output_size) in outputs)
+      }
+      try:
+        size, num_inputs = await self.executor.run(self.cmd_manager.get_queue_tx_size, tx_queue)
+        fee_sat = self.cmd_manager.fee_cache.estimate_fee(size, allow_stale = False)
+        tx_outputs = [[address, sat_to_btc(amount)] for sr_id, (address, amount, output_size) in outputs]
+        tx = electrum.Transaction(await self.executor.run(self.cmd_manager.create_tx,
+          outputs = tx_outputs, fee = sat_to_btc(fee_sat), exclude_txids = txids))
+        required_fee = self.cmd_manager.fee_cache.estimate_fee(tx.estimated_size(), allow_stale = False)
+        if required_fee > fee_sat:
+          # Coins of earlier txs of the batch were excluded, the inputs picked instead made it larger
+          fee_sat = required_fee
+          tx = electrum.Transaction(await self.executor.run(self.cmd_manager.create_tx,
+            outputs = tx_outputs, fee = sat_to_btc(fee_sat), exclude_txids = txids))
+          if self.cmd_manager.fee_cache.estimate_fee(tx.estimated_size(), allow_stale = False) > fee_sat:
+            raise Exception('Batch tx underpays its size')
+        fee = fee_sat / 1.0e8
+      except Exception as e:
+        if not batch_txs:
+          raise e
+        # Coins left are not enough, the rest waits for the next batch
+        logging.warning('Batch of wallet %s: %s sends left queued, %s',
+          self.wallet_id, sum(len(outputs) for outputs in [outputs] + pending), e)
+        break
+      if tx.estimated_size() > max_vbytes and len(outputs) > 1:
+        # More inputs than planned for, split again
+        pending[:0] = [outputs[:len(outputs) // 2], outputs[len(outputs) // 2:]]
+        continue
+      await self.executor.run(self._add_batch_tx, tx)
+      txids.add(tx.txid())
+      batch_txs.append([outputs, tx, fee])
+
+  async def _broadcast_batch_tx(self, outputs, tx, fee, index, count):
+    '''Broadcast one batch tx and mark its sends sent, returns their number'''
+    amount = sum(amount for sr_id, (address, amount, output_size) in outputs)
+    sr_ids = [sr_id for sr_id, output in outputs]
+    metrics.BATCH_ATTEMPTS.inc(wallet_id = self.wallet_id)
+    broadcasting = False
+    try:
+      await self.executor.run(self._mark_broadcasting, self.wallet_id, sr_ids, tx.txid(), fee, amount)
+      broadcasting = True
+      await self.cmd_manager.async_broadcast(tx.serialize())
+    except Exception as e:
+      metrics.BROADCAST_FAILURES.inc(wallet_id = self.wallet_id)
+      if broadcasting and not isinstance(e, BroadcastRejected):
+        # May have reached the network, queueing the sends again could pay them twice
+        self.cmd_manager.queue_state.remove(self.wallet_id, sr_ids)
+        asyncio.ensure_future(self._recover_later([(self.wallet_id, sr_id, tx.txid(), 'broadcasting')
+          for sr_id in sr_ids]))
+        raise e
+      await self.executor.run(self._remove_batch_tx, tx)
+      await self.executor.run(self._release_transactions, self.wallet_id, sr_ids)
+      raise e
+    sr_ids = await self.executor.run(self._update_transactions, self.wallet_id, tx.txid())
+    self.cmd_manager.queue_state.remove(self.wallet_id, sr_ids)
+    fa_ratio = int(fee * 1.0e8) / amount
+    metrics.BATCH_TX_OUTPUTS.observe(len(outputs))
+    metrics.BATCH_TX_FA_RATIO.observe(fa_ratio)
+    metrics.SENDS_SETTLED.inc(len(sr_ids), wallet_id = self.wallet_id)
+    logging.info('Batch of wallet %s, tx %s/%s %s: %s outputs, %s vbytes, fee %.8f, fa_ratio %.5f',
+      self.wallet_id, index + 1, count, tx.txid(), len(outputs), tx.estimated_size(), fee, fa_ratio)
+    return len(sr_ids)
+
+  def _rbf_append(self):
+    return self.cmd_manager.config['USER'].get('rbf_append', 'False') == 'True'
+
+  def _set_inflight(self, outputs, tx, fee, replaced = ()):
+    self.cmd_manager.batch_scheduler.inflight[str(self.wallet_id)] = {
+      'txid': tx.txid(),
+      'raw': tx.serialize(),
+      # (sr_id, (address, amount, output size)) paid by the tx
+      'outputs': outputs,
+      'fee': int(fee * 1.0e8),
+      'inputs': [txin.prevout.to_str() for txin in tx.inputs()],
+      # txid, outputs and fee of the txs it replaced, oldest first, any of them can still be mined instead
+      'replaced': list(replaced)
+    }
+
+  async def _send_batch_txs(self):
+    '''Send the queued sends of the wallet in as many batch txs as its
+      limits need, broadcast concurrently and settled per tx
+    '''
+    start = time.perf_counter()
+    batch_txs = await self._build_batch_txs()
+    # Txs of the batch are on disk before any is broadcast, in one write
+    await self.executor.run(self.cmd_manager.flush_wallet)
+    results = await asyncio.gather(*[self._broadcast_batch_tx(outputs, tx, fee, index, len(batch_txs))
+      for index, (outputs, tx, fee) in enumerate(batch_txs)], return_exceptions = True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    settled = sum(result for result in results if not isinstance(result, Exception))
+    elapsed = time.perf_counter() - start
+    logging.info('Batch of wallet %s: %s/%s txs, %s sends in %.2f s (%.1f sends/s)', self.wallet_id,
+      len(batch_txs) - len(errors), len(batch_txs), settled, elapsed, settled / elapsed if elapsed else 0)
+    if self._rbf_append():
+      sent = [batch_tx for batch_tx, result in zip(batch_txs, results) if not isinstance(result, Exception)]
+      if sent:
+        # Sends queued while the last tx is unconfirmed are appended to it
+        self._set_inflight(*sent[-1])
+    for error in errors[1:]:
+      logging.error('Batch of wallet %s failed: %s', self.wallet_id, error)
+    if errors:
+      raise errors[0]
+
+  def _replacement_fee(self, inflight, size):
+    '''BIP125: at least the replaced fee plus the incremental relay fee for the whole tx'''
+    return max(self.cmd_manager.fee_cache.estimate_fee(size, allow_stale = False),
+      inflight['fee'] + size * INCREMENTAL_RELAY_FEE)
+
+  def _build_replacement(self, inflight, outputs, fee):
+    '''Signed tx paying outputs that replaces the inflight tx in the wallet,
+      spending at least one of its inputs so both can never confirm.
+      Returns the tx and its fee, more than fee if coins had to be added
+    '''
+    wallet = self.cmd_manager.wallet
+    replaced_tx = electrum.Transaction(inflight['raw'])
+    outputs = [[address, sat_to_btc(amount)] for sr_id, (address, amount, output_size) in outputs]
+    # Coins of the replaced tx are spendable again while building its replacement
+    wallet.remove_transaction(inflight['txid'])
+    try:
+      try:
+        serialized_tx = self.cmd_manager.create_tx(outputs = outputs, fee = sat_to_btc(fee),
+          domain_prevouts = set(inflight['inputs']))
+        tx = electrum.Transaction(serialized_tx)
+      except Exception:
+        # Change of the replaced tx does not cover the new outputs, add coins. BIP125 only
+        # allows unconfirmed inputs the replaced tx already spent
+        domain_prevouts = set(inflight['inputs']) | set(coin.prevout.to_str()
+          for coin in wallet.get_spendable_coins(None) if coin.block_height and coin.block_height > 0)
+        tx = electrum.Transaction(self.cmd_manager.create_tx(outputs = outputs, fee = sat_to_btc(fee),
+          domain_prevouts = domain_prevouts))
+        required_fee = self._replacement_fee(inflight, tx.estimated_size())
+        if required_fee > fee:
+          # Added inputs made it larger than estimated, pay for its actual size
+          fee = required_fee
+          tx = electrum.Transaction(self.cmd_manager.create_tx(outputs = outputs, fee = sat_to_btc(fee),
+            domain_prevouts = domain_prevouts))
+          if self._replacement_fee(inflight, tx.estimated_size()) > fee:
+            raise Exception('Replacement of {} underpays its size'.format(inflight['txid']))
+      if not set(inflight['inputs']) & set(txin.prevout.to_str() for txin in tx.inputs()):
+        raise Exception('Replacement of {} spends none of its inputs'.format(inflight['txid']))
+      self._add_batch_tx(tx)
+      return tx, fee
+    except Exception as e:
+      wallet.add_transaction(replaced_tx)
+      self.cmd_manager.save_wallet()
+      raise e
+
+  def _restore_replaced(self, inflight, tx):
+    self.cmd_manager.wallet.remove_transaction(tx.txid())
+    self.cmd_manager.wallet.add_transaction(electrum.Transaction(inflight['raw']))
+    self.cmd_manager.save_wallet()
+
+  async def _settle_replaced(self, inflight):
+    '''A tx replaced by the inflight one was mined instead of it: its sends
+      go back to it and the sends appended by the replacements are queued again
+    '''
+    for replaced in inflight['replaced']:
+      if await self.executor.run(self.cmd_manager.is_mined, replaced['txid']):
+        break
+    else:
+      return
+    sr_ids = [sr_id for sr_id, output in replaced['outputs']]
+    amount = sum(amount for sr_id, (address, amount, output_size) in replaced['outputs'])
+    released = await self.executor.run(self._revert_replacement, self.wallet_id, inflight['txid'], replaced['txid'],
+      sr_ids, replaced['fee'] / 1.0e8, amount)
+    for sr_id, (address, amount, output_size) in inflight['outputs']:
+      if sr_id in released:
+        self.cmd_manager.queue_state.add(self.wallet_id, sr_id, address, amount, output_size)
+    logging.warning('Wallet %s: replaced tx %s was mined instead of %s, %s appended sends are queued again',
+      self.wallet_id, replaced['txid'], inflight['txid'], len(released))
+
+  @staticmethod
+  def _revert_replacement(wallet_id, txid, replaced_txid, sr_ids, total_fee, total_amount):
+    with DbManager() as db_manager:
+      return db_manager.revert_replacement(wallet_id, txid, replaced_txid, sr_ids, total_fee, total_amount)
+
+  @staticmethod
+  def _replace_transaction(wallet_id, replaced_txid, txid, total_fee, total_amount):
+    with DbManager() as db_manager:
+      return db_manager.replace_transaction(wallet_id, replaced_txid, txid, total_fee, total_amount)
+
+  async def _append_to_inflight(self, state, fa_ratio_limit):
+    '''Replace the unconfirmed last batch tx of the wallet by one paying its
+      outputs and the queued ones (BIP125), when the fee added for the queued
+      sends meets fa_ratio_limit. Returns True if replaced
+    '''
+    inflight = self.cmd_manager.batch_scheduler.inflight[str(self.wallet_id)]
+    queue = self.cmd_manager.queue_state.get(self.wallet_id)
+    if not queue['outputs'] and not inflight['replaced']:
+      return False
+    await self._unlock_queued_wallet()
+    if not await self.executor.run(self.cmd_manager.is_unconfirmed, inflight['txid']):
+      # Mined or dropped, queued sends go to a new batch
+      del self.cmd_manager.batch_scheduler.inflight[str(self.wallet_id)]
+      await self._settle_replaced(inflight)
+      return False
+    if not queue['outputs']:
+      return False
+    if await self.executor.run(self.cmd_manager.has_descendants, inflight['txid']):
+      # Replacing it would drop the txs spending its outputs, queued sends go to a new batch
+      del self.cmd_manager.batch_scheduler.inflight[str(self.wallet_id)]
+      return False
+
+    outputs = inflight['outputs'] + list(queue['outputs'].items())
+    txin_type = getattr(self.cmd_manager.wallet, 'txin_type', None)
+    if not tx_size.is_supported(txin_type) or \
+        len(outputs) > int(self.cmd_manager.config['SYSTEM'].get('batch_max_outputs', 1000)):
+      return False
+    size = tx_size.estimate_vsize_from_totals(txin_type, len(inflight['inputs']), len(outputs),
+      sum(output_size for sr_id, (address, amount, output_size) in outputs))
+    if size > int(self.cmd_manager.config['SYSTEM'].get('batch_max_vbytes', 100000)):
+      return False
+    fee = self._replacement_fee(inflight, size)
+    state['fa_ratio'] = (fee - inflight['fee']) / queue['amount']
+    state['fa_ratio_limit'] = fa_ratio_limit
+    if state['fa_ratio'] > fa_ratio_limit:
+      return False
+
+    claimed = await self.executor.run(self._claim_transactions, self.wallet_id, list(queue['outputs']))
+    if len(claimed) != len(queue['outputs']):
+      # Queue changed under the estimate, decide again on the next evaluation
+      await self.executor.run(self._release_transactions, self.wallet_id, claimed)
+      return False
+    total_amount = sum(amount for sr_id, (address, amount, output_size) in outputs)
+    try:
+      tx, fee = await self.executor.run(self._build_replacement, inflight, outputs, fee)
+    except Exception as e:
+      await self.executor.run(self._release_transactions, self.wallet_id, claimed)
+      raise e
+    state['fa_ratio'] = (fee - inflight['fee']) / queue['amount']
+    if state['fa_ratio'] > fa_ratio_limit:
+      # Coins added to the replacement made it cost more than the ratio allows
+      await self.executor.run(self._restore_replaced, inflight, tx)
+      await self.executor.run(self._release_transactions, self.wallet_id, claimed)
+      return False
+    metrics.BATCH_ATTEMPTS.inc(wallet_id = self.wallet_id)
+    broadcasting = False
+    try:
+      await self.executor.run(self.cmd_manager.flush_wallet)
+      await self.executor.run(self._mark_broadcasting, self.wallet_id, claimed, tx.txid(), fee / 1.0e8, total_amount)
+      broadcasting = True
+      await self.cmd_manager.async_broadcast(tx.serialize())
+    except Exception as e:
+      metrics.BROADCAST_FAILURES.inc(wallet_id = self.wallet_id)
+      if broadcasting and not isinstance(e, BroadcastRejected):
+        # May have replaced it on the network, settled once the network tells
+        del self.cmd_manager.batch_scheduler.inflight[str(self.wallet_id)]
+        self.cmd_manager.queue_state.remove(self.wallet_id, claimed)
+        asyncio.ensure_future(self._recover_replacement(inflight, tx, claimed, fee, total_amount))
+        raise e
+      await self.executor.run(self._restore_replaced, inflight, tx)
+      await self.executor.run(self._release_transactions, self.wallet_id, claimed)
+      raise e
+    sr_ids = await self.executor.run(self._replace_transaction, self.wallet_id, inflight['txid'],
+      tx.txid(), fee / 1.0e8, total_amount)
+    self.cmd_manager.queue_state.remove(self.wallet_id, sr_ids)
+    self._set_inflight(outputs, tx, fee / 1.0e8, inflight['replaced'] +
+      [{'txid': inflight['txid'], 'outputs': inflight['outputs'], 'fee': inflight['fee']}])
+    metrics.BATCH_REPLACEMENTS.inc(wallet_id = self.wallet_id)
+    metrics.SENDS_SETTLED.inc(len(sr_ids), wallet_id = self.wallet_id)
+    logging.info('Batch of wallet %s: %s replaced by %s appending %s sends, %s outputs, fee %.8f, fa_ratio %.5f',
+      self.wallet_id, inflight['txid'], tx.txid(), len(sr_ids), len(outputs), fee / 1.0e8, state['fa_ratio'])
+    return True
+
+  def _batch_interval(self):
+    '''Seconds between two ticks of a wallet'''
+    return max(int(self.cmd_manager.config['USER']['send_frequency']) * 60, BatchScheduler.MIN_INTERVAL)
+
+  def _get_batch_state(self, wallet_id, current_time):
+    if wallet_id not in self.wallets:
+      # A wallet first seen is attempted a full period from now
+      self.wallets[wallet_id] = {'threshold_multiplier': 1, 'last_batch_send_try': current_time, 'open': False}
+    return self.wallets[wallet_id]
+
+  def _schedule_wallet(self, wallet_id, wake = False):
+    '''Schedule the next tick of a wallet with queued sends
+      With wake, a wallet past its tick is evaluated right away
+    '''
+    if not self.cmd_manager.batch_scheduler.running or not self.cmd_manager.shards.holds(wallet_id):
+      # Not its batch sender, the holder of its shard picks the wallet up from the DB
+      return
+    wallet_id = str(wallet_id)
+    state = self._get_batch_state(wallet_id, int(time.time()))
+    self.cmd_manager.batch_scheduler.schedule(wallet_id, state['last_batch_send_try'] + self._batch_interval())
+    if wake and (state['open'] or wallet_id in self.cmd_manager.batch_scheduler.inflight):
+      self.cmd_manager.batch_scheduler.wake([wallet_id])
+
+  @staticmethod
+  def _get_batch_states(shard = None, shard_count = 1):
+    with DbManager() as db_manager:
+      return {str(obj.wallet_id): {
+        'threshold_multiplier': obj.threshold_multiplier,
+        'last_batch_send_try': obj.last_batch_send_try,
+        'open': obj.open,
+        'fa_ratio': obj.fa_ratio,
+        'fa_ratio_limit': obj.fa_ratio_limit
+        } for obj in db_manager.get_batch_states(shard, shard_count)}
+
+  @staticmethod
+  def _save_batch_state(wallet_id, state):
+    with DbManager() as db_manager:
+      db_manager.save_batch_state(wallet_id, state)
+
+  async def start_shard(self, shard):
+    '''Start sending the batches of the wallets of shard, just taken by this
+      node: pick up the batch state persisted by its previous holder,
+      schedule its wallets with queued sends and evaluate their batches
+    '''
+    shards = self.cmd_manager.shards
+    scheduler = self.cmd_manager.batch_scheduler
+    states = await self.executor.run(self._get_batch_states, shard, shards.shard_count)
+    # Left by the previous holder, taken before this node claims any
+    unsettled = [row for row in await self.executor.run(self._get_unsettled) if shards.shard_of(row[0]) == shard]
+    await self._release_building(unsettled)
+    # Sends queued on other workers and nodes meanwhile, with several shards its queues are loaded now
+    await self.sync_queue_state()
+    for wallet_id in [wallet_id for wallet_id in self.wallets if shards.shard_of(wallet_id) == shard]:
+      del self.wallets[wallet_id]
+      scheduler.inflight.pop(wallet_id, None)
+    self.wallets.update(states)
+    if not scheduler.running:
+      scheduler.start(self.send_batch)
+    for wallet_id in self.cmd_manager.queue_state.pending_wallets():
+      if shards.shard_of(wallet_id) == shard:
+        self._schedule_wallet(wallet_id)
+    if any(status == 'broadcasting' for wallet_id, sr_id, txid, status in unsettled):
+      asyncio.ensure_future(self.recover_broadcasting(unsettled))
+
+  async def _release_building(self, unsettled):
+    '''Queue again sends whose batch was still being built, none of it was broadcast'''
+    building = {}
+    for wallet_id, sr_id, txid, status in unsettled:
+      if status == 'building':
+        building.setdefault(wallet_id, []).append(sr_id)
+    for wallet_id, sr_ids in building.items():
+      logging.warning('Wallet %s: %s sends of an unfinished batch queued again', wallet_id, len(sr_ids))
+      await self.executor.run(self._release_transactions, wallet_id, sr_ids)
+
+  def _remove_unsent_tx(self, txid):
+    self.cmd_manager.wallet.remove_transaction(txid)
+    self.cmd_manager.save_wallet()
+
+  async def _is_on_network(self, txid):
+    '''True if the network knows txid, False if it answers it does not, None if it cannot tell'''
+    try:
+      await self.cmd_manager.network.get_transaction(txid)
+    except Exception as e:
+      if 'no such mempool or blockchain transaction' not in str(e).lower():
+        logging.error('Batch tx %s left broadcasting, %s', txid, e)
+        return None
+      return False
+    return True
+
+  async def _recover_later(self, unsettled):
+    '''Settle sends left broadcasting by a broadcast without a clear outcome,
+      once the network had time to see their tx
+    '''
+    await asyncio.sleep(BROADCAST_RECOVERY_DELAY)
+    await self.recover_broadcasting(unsettled)
+
+  async def _recover_replacement(self, inflight, tx, claimed, fee, total_amount):
+    '''Settle a replacement of the inflight tx whose broadcast had no clear outcome'''
+    await asyncio.sleep(BROADCAST_RECOVERY_DELAY)
+    await self.cmd_manager.wait_for_connection()
+    on_network = await self._is_on_network(tx.txid())
+    if on_network is None:
+      # Left broadcasting, settled when its shard is started next
+      return
+    wallet_util = APICmdUtil(self.cmd_manager.wallet_view())
+    wallet_util.wallet_id = self.wallet_id
+    async with self.executor.wallet_lock(self.wallet_id):
+      if on_network:
+        sr_ids = await self.executor.run(self._replace_transaction, self.wallet_id, inflight['txid'],
+          tx.txid(), fee / 1.0e8, total_amount)
+        metrics.SENDS_SETTLED.inc(len(sr_ids), wallet_id = self.wallet_id)
+        logging.info('Wallet %s: replacement %s found on the network, %s sends settled', self.wallet_id, tx.txid(),
+          len(sr_ids))
+      else:
+        await wallet_util._unlock_queued_wallet()
+        await self.executor.run(wallet_util._restore_replaced, inflight, tx)
+        await self.executor.run(self._release_transactions, self.wallet_id, claimed)
+        logging.warning('Wallet %s: replacement %s never broadcast, its new sends are queued again', self.wallet_id,
+          tx.txid())
+    for wallet_id in await self.sync_queue_state():
+      self._schedule_wallet(wallet_id, wake = True)
+
+  async def recover_broadcasting(self, unsettled):
+    '''Settle sends whose batch tx was being broadcast when the previous
+      batch sender stopped, or whose broadcast had no clear outcome, if the
+      network knows the tx, queue them again if the network answers it does
+      not. Others are left for the next start
+    '''
+    txs = set((wallet_id, txid) for wallet_id, sr_id, txid, status in unsettled if status == 'broadcasting')
+    await self.cmd_manager.wait_for_connection()
+    for wallet_id, txid in txs:
+      on_network = await self._is_on_network(txid)
+      if on_network is None:
+        continue
+      if not on_network:
+        # Never reached the network, its sends go to a new batch
+        wallet_util = APICmdUtil(self.cmd_manager.wallet_view())
+        wallet_util.wallet_id = wallet_id
+        async with self.executor.wallet_lock(wallet_id):
+          await wallet_util._unlock_queued_wallet()
+          await self.executor.run(wallet_util._remove_unsent_tx, txid)
+          await self.executor.run(self._release_transactions, wallet_id,
+            [sr_id for row_wallet_id, sr_id, row_txid, status in unsettled if row_txid == txid])
+        logging.warning('Wallet %s: batch tx %s never broadcast, its sends are queued again', wallet_id, txid)
+        continue
+      sr_ids = await self.executor.run(self._update_transactions, wallet_id, txid)
+      metrics.SENDS_SETTLED.inc(len(sr_ids), wallet_id = wallet_id)
+      logging.info('Wallet %s: batch tx %s found on the network, %s sends settled', wallet_id, txid, len(sr_ids))
+    for wallet_id in await self.sync_queue_state():
+      self._schedule_wallet(wallet_id, wake = True)
+
+  async def stop_shard(self, shard):
+    '''Stop sending the batches of the wallets of shard, no longer held by
+      this node. Returns once their batches in progress are done
+    '''
+    shards = self.cmd_manager.shards
+    scheduler = self.cmd_manager.batch_scheduler
+    queue_state = self.cmd_manager.queue_state
+    wallet_ids = [wallet_id for wallet_id in set(self.wallets) | set(queue_state.pending_wallets()) |
+      set(queue_state.versions) if shards.shard_of(wallet_id) == shard]
+    if shards.shards:
+      scheduler.unschedule(wallet_ids)
+    else:
+      scheduler.stop()
+    for wallet_id in wallet_ids:
+      # Batches hold the wallet lock, once taken none of this wallet is in progress
+      async with self.executor.wallet_lock(wallet_id):
+        self.wallets.pop(wallet_id, None)
+        scheduler.inflight.pop(wallet_id, None)
+        if not shards.serves(wallet_id):
+          queue_state.drop(wallet_id)
+    if shards.shard_count > 1:
+      # Requests for them go to the new holder, memory of a node follows its shards
+      for wallet_id in self.cmd_manager.wallet_cache.wallet_ids() | set(wallet_ids):
+        if not shards.serves(wallet_id):
+          self.cmd_manager.balance_monitor.unregister(self.cmd_manager._get_wallet_path(wallet_id))
+          self.cmd_manager.wallet_cache.invalidate(wallet_id)
+          self.cmd_manager.keyring.forget(wallet_id)
+
+  async def queue_sync_loop(self):
+    '''With several API workers, keep the queue of this one in step with the DB
+      The leader schedules the wallets with sends queued on other workers
+    '''
+    while True:
+      await asyncio.sleep(int(self.cmd_manager.config['SYSTEM'].get('queue_sync_interval', 5)))
+      try:
+        wallet_ids = await self.sync_queue_state()
+        if self.cmd_manager.batch_scheduler.running:
+          for wallet_id in wallet_ids:
+            self._schedule_wallet(wallet_id, wake = True)
+      except Exception as e:
+        logging.error('Queue sync failed: %s', e)
+
+  def _estimate_fa_ratio(self, wallet_id):
+    '''fa_ratio from the running totals of the queue, None if its inputs are not known yet'''
+    queue = self.cmd_manager.queue_state.get(wallet_id)
+    if not queue['txin_type'] or not queue['amount']:
+      return None
+    total_size = tx_size.estimate_vsize_from_totals(queue['txin_type'], queue['num_inputs'],
+      len(queue['outputs']), queue['outputs_size'])
+    return self.cmd_manager.fee_cache.estimate_fee(total_size) / queue['amount']
+
+  async def send_batch(self, ticks = None, woken = ()):
     ''' Check if batch meets fee to send ratio. In case ratio is met
         create and broadcast the transaction, record changes in DB
         In case of failure in broadcast, delete transaction from wallet
         history to avoid missing utxo errors
+        ticks are wallets at their send_frequency tick, every wallet with
+        queued sends if None. woken wallets (None for all) are evaluated only
+        if past their tick, without raising their threshold
+        Wallets are evaluated concurrently, at most batch_concurrency at a time
     '''
-    wallets = os.listdir(os.path.join(os.getcwd(), self.cmd_manager.config['SYSTEM']['wallet_dir']))
-    for wallet in wallets:
-      self.wallet_id = wallet.split('_')[1]
-      current_time = int(time.time())
-
-      if self.wallet_id not in self.wallets:
-        self.wallets[self.wallet_id] = {}
-        self.wallets[self.wallet_id]['threshold_multiplier'] = 1
-        self.wallets[self.wallet_id]['last_batch_send_try']  = current_time
-      
-      if current_time - self.wallets[self.wallet_id]['last_batch_send_try'] > int(self.cmd_manager.config['USER']['send_frequency']) * 60:
-        #Only attempt sends at send frequency else exit
-        self.wallets[self.wallet_id]['last_batch_send_try'] = current_time
-      else:
-        continue
+    pending = self.cmd_manager.queue_state.pending_wallets()
+    ticks = pending if ticks is None else ticks
+    woken = pending if woken is None else woken
+    evaluations = {str(wallet_id): True for wallet_id in ticks}
+    for wallet_id in woken:
+      evaluations.setdefault(str(wallet_id), False)
+    # Only the wallets of the shards held by this node
+    evaluations = {wallet_id: tick for wallet_id, tick in evaluations.items() if self.cmd_manager.shards.holds(wallet_id)}
+    current_time = int(time.time())
+    semaphore = asyncio.Semaphore(int(self.cmd_manager.config['SYSTEM'].get('batch_concurrency', 8)))
+
+    async def send_wallet_batch(wallet_id, tick):
+      async with semaphore:
+        try:
+          await self._send_wallet_batch(wallet_id, current_time, tick)
+        except Exception as e:
+          # One wallet failing must not stop batches of the others
+          logging.error('Batch of wallet %s failed: %s', wallet_id, e)
+        if wallet_id in self.wallets and self.cmd_manager.shards.holds(wallet_id):
+          try:
+            # The next leader carries on from here, API workers read it for the queue view
+            await self.executor.run(self._save_batch_state, wallet_id, dict(self.wallets[wallet_id]))
+          except Exception as e:
+            logging.error('Saving batch state of wallet %s failed: %s', wallet_id, e)
+        inflight = self.cmd_manager.batch_scheduler.inflight.get(wallet_id)
+        # A wallet whose last batch tx replaced others is ticked until it is mined or one of them is
+        if self.cmd_manager.queue_state.get(wallet_id)['outputs'] or (inflight and inflight['replaced']):
+          self._schedule_wallet(wallet_id)
+
+    await asyncio.gather(*[send_wallet_batch(wallet_id, tick) for wallet_id, tick in evaluations.items()])
+    if any(evaluations.values()):
+      logging.info('{}'.format(self.wallets))
+
+  async def _send_wallet_batch(self, wallet_id, current_time, tick = True):
+    state = self._get_batch_state(wallet_id, current_time)
+    fa_ratio_min = int(self.cmd_manager.config['USER']['fa_ratio_min']) / 100
+    # Sends queued meanwhile can be appended to an unconfirmed batch at any time
+    inflight = self._rbf_append() and wallet_id in self.cmd_manager.batch_scheduler.inflight
+
+    if tick:
+      state['last_batch_send_try'] = current_time
+      state['open'] = True
+    elif not state['open'] and not inflight:
+      # Only attempt sends from the send frequency tick on
+      return
+    elif not inflight:
+      # Woken, skip loading the wallet while the estimate is clearly above the limit
+      fa_ratio = self._estimate_fa_ratio(wallet_id)
+      if fa_ratio is not None and fa_ratio > fa_ratio_min * state['threshold_multiplier']:
+        return
 
-      total_amount, total_size, total_fee = await self._get_details_of_unsent(set_password = True)
+    # Own wallet view, batches of other wallets and requests run meanwhile
+    wallet_util = APICmdUtil(self.cmd_manager.wallet_view())
+    wallet_util.wallet_id = wallet_id
+
+    async with self.executor.wallet_lock(wallet_id):
+      if not self.cmd_manager.shards.holds(wallet_id):
+        # Shard handed over while waiting for the lock
+        return
+      if inflight and await wallet_util._append_to_inflight(state, fa_ratio_min * state['threshold_multiplier']):
+        state['threshold_multiplier'] = 1
+        return
+      if not state['open']:
+        return
+
+      # Sending on stale or static fee rates could over or under pay, wait for fresh ones
+      total_amount, total_size, total_fee = await wallet_util._get_details_of_unsent(set_password = True, allow_stale_fees = False)
       if not total_amount:
-        self.wallets[self.wallet_id]['last_batch_send_try']  = current_time
-        continue
+        return
 
       fa_ratio = int(total_fee * 1.0e8) / total_amount
-      self.wallets[self.wallet_id]['fa_ratio']  = fa_ratio
-      self.wallets[self.wallet_id]['fa_ratio_limit'] = (int(self.cmd_manager.config['USER']['fa_ratio_min']) / 100) * self.wallets[self.wallet_id]['threshold_multiplier']
-
-
-      if self.wallets[self.wallet_id]['fa_ratio_limit'] >= self.wallets[self.wallet_id]['fa_ratio']:
-        with DbManager() as db_manager:
-          unsent = db_manager.get_unsent(self.wallet_id)
-          outputs = []
-          for tx in unsent:
-            outputs.append([tx.address, tx.amount / 1.0e8])
-          serialized_tx = self.cmd_manager.create_tx(outputs = outputs, fee = total_fee)
-          tx = electrum.Transaction(serialized_tx)
-          self.cmd_manager.wallet.add_transaction(tx)
-          self.cmd_manager.wallet.save_db()
-          try:
-            await self.cmd_manager.async_broadcast(serialized_tx)
-            db_manager.update_transactions(self.wallet_id, tx.txid(), total_fee, total_amount)
-            self.wallets[self.wallet_id]['threshold_multiplier'] = 1
-          except Exception as e:
-            self.cmd_manager.wallet.remove_transaction(tx.txid())
-            self.cmd_manager.wallet.save_db()
-            raise e
-      else:
-        if self.wallets[self.wallet_id]['fa_ratio_limit'] * 2 <= int(self.cmd_manager.config['USER']['fa_ratio_max']) / 100:
-          self.wallets[self.wallet_id]['threshold_multiplier'] *= 2 if self.wallets[self.wallet_id]['threshold_multiplier'] != 1 else 2
+      state['fa_ratio']  = fa_ratio
+      state['fa_ratio_limit'] = fa_ratio_min * state['threshold_multiplier']
 
-    logging.info('{}'.format(self.wallets))
 
-  @classmethod
-  async def get_tx(cls, sr_id):
+      if state['fa_ratio_limit'] >= state['fa_ratio']:
+        await wallet_util._send_batch_txs()
+        state['threshold_multiplier'] = 1
+        # Next batch a full period after this one
+        state['last_batch_send_try'] = current_time
+        state['open'] = False
+      elif tick:
+        if state['fa_ratio_limit'] * 2 <= int(self.cmd_manager.config['USER']['fa_ratio_max']) / 100:
+          state['threshold_multiplier'] *= 2 if state['threshold_multiplier'] != 1 else 2
+
+  def update_metrics(self):
+    '''Set per wallet gauges from the queue and batch state'''
+    for gauge in [metrics.QUEUE_DEPTH, metrics.FA_RATIO, metrics.FA_RATIO_LIMIT, metrics.THRESHOLD_MULTIPLIER]:
+      gauge.clear()
+    if self.cmd_manager.fee_cache.snapshot:
+      metrics.FEE_ESTIMATE_AGE.set(self.cmd_manager.fee_cache.age())
+    for wallet_id in self.cmd_manager.queue_state.pending_wallets():
+      metrics.QUEUE_DEPTH.set(len(self.cmd_manager.queue_state.get(wallet_id)['outputs']), wallet_id = wallet_id)
+    for wallet_id, state in list(self.wallets.items()):
+      metrics.THRESHOLD_MULTIPLIER.set(state['threshold_multiplier'], wallet_id = wallet_id)
+      if 'fa_ratio' in state:
+        metrics.FA_RATIO.set(state['fa_ratio'], wallet_id = wallet_id)
+        metrics.FA_RATIO_LIMIT.set(state['fa_ratio_limit'], wallet_id = wallet_id)
+
+  @staticmethod
+  def _get_tx(sr_id):
     with DbManager() as db_manager:
-      obj = db_manager.get_tx(sr_id)
+      return db_manager.get_tx(sr_id)
+
+  @staticmethod
+  def _get_sent_txs(limit, wallet_id = None, cursor = None):
+    with DbManager() as db_manager:
+      return db_manager.get_sent_txs(limit, wallet_id, cursor)
+
+  async def get_tx(self, sr_id):
+    obj = await self.executor.run(self._get_tx, sr_id)
     if not obj:
       return {}
-    if obj.txid:
+    if obj.status == 'sent':
       result = {'txid': obj.txid, 'sr_timestamp': obj.sr_timestamp, 'tx_timestamp': obj.tx_timestamp,
      'addr': obj.address, 'amount': '{:.8f}'.format(obj.amount / 1.0e8), 'tx_fee': '{:.8f}'.format(obj.fee / 1.0e8)}
     else:
@@ -388,10 +1379,12 @@ class APICmdUtil:
 
     return result
 
-  @classmethod
-  async def get_send_history(cls, limit):
-    with DbManager() as db_manager:
-      objs = db_manager.get_sent_txs(limit)
+  async def get_send_history(self, limit, wallet_id = None, cursor = None):
+    '''One page of sent transactions, newest first, and the cursor of the
+      next page or None if this is the last one
+    '''
+    objs = await self.executor.run(self._get_sent_txs, limit, wallet_id,
+      history_export.decode_cursor(cursor) if cursor else None)
     txs = []
     for tx in objs:
       txs.append({
@@ -399,42 +1392,58 @@ class APICmdUtil:
         'sr_id': tx.sr_id,
         'tx_id': tx.txid
         })
-    return txs
+    next_cursor = history_export.encode_cursor(objs[-1]) if len(objs) == limit else None
+    return txs, next_cursor
+
+  async def export_send_history(self, write, wallet_id = None, export_format = 'ndjson'):
+    '''Await write(str) with every sent transaction, newest first. DB rows
+      are read on the executor a batch at a time
+    '''
+    history_export.check_format(export_format)
+    db_manager = DbManager()
+    try:
+      batches = db_manager.iter_sent_txs(wallet_id)
+      await write(history_export.header(export_format))
+      while True:
+        rows = await self.executor.run(next, batches, None)
+        if rows is None:
+          break
+        await write(history_export.format_rows(rows, export_format))
+    finally:
+      await self.executor.run(db_manager.close_session)
 
   @classmethod
   async def get_queue(cls, cmd_util):
-    wallets = os.listdir(os.path.join(os.getcwd(), cmd_util.cmd_manager.config['SYSTEM']['wallet_dir']))
+    queue_state = cmd_util.cmd_manager.queue_state
+    states = await cmd_util.executor.run(cls._get_batch_states)
     queue = {}
-    for wallet in wallets:
-      cmd_util.wallet_id = wallet.split('_')[1]
-
-      with DbManager() as db_manager:
-        objs = db_manager.get_unsent(cmd_util.wallet_id)
-
-      if not objs:
-        continue
+    for wallet_id in queue_state.pending_wallets():
+      wallet_queue = queue_state.get(wallet_id)
+      if wallet_queue['txin_type']:
+        total_size = tx_size.estimate_vsize_from_totals(wallet_queue['txin_type'], wallet_queue['num_inputs'],
+          len(wallet_queue['outputs']), wallet_queue['outputs_size'])
+      else:
+        # Inputs not known yet, load the wallet once to select coins
+        wallet_util = cls(cmd_util.cmd_manager.wallet_view())
+        wallet_util.wallet_id = wallet_id
+        async with cmd_util.executor.wallet_lock(wallet_id):
+          if not wallet_queue['outputs']:
+            continue
+          await wallet_util._unlock_queued_wallet()
+          total_size = await wallet_util._get_queue_tx_size()
 
-      wallet_password = cryptocode.decrypt(objs[0].wallet_password, objs[0].sr_id)
-      cmd_util.cmd_manager.set_wallet(cmd_util.wallet_id, wallet_password)
-      txs = []
-      outputs = []
-      total_amount = 0
-      total_fee = 0
-      for tx in objs:
-        txs.append(tx.sr_id)
-        total_amount += tx.amount
-        outputs.append([tx.address, tx.amount / 1.0e8])
-
-      total_size = cmd_util.cmd_manager.get_tx_size(outputs = outputs)
-      total_fee = cmd_util.cmd_manager.conf.estimate_fee(total_size, allow_fallback_to_static_rates = True) / 1.0e8
+      total_amount = wallet_queue['amount']
+      total_fee = cmd_util.cmd_manager.fee_cache.estimate_fee(total_size) / 1.0e8
       fa_ratio = int(total_fee * 1.0e8) / total_amount
 
-      next_attempt = int(cmd_util.cmd_manager.config['USER']['send_frequency']) * 60 - (int(time.time()) - cmd_util.wallets[cmd_util.wallet_id].get('last_batch_send_try'))
-      next_attempt = next_attempt if next_attempt >= 0 else 0
-      fa_ratio_limit = (int(cmd_util.cmd_manager.config['USER']['fa_ratio_min']) / 100) * cmd_util.wallets[cmd_util.wallet_id]['threshold_multiplier']
+      # Batch state of the leader, wallet not evaluated yet is attempted a full period from now
+      state = states.get(wallet_id, {})
+      next_tick = state.get('last_batch_send_try', int(time.time())) + cmd_util._batch_interval()
+      next_attempt = 0 if state.get('open') else max(int(next_tick - time.time()), 0)
+      fa_ratio_limit = (int(cmd_util.cmd_manager.config['USER']['fa_ratio_min']) / 100) * state.get('threshold_multiplier', 1)
 
-      queue[cmd_util.wallet_id] = {
-        'sr_ids': txs,
+      queue[wallet_id] = {
+        'sr_ids': list(wallet_queue['outputs']),
         'amount': '{:.8f}'.format(total_amount / 1.0e8),
         'fee': '{:.8f}'.format(total_fee),
         'fa_ratio': fa_ratio,
@@ -442,4 +1451,24 @@ class APICmdUtil:
         'next_send_attempt_in': next_attempt
       }
 
+    shards = cmd_util.cmd_manager.shards
+    if shards.shard_count > 1:
+      # Wallets of the other nodes from the shared DB, fee as of the last evaluation by their holder
+      others = {}
+      for tx in await cmd_util.executor.run(cls._get_all_unsent):
+        if not shards.holds(tx.wallet_id):
+          others.setdefault(str(tx.wallet_id), []).append(tx)
+      for wallet_id, txs in others.items():
+        total_amount = sum(tx.amount for tx in txs)
+        state = states.get(wallet_id, {})
+        next_tick = state.get('last_batch_send_try', int(time.time())) + cmd_util._batch_interval()
+        queue[wallet_id] = {
+          'sr_ids': [tx.sr_id for tx in txs],
+          'amount': '{:.8f}'.format(total_amount / 1.0e8),
+          'fee': '{:.8f}'.format(state['fa_ratio'] * total_amount / 1.0e8) if state.get('fa_ratio') is not None else None,
+          'fa_ratio': state.get('fa_ratio'),
+          'fa_ratio_limit': state.get('fa_ratio_limit'),
+          'next_send_attempt_in': 0 if state.get('open') else max(int(next_tick - time.time()), 0)
+        }
+
     return queue
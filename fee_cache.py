@@ -0,0 +1,94 @@
+import time
+import asyncio
+import logging
+from collections import deque
+import electrum
+import metrics
+
+class FeeCache:
+  '''Snapshot of network fee estimates with a rolling history
+
+    Updated from electrum fee callbacks and a periodic refresh task, so
+    fee lookups are O(1) reads of the last snapshot. A snapshot older than
+    max_age is stale: requests may still use it, batch decisions may not.
+    Its timestamp only moves when the network pushes estimates or they
+    change, and static rates never make a snapshot, so a fee outage makes
+    it stale instead of silently repeating old or static rates
+  '''
+
+  def __init__(self, conf, max_age = 600, history_size = 1440, refresh_interval = 60):
+    self.conf = conf
+    self.max_age = max_age
+    self.refresh_interval = refresh_interval
+    self.snapshot = None
+    self.history = deque(maxlen = history_size)
+    # Called without arguments when the fee rate changes
+    self.listeners = []
+
+  def add_listener(self, func):
+    self.listeners.append(func)
+
+  def start(self):
+    electrum.util.register_callback(self.on_fee_event, ['fee'])
+    self.refresh()
+    asyncio.ensure_future(self.run())
+
+  async def run(self):
+    while True:
+      await asyncio.sleep(self.refresh_interval)
+      try:
+        self.refresh()
+      except Exception as e:
+        logging.error('Fee refresh failed: %s', e)
+
+  def on_fee_event(self, event, *args):
+    self.refresh(pushed = True)
+
+  def refresh(self, pushed = False):
+    '''Snapshot the estimates of the network, pushed when they come from a fee callback'''
+    if not self.conf.is_dynfee() or not self.conf.fee_estimates:
+      # Static rates, or no estimates from the network yet, keep the last snapshot
+      return
+    fee_per_kb = self.conf.fee_per_kb()
+    if not fee_per_kb:
+      return
+    # sat/vB by confirmation target
+    estimates = {target: rate / 1000 for target, rate in dict(self.conf.fee_estimates).items()}
+    if not pushed and self.snapshot and self.snapshot['fee_per_kb'] == fee_per_kb and \
+        self.snapshot['estimates'] == estimates:
+      # Polled estimates electrum still holds are no sign the network is sending fees
+      return
+    # Batches refused on stale fees can be decided again too
+    changed = self.is_stale() or self.snapshot['fee_per_kb'] != fee_per_kb
+    now = int(time.time())
+    self.snapshot = {
+      'fee_per_kb': fee_per_kb,
+      'estimates': estimates,
+      'timestamp': now
+    }
+    if not self.history or self.history[-1]['fee_per_kb'] != fee_per_kb or \
+        now - self.history[-1]['timestamp'] >= self.refresh_interval:
+      self.history.append(self.snapshot)
+    metrics.FEE_RATE.set(fee_per_kb / 1000)
+    if changed:
+      for func in self.listeners:
+        func()
+
+  def age(self):
+    return int(time.time()) - self.snapshot['timestamp'] if self.snapshot else None
+
+  def is_stale(self):
+    return self.snapshot is None or self.age() > self.max_age
+
+  def estimate_fee(self, size, allow_stale = True):
+    '''Fee in sat for size vbytes at the current fee level
+      Stale or missing estimates raise unless allow_stale, in which case the
+      last snapshot is used, or electrum static rates if there is none
+    '''
+    if self.is_stale():
+      if not allow_stale:
+        raise Exception('Fee estimates are stale (age: {} s), not deciding on stale fees'.format(self.age()))
+      if self.snapshot is None:
+        return self.conf.estimate_fee(size, allow_fallback_to_static_rates = True)
+      logging.warning('Using fee estimates %s s old', self.age())
+    return round(self.snapshot['fee_per_kb'] * size / 1000)
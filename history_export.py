@@ -0,0 +1,53 @@
+'''Send history pages and exports
+
+  Pages of /api/history are addressed by an opaque cursor, the
+  (tx_timestamp, sr_id) of the last send of the previous page. Exports
+  write every sent transaction as NDJSON or CSV lines, a batch of rows at
+  a time
+'''
+import io
+import csv
+import json
+
+FORMATS = {
+  'ndjson': 'application/x-ndjson',
+  'csv': 'text/csv'
+}
+
+FIELDS = ['tx_timestamp', 'sr_id', 'tx_id', 'wallet_id', 'addr', 'amount', 'tx_fee']
+
+def encode_cursor(tx):
+  return '{}:{}'.format(tx.tx_timestamp, tx.sr_id)
+
+def decode_cursor(cursor):
+  try:
+    tx_timestamp, sr_id = cursor.split(':')
+    return int(tx_timestamp), sr_id
+  except ValueError:
+    raise Exception('Invalid cursor: {}'.format(cursor))
+
+def check_format(export_format):
+  if export_format not in FORMATS:
+    raise Exception('Unknown format: {}, use one of {}'.format(export_format, ', '.join(FORMATS)))
+
+def header(export_format):
+  if export_format == 'csv':
+    return ','.join(FIELDS) + '\r\n'
+  return ''
+
+def format_rows(rows, export_format):
+  '''Lines of rows from DbManager.iter_sent_txs'''
+  records = [[tx.tx_timestamp, tx.sr_id, tx.txid, tx.wallet_id, tx.address, '{:.8f}'.format(tx.amount / 1.0e8),
+    '{:.8f}'.format(tx.fee / 1.0e8) if tx.fee is not None else None] for tx in rows]
+  if export_format == 'csv':
+    output = io.StringIO()
+    csv.writer(output).writerows(records)
+    return output.getvalue()
+  return ''.join(json.dumps(dict(zip(FIELDS, record))) + '\n' for record in records)
+
+def export(db_manager, write, wallet_id = None, export_format = 'ndjson'):
+  '''Write the sent transactions to write(str), newest first'''
+  check_format(export_format)
+  write(header(export_format))
+  for rows in db_manager.iter_sent_txs(wallet_id):
+    write(format_rows(rows, export_format))
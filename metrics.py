@@ -0,0 +1,162 @@
+'''Service metrics rendered in the Prometheus text format
+
+  Histograms time the hot paths (wallet loading, size estimation, signing,
+  broadcast, DB queries, API requests), gauges and counters follow the
+  batch state of each wallet. Exposed by the API at /metrics
+'''
+import time
+import asyncio
+import functools
+import threading
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(label_names, label_values, extra = ()):
+  pairs = list(zip(label_names, label_values)) + list(extra)
+  if not pairs:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+    for name, value in pairs) + '}'
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+  type_name = None
+
+  def __init__(self, name, help_text, label_names = ()):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = tuple(label_names)
+    self.values = {}
+    self.lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def _key(self, labels):
+    return tuple(str(labels[name]) for name in self.label_names)
+
+  def clear(self):
+    with self.lock:
+      self.values = {}
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.type_name)]
+    with self.lock:
+      for key, value in sorted(self.values.items()):
+        lines += self._render_value(key, value)
+    return lines
+
+  def _render_value(self, key, value):
+    return ['{}{} {}'.format(self.name, _format_labels(self.label_names, key), _format_value(value))]
+
+class Counter(Metric):
+  type_name = 'counter'
+
+  def inc(self, amount = 1, **labels):
+    key = self._key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+  type_name = 'gauge'
+
+  def set(self, value, **labels):
+    with self.lock:
+      self.values[self._key(labels)] = value
+
+class Histogram(Metric):
+  type_name = 'histogram'
+
+  def __init__(self, name, help_text, label_names = (), buckets = DEFAULT_BUCKETS):
+    super().__init__(name, help_text, label_names)
+    self.buckets = tuple(buckets) + (float('inf'),)
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    with self.lock:
+      if key not in self.values:
+        self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+      series = self.values[key]
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          series['buckets'][i] += 1
+      series['sum'] += value
+      series['count'] += 1
+
+  def _render_value(self, key, series):
+    lines = []
+    for bound, count in zip(self.buckets, series['buckets']):
+      lines.append('{}_bucket{} {}'.format(self.name,
+        _format_labels(self.label_names, key, [('le', _format_value(bound))]), count))
+    labels = _format_labels(self.label_names, key)
+    lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(series['sum'])))
+    lines.append('{}_count{} {}'.format(self.name, labels, series['count']))
+    return lines
+
+  def time(self, **labels):
+    '''Decorator observing the duration of each call, sync or async'''
+    def decorator(func):
+      if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+          start = time.perf_counter()
+          try:
+            return await func(*args, **kwargs)
+          finally:
+            self.observe(time.perf_counter() - start, **labels)
+        return async_wrapper
+
+      @functools.wraps(func)
+      def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+          return func(*args, **kwargs)
+        finally:
+          self.observe(time.perf_counter() - start, **labels)
+      return wrapper
+    return decorator
+
+REGISTRY = []
+
+def render():
+  lines = []
+  for metric in REGISTRY:
+    lines += metric.render()
+  return '\n'.join(lines) + '\n'
+
+OPERATION_SECONDS = Histogram('wallet_service_operation_seconds',
+  'Duration of wallet operations', ['operation'])
+DB_QUERY_SECONDS = Histogram('wallet_service_db_query_seconds',
+  'Duration of DbManager queries', ['query'])
+REQUEST_SECONDS = Histogram('wallet_service_request_seconds',
+  'API request latency', ['method', 'endpoint', 'status'])
+QUEUE_DEPTH = Gauge('wallet_service_queue_depth',
+  'Queued sends of a wallet', ['wallet_id'])
+FA_RATIO = Gauge('wallet_service_fa_ratio',
+  'Fee to amount ratio of the queued batch at the last batch evaluation', ['wallet_id'])
+FA_RATIO_LIMIT = Gauge('wallet_service_fa_ratio_limit',
+  'fa_ratio a batch must be below to be sent', ['wallet_id'])
+THRESHOLD_MULTIPLIER = Gauge('wallet_service_threshold_multiplier',
+  'Multiplier of fa_ratio_min giving fa_ratio_limit', ['wallet_id'])
+BATCH_ATTEMPTS = Counter('wallet_service_batch_attempts_total',
+  'Batch transactions created and broadcast', ['wallet_id'])
+BROADCAST_FAILURES = Counter('wallet_service_broadcast_failures_total',
+  'Batch transactions that failed to broadcast', ['wallet_id'])
+FEE_RATE = Gauge('wallet_service_fee_rate_sat_vb',
+  'Fee rate of the last fee estimate snapshot')
+FEE_ESTIMATE_AGE = Gauge('wallet_service_fee_estimate_age_seconds',
+  'Age of the last fee estimate snapshot')
+BATCH_TX_OUTPUTS = Histogram('wallet_service_batch_tx_outputs',
+  'Outputs of each batch transaction', buckets = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+BATCH_TX_FA_RATIO = Histogram('wallet_service_batch_tx_fa_ratio',
+  'Fee to amount ratio of each batch transaction', buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5))
+SENDS_SETTLED = Counter('wallet_service_sends_settled_total',
+  'Queued sends settled by a broadcast batch transaction', ['wallet_id'])
+BATCH_REPLACEMENTS = Counter('wallet_service_batch_replacements_total',
+  'Unconfirmed batch transactions replaced to append queued sends', ['wallet_id'])
+WALLET_FLUSH_SECONDS = Histogram('wallet_service_wallet_flush_seconds',
+  'Duration of each wallet file write by the wallet writer')
+WALLET_WRITES_SAVED = Counter('wallet_service_wallet_writes_saved_total',
+  'Wallet saves coalesced into a pending write of the same wallet')
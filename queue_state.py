@@ -0,0 +1,95 @@
+import threading
+
+class QueueState:
+  '''In memory aggregate of queued (unsent) sends per wallet
+
+    Kept in step with the DB: sends are added when inserted and removed
+    when settled by a batch, and the whole state is rebuilt from the DB on
+    startup. Running totals make fee weighting and the queue view O(1)
+  '''
+
+  def __init__(self):
+    self.wallets = {}
+    # wallet_id -> queue version of the wallet registry its queue was loaded at
+    self.versions = {}
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def _new_queue():
+    return {
+      # sr_id -> (address, amount in sat, output size in bytes), in insert order
+      'outputs': {},
+      'amount': 0,
+      'outputs_size': 0,
+      # Inputs of the last size estimate, None until the wallet was estimated
+      'txin_type': None,
+      'num_inputs': None
+    }
+
+  def reconcile(self, rows, versions = None):
+    '''Rebuild from (wallet_id, sr_id, address, amount, output_size) of all unsent rows
+      and {wallet_id: queue version} read before them
+    '''
+    wallets = {}
+    for wallet_id, sr_id, address, amount, output_size in rows:
+      queue = wallets.setdefault(str(wallet_id), self._new_queue())
+      queue['outputs'][sr_id] = (address, amount, output_size)
+      queue['amount'] += amount
+      queue['outputs_size'] += output_size
+    with self.lock:
+      self.wallets = wallets
+      self.versions = dict(versions or {})
+
+  def reload(self, wallet_id, rows, version = None):
+    '''Replace the sends of a wallet by (sr_id, address, amount, output_size) of its unsent rows,
+      read at queue version or later. Inputs of its last estimate are kept
+    '''
+    queue = self._new_queue()
+    for sr_id, address, amount, output_size in rows:
+      queue['outputs'][sr_id] = (address, amount, output_size)
+      queue['amount'] += amount
+      queue['outputs_size'] += output_size
+    with self.lock:
+      old_queue = self.wallets.get(str(wallet_id))
+      if old_queue:
+        queue['txin_type'] = old_queue['txin_type']
+        queue['num_inputs'] = old_queue['num_inputs']
+      self.wallets[str(wallet_id)] = queue
+      self.versions[str(wallet_id)] = version
+
+  def add(self, wallet_id, sr_id, address, amount, output_size):
+    with self.lock:
+      queue = self.wallets.setdefault(str(wallet_id), self._new_queue())
+      queue['outputs'][sr_id] = (address, amount, output_size)
+      queue['amount'] += amount
+      queue['outputs_size'] += output_size
+
+  def remove(self, wallet_id, sr_ids):
+    with self.lock:
+      queue = self.wallets.get(str(wallet_id))
+      if not queue:
+        return
+      for sr_id in sr_ids:
+        output = queue['outputs'].pop(sr_id, None)
+        if output:
+          queue['amount'] -= output[1]
+          queue['outputs_size'] -= output[2]
+
+  def drop(self, wallet_id):
+    '''Forget the queue of a wallet no longer served here'''
+    with self.lock:
+      self.wallets.pop(str(wallet_id), None)
+      self.versions.pop(str(wallet_id), None)
+
+  def set_inputs(self, wallet_id, txin_type, num_inputs):
+    with self.lock:
+      queue = self.wallets.setdefault(str(wallet_id), self._new_queue())
+      queue['txin_type'] = txin_type
+      queue['num_inputs'] = num_inputs
+
+  def get(self, wallet_id):
+    '''Queue of a wallet, empty if nothing is queued. Read only for callers'''
+    return self.wallets.get(str(wallet_id)) or self._new_queue()
+
+  def pending_wallets(self):
+    return [wallet_id for wallet_id, queue in list(self.wallets.items()) if queue['outputs']]
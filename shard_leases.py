@@ -0,0 +1,161 @@
+import os
+import math
+import uuid
+import zlib
+import socket
+import asyncio
+import logging
+from db_manager import DbManager
+
+class ShardLeases:
+  '''Leases in the shared DB assigning the shards of wallets to nodes
+
+    Wallet wallet_id is in shard wallet_id % shard_count, the holder of a
+    shard lease sends the batches of its wallets and serves their requests.
+    Every node holds a node lease and takes free shards up to its share of
+    the live nodes, renewing its leases every ttl / 3 seconds. A node
+    holding more than its share, as another node joined, hands shards over
+    once their batches in progress are done. Shards of a node that stopped
+    renewing are taken over when their leases expire. With one shard, its
+    holder sends the batches of every wallet and every node serves any wallet
+  '''
+
+  def __init__(self, executor, shard_count = 1, ttl = 30, url = None):
+    self.executor = executor
+    self.shard_count = shard_count
+    self.ttl = ttl
+    # Other nodes redirect requests for wallets of the shards held here to url
+    self.url = url
+    self.holder = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    # Shards whose batches and requests this node serves
+    self.shards = set()
+    # Shards whose lease this node holds, the served ones until stop
+    self.leases = set()
+    # shard -> url of the other node holding it, as of the last renewal
+    self.owners = {}
+    self.on_acquire = None
+    self.on_lose = None
+    self.running = False
+    self.task = None
+
+  @staticmethod
+  def lease_name(shard):
+    return 'shard:{}'.format(shard)
+
+  def shard_of(self, wallet_id):
+    return int(wallet_id) % self.shard_count
+
+  def holds(self, wallet_id):
+    '''Whether this node sends the batches of wallet_id'''
+    return self.shard_of(wallet_id) in self.shards
+
+  def serves(self, wallet_id):
+    '''Whether this node serves requests for wallet_id'''
+    return self.shard_count == 1 or self.holds(wallet_id)
+
+  def owner_url(self, wallet_id):
+    '''URL of the other node holding the shard of wallet_id, None if no other node holds it'''
+    return self.owners.get(self.shard_of(wallet_id))
+
+  def start(self, on_acquire, on_lose):
+    '''Await on_acquire(shard) when this node takes a shard and on_lose(shard)
+      when it stops holding one, on_lose returns once its batches are done
+    '''
+    self.on_acquire = on_acquire
+    self.on_lose = on_lose
+    self.running = True
+    self.task = asyncio.ensure_future(self.run())
+
+  def _renew(self):
+    '''Renew the node lease and the held shard leases, returns the shards
+      still held, the number of live nodes and {shard: (holder, url)} of held shards
+    '''
+    with DbManager() as db_manager:
+      db_manager.delete_expired_leases('node:')
+      db_manager.acquire_lease('node:' + self.holder, self.holder, self.ttl, self.url)
+      renewed = set(shard for shard in self.leases
+        if db_manager.acquire_lease(self.lease_name(shard), self.holder, self.ttl, self.url))
+      nodes = len(db_manager.get_leases('node:'))
+      owners = {int(lease.name.split(':')[1]): (lease.holder, lease.url) for lease in db_manager.get_leases('shard:')}
+    return renewed, nodes, owners
+
+  def _acquire(self, shard):
+    with DbManager() as db_manager:
+      return db_manager.acquire_lease(self.lease_name(shard), self.holder, self.ttl, self.url)
+
+  def _release(self, shards, node = False):
+    with DbManager() as db_manager:
+      for shard in shards:
+        db_manager.release_lease(self.lease_name(shard), self.holder)
+      if node:
+        db_manager.release_lease('node:' + self.holder, self.holder)
+
+  def _free_shards(self, owners):
+    # Every node starts looking at another shard, so nodes starting at once rarely race for one
+    start = zlib.crc32(self.holder.encode()) % self.shard_count
+    return [(start + i) % self.shard_count for i in range(self.shard_count)
+      if (start + i) % self.shard_count not in owners]
+
+  async def run(self):
+    while self.running:
+      try:
+        await self._rebalance()
+      except Exception as e:
+        logging.error('Shard leases of %s: %s', self.holder, e)
+      await asyncio.sleep(self.ttl / 3)
+
+  async def _rebalance(self):
+    try:
+      renewed, nodes, owners = await self.executor.run(self._renew)
+    except Exception as e:
+      # Another node may take them once they expire, stop right away
+      logging.error('Shard lease renewal of %s failed: %s', self.holder, e)
+      renewed, nodes, owners = set(), None, None
+    for shard in sorted(self.leases - renewed):
+      logging.warning('Shard %s lost by %s', shard, self.holder)
+      self.shards.discard(shard)
+      self.leases.discard(shard)
+      await self.on_lose(shard)
+    if owners is None:
+      return
+    self.owners = {shard: url for shard, (holder, url) in owners.items() if holder != self.holder}
+    share = math.ceil(self.shard_count / max(nodes, 1))
+    for shard in sorted(self.shards, reverse = True)[:max(len(self.shards) - share, 0)]:
+      await self._hand_over(shard)
+    for shard in self._free_shards(owners)[:max(share - len(self.shards), 0)]:
+      if not await self.executor.run(self._acquire, shard):
+        continue
+      logging.info('Shard %s taken by %s', shard, self.holder)
+      self.shards.add(shard)
+      self.leases.add(shard)
+      self.owners.pop(shard, None)
+      try:
+        await self.on_acquire(shard)
+      except Exception as e:
+        # Let another node hold it instead
+        logging.error('Shard %s: starting failed: %s', shard, e)
+        await self._hand_over(shard)
+
+  async def _hand_over(self, shard):
+    # Not served from here on, batches of it in progress finish before the lease is released
+    self.shards.discard(shard)
+    await self.on_lose(shard)
+    self.leases.discard(shard)
+    await self.executor.run(self._release, [shard])
+    logging.info('Shard %s handed over by %s', shard, self.holder)
+
+  async def stop(self):
+    '''Stop taking shards and sending batches, the leases stay held until release'''
+    self.running = False
+    if self.task:
+      self.task.cancel()
+    shards = sorted(self.shards)
+    self.shards = set()
+    for shard in shards:
+      await self.on_lose(shard)
+
+  async def release(self):
+    '''Hand every held shard over right away'''
+    leases = list(self.leases)
+    self.leases = set()
+    await self.executor.run(self._release, leases, True)
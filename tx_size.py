@@ -0,0 +1,62 @@
+'''Analytical transaction size estimation
+
+  Sizes are computed from BIP141 weight units. Inputs assume a 72 byte
+  signature and a compressed public key, the same worst case electrum
+  uses when estimating the size of an unsigned transaction
+'''
+import math
+
+# Weight of one input by wallet script type: 4 * non witness bytes + witness bytes
+INPUT_WEIGHT = {
+  'p2pkh': 4 * (32 + 4 + 1 + 107 + 4),
+  'p2wpkh-p2sh': 4 * (32 + 4 + 1 + 23 + 4) + (1 + 1 + 72 + 1 + 33),
+  'p2wpkh': 4 * (32 + 4 + 1 + 4) + (1 + 1 + 72 + 1 + 33),
+}
+
+# Length of the change output script, wallets pay change to their own script type
+CHANGE_SCRIPT_LEN = {
+  'p2pkh': 25,
+  'p2wpkh-p2sh': 23,
+  'p2wpkh': 22,
+}
+
+def is_supported(txin_type):
+  return txin_type in INPUT_WEIGHT
+
+def var_int_size(n):
+  if n < 0xfd:
+    return 1
+  if n <= 0xffff:
+    return 3
+  if n <= 0xffffffff:
+    return 5
+  return 9
+
+def output_size(script_len):
+  # 8 byte amount, script length and script
+  return 8 + var_int_size(script_len) + script_len
+
+def estimate_vsize(txin_type, num_inputs, output_script_lens, change = True):
+  '''Virtual size in vbytes of a transaction spending num_inputs coins of
+    txin_type to outputs with the given script lengths
+  '''
+  outputs_size = sum(output_size(script_len) for script_len in output_script_lens)
+  return estimate_vsize_from_totals(txin_type, num_inputs, len(output_script_lens), outputs_size, change)
+
+def estimate_vsize_from_totals(txin_type, num_inputs, num_outputs, outputs_size, change = True):
+  '''Same as estimate_vsize from the output count and their summed size,
+    so queues can keep running totals instead of every output
+  '''
+  if not is_supported(txin_type):
+    raise Exception('Unsupported input type {}'.format(txin_type))
+  if change:
+    num_outputs += 1
+    outputs_size += output_size(CHANGE_SCRIPT_LEN[txin_type])
+  # Version, input count, output count, locktime
+  weight = 4 * (4 + var_int_size(num_inputs) + var_int_size(num_outputs) + 4)
+  if txin_type != 'p2pkh':
+    # Segwit marker and flag
+    weight += 2
+  weight += num_inputs * INPUT_WEIGHT[txin_type]
+  weight += 4 * outputs_size
+  return math.ceil(weight / 4)
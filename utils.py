@@ -1,3 +1,5 @@
+import json
+
 MIN_BTC_AMOUNT = 0.00000001
 
 def check_params(data, params):
@@ -0,0 +1,144 @@
+import os
+import hmac
+import time
+import asyncio
+import threading
+import logging
+from collections import OrderedDict
+from hashlib import sha256
+
+class WalletCache:
+  '''LRU cache of decrypted, loaded electrum wallets
+
+    Entries are keyed by wallet id and a digest of the password that
+    decrypted the wallet file, so a wrong password can never hit. An entry
+    is dropped when it has been idle for too long, when the cache is over
+    its size budget or when the wallet file changed on disk since load.
+    Pinned wallets are live (attached to the network) and never dropped
+  '''
+
+  def __init__(self, max_size = 32, max_idle = 600):
+    self.max_size = max_size
+    self.max_idle = max_idle
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.pinned = set()
+    # Wallets are loaded from executor threads
+    self.lock = threading.RLock()
+    # Per process secret so password digests are useless outside of it
+    self._secret = os.urandom(32)
+
+  def _key(self, wallet_id, wallet_password):
+    digest = hmac.new(self._secret, str(wallet_password).encode(), sha256).hexdigest()
+    return (str(wallet_id), digest)
+
+  @staticmethod
+  def _file_stamp(wallet_path):
+    try:
+      stat = os.stat(wallet_path)
+    except OSError:
+      return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+  def _evict(self, key):
+    entry = self.entries.pop(key)
+    self.evictions += 1
+    wallet = entry['wallet']
+    logging.info('Evicting %s from wallet cache', wallet)
+    network = getattr(wallet, 'network', None)
+    if network:
+      try:
+        asyncio.run_coroutine_threadsafe(wallet.stop(), network.asyncio_loop)
+      except Exception as e:
+        logging.error('Failed to stop %s: %s', wallet, e)
+
+  def _expire_idle(self):
+    now = time.time()
+    for key in [key for key, entry in self.entries.items()
+        if now - entry['last_used'] > self.max_idle and entry['path'] not in self.pinned]:
+      self._evict(key)
+
+  def _shrink(self):
+    unpinned = [key for key, entry in self.entries.items() if entry['path'] not in self.pinned]
+    while len(self.entries) > self.max_size and unpinned:
+      self._evict(unpinned.pop(0))
+
+  def get(self, wallet_id, wallet_password, wallet_path):
+    with self.lock:
+      self._expire_idle()
+      key = self._key(wallet_id, wallet_password)
+      entry = self.entries.get(key)
+      if entry and entry['stamp'] != self._file_stamp(wallet_path):
+        if wallet_path in self.pinned:
+          # Live wallet is the authority, its file follows it
+          entry['stamp'] = self._file_stamp(wallet_path)
+        else:
+          # Wallet file was changed by someone else, loaded copy is stale
+          self._evict(key)
+          entry = None
+      if not entry:
+        self.misses += 1
+        return None
+      self.hits += 1
+      entry['last_used'] = time.time()
+      self.entries.move_to_end(key)
+      return entry['wallet']
+
+  def put(self, wallet_id, wallet_password, wallet_path, wallet):
+    with self.lock:
+      key = self._key(wallet_id, wallet_password)
+      if key in self.entries:
+        self._evict(key)
+      self.entries[key] = {
+        'wallet': wallet,
+        'path': wallet_path,
+        'stamp': self._file_stamp(wallet_path),
+        'last_used': time.time()
+      }
+      self._shrink()
+
+  def refresh(self, wallet_path):
+    '''Record our own write of a wallet file so it is not seen as stale'''
+    with self.lock:
+      stamp = self._file_stamp(wallet_path)
+      for entry in self.entries.values():
+        if entry['path'] == wallet_path:
+          entry['stamp'] = stamp
+
+  def pin(self, wallet_path):
+    with self.lock:
+      self.pinned.add(wallet_path)
+
+  def unpin(self, wallet_path):
+    '''Let wallet_path be dropped again, right away if it is idle or over the size budget'''
+    with self.lock:
+      self.pinned.discard(wallet_path)
+      self.expire()
+
+  def expire(self):
+    '''Drop idle wallets and wallets over the size budget'''
+    with self.lock:
+      self._expire_idle()
+      self._shrink()
+
+  def wallet_ids(self):
+    with self.lock:
+      return set(key[0] for key in self.entries)
+
+  def invalidate(self, wallet_id):
+    with self.lock:
+      for key in [key for key in self.entries if key[0] == str(wallet_id)]:
+        self._evict(key)
+
+  def stats(self):
+    with self.lock:
+      return {
+        'size': len(self.entries),
+        'max_size': self.max_size,
+        'pinned': len(self.pinned),
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions
+      }
@@ -0,0 +1,46 @@
+import asyncio
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+class WalletExecutor:
+  '''Runs blocking electrum, crypto and DB work off the event loop
+
+    Wallet objects are shared in process, so electrum and DB work always
+    runs on a thread pool. Pure CPU bound crypto (password encryption) can
+    go to a process pool instead. Work on one wallet is serialized by
+    holding its wallet_lock, work on different wallets runs concurrently
+  '''
+
+  def __init__(self, max_threads = 8, crypto_processes = 0):
+    self.thread_pool = ThreadPoolExecutor(max_workers = max_threads, thread_name_prefix = 'wallet_worker')
+    self.crypto_pool = ProcessPoolExecutor(max_workers = crypto_processes) if crypto_processes > 0 else self.thread_pool
+    # wallet_id -> [lock, holders and waiters], dropped once nobody uses it
+    self.wallet_locks = {}
+
+  @contextlib.asynccontextmanager
+  async def wallet_lock(self, wallet_id):
+    wallet_id = str(wallet_id)
+    entry = self.wallet_locks.setdefault(wallet_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+      async with entry[0]:
+        yield
+    finally:
+      entry[1] -= 1
+      if not entry[1]:
+        del self.wallet_locks[wallet_id]
+
+  async def run(self, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.thread_pool, functools.partial(func, *args, **kwargs))
+
+  async def run_crypto(self, func, *args):
+    # Process pool needs picklable func and args, no keyword arguments
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.crypto_pool, func, *args)
+
+  def shutdown(self):
+    self.thread_pool.shutdown(wait = False)
+    if self.crypto_pool is not self.thread_pool:
+      self.crypto_pool.shutdown(wait = False)
@@ -0,0 +1,54 @@
+import time
+import secrets
+import threading
+import cryptocode
+
+def seal(wallet_password):
+  '''Credential envelope of a wallet password: (envelope, salt)'''
+  salt = secrets.token_hex(16)
+  return cryptocode.encrypt(wallet_password, salt), salt
+
+def unseal(envelope, salt):
+  wallet_password = cryptocode.decrypt(envelope, salt)
+  if wallet_password is False:
+    raise Exception('Could not open wallet credentials')
+  return wallet_password
+
+class WalletKeyring:
+  '''Wallet passwords unlocked from their credential envelope, kept in
+    memory for ttl seconds after their last use so the key derivation of
+    an envelope is paid once per wallet, not once per queued send
+  '''
+
+  def __init__(self, ttl = 3600):
+    self.ttl = ttl
+    # wallet_id -> (wallet_password, expiry time)
+    self.passwords = {}
+    self.lock = threading.Lock()
+
+  def get(self, wallet_id):
+    wallet_id = str(wallet_id)
+    now = time.monotonic()
+    with self.lock:
+      entry = self.passwords.get(wallet_id)
+      if entry is None:
+        return None
+      if entry[1] < now:
+        del self.passwords[wallet_id]
+        return None
+      self.passwords[wallet_id] = (entry[0], now + self.ttl)
+      return entry[0]
+
+  def put(self, wallet_id, wallet_password):
+    with self.lock:
+      self.passwords[str(wallet_id)] = (wallet_password, time.monotonic() + self.ttl)
+
+  def forget(self, wallet_id):
+    with self.lock:
+      self.passwords.pop(str(wallet_id), None)
+
+  def expire(self):
+    now = time.monotonic()
+    with self.lock:
+      for wallet_id in [wallet_id for wallet_id, entry in self.passwords.items() if entry[1] < now]:
+        del self.passwords[wallet_id]
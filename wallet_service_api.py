@@ -1,15 +1,51 @@
 from sanic import Sanic
-from sanic.response import text, json
+from sanic.response import text, json, redirect
 from electrum_cmd_util import APICmdUtil, ElectrumCmdUtil
+from admin_socket import AdminServer
 import asyncio
+import db_migrate
+import history_export
+import metrics
 import utils
 import logging
 import time
 
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+
 app = Sanic("BlockonomicsWalletServiceAPI")
 cmd_manager = ElectrumCmdUtil()
 cmd_util = APICmdUtil(cmd_manager)
 
+@app.middleware("request")
+async def start_request_timer(request):
+  request.ctx.start_time = time.perf_counter()
+
+@app.middleware("response")
+async def observe_request_time(request, response):
+  start_time = getattr(request.ctx, 'start_time', None)
+  if start_time is not None:
+    # Route path keeps ids like sr_id out of the labels
+    endpoint = request.route.path if request.route else 'unmatched'
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start_time,
+      method = request.method, endpoint = endpoint, status = response.status)
+
+def shard_redirect(request, wallet_id):
+  '''Response sending a request for a wallet of a shard held by another node there, None if served here'''
+  shards = cmd_manager.shards
+  if shards.serves(wallet_id):
+    return None
+  owner_url = shards.owner_url(wallet_id)
+  if not owner_url:
+    return json({"error": 'Shard of wallet {} is being handed over, retry'.format(wallet_id)}, status = 503)
+  # 307 keeps the method and body of the POST
+  return redirect(owner_url.rstrip('/') + request.path, status = 307)
+
+@app.get("/metrics")
+async def metrics_endpoint(request):
+  cmd_util.update_metrics()
+  return text(metrics.render(), content_type = 'text/plain; version=0.0.4; charset=utf-8')
+
 @app.post("/api/presend")
 async def presend(request):
   try:
@@ -24,8 +60,11 @@ async def presend(request):
 
     if api_password != cmd_manager.config['USER']['api_password']:
       raise Exception('Incorrect API password')
+    response = shard_redirect(request, wallet_id)
+    if response:
+      return response
 
-    post_cmd_util = APICmdUtil(cmd_manager, wallet_id, wallet_password)
+    post_cmd_util = await APICmdUtil.open(cmd_manager, wallet_id, wallet_password)
 
     estimated_fee = await post_cmd_util.presend(addr, btc_amount)
     return json({"estimated_fee": '{:.8f}'.format(estimated_fee)})
@@ -46,14 +85,49 @@ async def send(request):
 
     if api_password != cmd_manager.config['USER']['api_password']:
       raise Exception('Incorrect API password')
+    response = shard_redirect(request, wallet_id)
+    if response:
+      return response
 
-    post_cmd_util = APICmdUtil(cmd_manager, wallet_id, wallet_password)
+    post_cmd_util = await APICmdUtil.open(cmd_manager, wallet_id, wallet_password)
   
     estimated_fee, sr_id = await post_cmd_util.send(addr, btc_amount)
     return json({"estimated_fee": '{:.8f}'.format(estimated_fee), "sr_id": sr_id})
   except Exception as e:
     return json({"error": '{}'.format(e)}, status = 500)
 
+@app.post("/api/send_bulk")
+async def send_bulk(request):
+  try:
+    args = request.json
+    # Checked one by one below, check_params only takes primitive params
+    outputs = args.pop('outputs', None)
+    utils.check_params(args, ['wallet_id', 'wallet_password', 'api_password'])
+    if not outputs or not isinstance(outputs, list):
+      raise Exception('Missing param outputs')
+    for i, output in enumerate(outputs):
+      try:
+        utils.check_params(output, ['addr', 'btc_amount'])
+      except Exception as e:
+        raise Exception('outputs[{}]: {}'.format(i, e))
+
+    wallet_id = args.get('wallet_id')
+    wallet_password = args.get('wallet_password')
+    api_password = args.get('api_password')
+
+    if api_password != cmd_manager.config['USER']['api_password']:
+      raise Exception('Incorrect API password')
+    response = shard_redirect(request, wallet_id)
+    if response:
+      return response
+
+    post_cmd_util = await APICmdUtil.open(cmd_manager, wallet_id, wallet_password)
+
+    sends = await post_cmd_util.send_bulk([[output['addr'], float(output['btc_amount'])] for output in outputs])
+    return json([{"sr_id": sr_id, "estimated_fee": '{:.8f}'.format(estimated_fee)} for sr_id, estimated_fee in sends])
+  except Exception as e:
+    return json({"error": '{}'.format(e)}, status = 500)
+
 @app.post("/api/get_balance")
 async def get_balance(request):
   try:
@@ -66,11 +140,16 @@ async def get_balance(request):
 
     if api_password != cmd_manager.config['USER']['api_password']:
       raise Exception('Incorrect API password')
+    response = shard_redirect(request, wallet_id)
+    if response:
+      return response
 
-    balance_cmd_util = APICmdUtil(cmd_manager, wallet_id, wallet_password)
+    balance_cmd_util = await APICmdUtil.open(cmd_manager, wallet_id, wallet_password)
   
-    confirmed, unconfirmed = await balance_cmd_util.get_balance()
-    return json({"confirmed": confirmed, "unconfirmed": unconfirmed})
+    balance = await balance_cmd_util.get_balance()
+    return json({"confirmed": balance['confirmed'], "unconfirmed": balance['unconfirmed'],
+      "sync_height": balance['sync_height'], "up_to_date": balance['up_to_date'],
+      "updated_timestamp": balance['updated_timestamp']})
   except Exception as e:
     return json({"error": '{}'.format(e)}, status = 500)
 
@@ -79,7 +158,7 @@ async def detail(request, sr_id):
   try:
     if not sr_id:
       raise Exception('Missing param sr_id')
-    data = await APICmdUtil.get_tx(sr_id)
+    data = await cmd_util.get_tx(sr_id)
     return json(data)
   except Exception as e:
     return json({"error": '{}'.format(e)}, status = 500)
@@ -87,11 +166,29 @@ async def detail(request, sr_id):
 @app.get("/api/history")
 async def history(request):
   try:
-    limit = request.args.get("limit")
-    data = await APICmdUtil.get_send_history(limit)
-    return json(data)
+    limit = int(request.args.get("limit", HISTORY_PAGE_SIZE))
+    if not 0 < limit <= HISTORY_MAX_PAGE_SIZE:
+      raise Exception('limit must be between 1 and {}'.format(HISTORY_MAX_PAGE_SIZE))
+    if request.args.get("wallet_id") is not None:
+      utils.check_params({'wallet_id': request.args.get("wallet_id")}, ['wallet_id'])
+    data, next_cursor = await cmd_util.get_send_history(limit, request.args.get("wallet_id"), request.args.get("cursor"))
+    # Body stays a plain list, the next page is linked in a header
+    return json(data, headers = {'X-Next-Cursor': next_cursor} if next_cursor else None)
+  except Exception as e:
+    return json({"error": '{}'.format(e)}, status = 500)
+
+@app.get("/api/history/export")
+async def export_history(request):
+  try:
+    export_format = request.args.get("format", "ndjson")
+    history_export.check_format(export_format)
+    if request.args.get("wallet_id") is not None:
+      utils.check_params({'wallet_id': request.args.get("wallet_id")}, ['wallet_id'])
   except Exception as e:
     return json({"error": '{}'.format(e)}, status = 500)
+  response = await request.respond(content_type = history_export.FORMATS[export_format])
+  await cmd_util.export_send_history(response.send, request.args.get("wallet_id"), export_format)
+  await response.eof()
 
 @app.get("/api/queue")
 async def queue(request):
@@ -101,26 +198,93 @@ async def queue(request):
   except Exception as e:
     return json({"error": '{}'.format(e)}, status = 500)
 
-@app.listener("after_server_start")
-async def server_start_listener(app, loop):
-  # Once server is running, grab the loop of the server and start
-  # Bitcoin network
-  asyncio.ensure_future(main_loop())
+def wallet_command(method, writes = False):
+  '''Admin command running method of the wallet util with the remaining args.
+    Wallets of shards held by another node are refused, and with writes the
+    ones whose file is written by another worker too
+  '''
+  async def run(wallet_id, wallet_password, *args):
+    shards = cmd_manager.shards
+    if not shards.serves(wallet_id):
+      raise Exception('Wallet {} is served by {}'.format(wallet_id,
+        shards.owner_url(wallet_id) or 'another node, its shard is being handed over, retry'))
+    if writes and not shards.holds(wallet_id):
+      raise Exception('Wallet {} is written by the worker sending its batches, not this one, retry'.format(wallet_id))
+    wallet_util = await APICmdUtil.open(cmd_manager, wallet_id, wallet_password)
+    return await getattr(wallet_util, method)(*args)
+  return run
+
+admin_server = AdminServer(cmd_manager.config['SYSTEM'].get('admin_socket', 'admin.sock'), {
+  'getinfo': wallet_command('get_wallet_info'),
+  'getbalance': wallet_command('get_synced_balance'),
+  'gethistory': wallet_command('get_wallet_history'),
+  'getunusedaddress': wallet_command('get_unused_address'),
+  'sendtoaddress': wallet_command('send_to', writes = True)
+})
+
+async def start_service():
+  await cmd_util.load_queue_state()
+  # Grab the loop of the server and start Bitcoin network
   cmd_manager.get_event_loop()
   cmd_manager.connect_to_network()
+  cmd_manager.fee_cache.start()
+  cmd_manager.wallet_writer.start(cmd_manager.executor)
+
+def api_workers():
+  return int(cmd_manager.config['SYSTEM'].get('api_workers', 1))
+
+def shared_queue():
+  '''Other processes queue sends too, other workers or other nodes on the same PostgreSQL DB'''
+  return (api_workers() > 1 or cmd_manager.shards.shard_count > 1 or
+    not cmd_manager.config['SYSTEM'].get('db_url', 'sqlite').startswith('sqlite'))
+
+@app.main_process_start
+async def main_process_start_listener(app):
+  if cmd_manager.shards.shard_count > 1:
+    # Requests are redirected to a node, not to one of its workers
+    if api_workers() > 1:
+      raise Exception('Set api_workers = 1 when shard_count > 1, run more nodes instead')
+    if not cmd_manager.shards.url:
+      raise Exception('Set node_url when shard_count > 1, other nodes redirect requests to it')
+  # Bring DB schema up to date once, before any worker serves anything
+  db_migrate.migrate()
+
+@app.listener("after_server_start")
+async def server_start_listener(app, loop):
+  await start_service()
+  cmd_manager.fee_cache.add_listener(cmd_manager.batch_scheduler.wake)
+  cmd_manager.shards.start(cmd_util.start_shard, cmd_util.stop_shard)
+  try:
+    await admin_server.start()
+  except Exception as e:
+    # The CLI falls back to standalone mode
+    logging.error('Admin socket not available: %s', e)
+  if shared_queue():
+    asyncio.ensure_future(cmd_util.queue_sync_loop())
+  asyncio.ensure_future(status_loop())
+
+@app.listener("before_server_stop")
+async def server_stop_listener(app, loop):
+  await cmd_manager.shards.stop()
+  await admin_server.stop()
+  await cmd_manager.wallet_writer.stop(cmd_manager.executor)
+  # Other workers and nodes take the shards over without waiting for the leases to expire
+  await cmd_manager.shards.release()
 
-async def main_loop():
-  last_batch_send_try = int(time.time())
+async def status_loop():
+  # Batches are driven by the batch scheduler, this only logs, reloads config and expires keys
   while True:
     try:
-      cmd_util.last_batch = last_batch_send_try
       # Re-read config in case of any updates
       cmd_manager.config.read(cmd_manager.config_file)
       await cmd_manager.log_network_status()
-      await cmd_util.send_batch()
+      cmd_manager.balance_monitor.expire()
+      cmd_manager.wallet_cache.expire()
+      logging.info('Wallet cache: %s', cmd_manager.wallet_cache.stats())
+      cmd_manager.keyring.expire()
     except Exception as e:
       logging.error("%s", e)
-    await asyncio.sleep(10)
+    await asyncio.sleep(int(cmd_manager.config['SYSTEM'].get('status_interval', 60)))
 
 if __name__ == "__main__":
-  app.run(host="0.0.0.0", port=8000, debug=True)
+  app.run(host="0.0.0.0", port=8000, debug=True, workers=api_workers())
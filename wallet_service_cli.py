@@ -1,14 +1,22 @@
 import argparse
 import configparser
-import os
+import json
 import random, string
-from electrum_cmd_util import ElectrumCmdUtil
-from electrum import util
+import sys
+import time
+# Only light standard modules at module load, so config commands start fast.
+# Electrum, the DB, HTTP and asyncio are imported by the commands using them
 
 CONFIG_FILE = 'config.ini'
+API_URL = 'http://127.0.0.1:8000'
 config = configparser.ConfigParser()
 config.read(CONFIG_FILE)
 
+def _electrum_cmd_util():
+  '''New ElectrumCmdUtil, importing electrum on first use'''
+  from electrum_cmd_util import ElectrumCmdUtil
+  return ElectrumCmdUtil()
+
 def _check_api_password():
   # If no api password exists, create and set a random alphanumeric
   if config['USER']['api_password'] == '':
@@ -31,65 +39,151 @@ def set_config(param, value):
   with open(CONFIG_FILE, 'w') as configfile:
     config.write(configfile)
 
-def list_wallets():
-  # Sort by timestamp
-  os.chdir(config['SYSTEM']['wallet_dir'])
-  wallets = sorted(filter(os.path.isfile, os.listdir('.')), key=os.path.getmtime)
+def _db_manager():
+  '''DbManager of a DB migrated to the latest schema, the CLI may run before the service ever did'''
+  import db_migrate
+  from db_manager import DbManager
+  db_migrate.migrate()
+  return DbManager()
+
+def _format_time(timestamp):
+  return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) if timestamp else '-'
+
+def list_wallets(verbose = False):
+  ''' Ids of the registered wallets in creation order, one per line. verbose
+      adds network, created and last activity time, and whether sends of it
+      are queued
+  '''
+  # Read only, migrating would import and run the whole schema history on every call
+  from db_manager import DbManager
+  from sqlalchemy.exc import DBAPIError
+  try:
+    with DbManager() as db_manager:
+      wallets = db_manager.get_wallets()
+  except DBAPIError:
+    # Registry not created or not up to date yet
+    with _db_manager() as db_manager:
+      wallets = db_manager.get_wallets()
   for wallet in wallets:
-    print(wallet.split('_')[1])
+    if not verbose:
+      print(wallet.wallet_id)
+      continue
+    print('{}\t{}\tcreated {}\tlast activity {}{}'.format(wallet.wallet_id, wallet.network or '-',
+      _format_time(wallet.created_timestamp), _format_time(wallet.last_activity_timestamp),
+      '\tqueued' if wallet.has_queued else ''))
 
 def create_wallet(wallet_password):
-  cmd_manager = ElectrumCmdUtil()
-  last_id = 0
-  if os.path.exists(config['SYSTEM']['wallet_dir']):
-    path, dirs, files = next(os.walk(config['SYSTEM']['wallet_dir']))
-    last_id = len(files)
-  seed, xpub = cmd_manager.create_wallet(last_id, wallet_password)
-  print('Wallet created\nID: {}\nPassword: {}\nSeed: {}\nxPub: {}'.format(last_id, wallet_password, xpub, seed))
+  cmd_manager = _electrum_cmd_util()
+  with _db_manager() as db_manager:
+    # Id taken in the registry first, two wallets created at once never share one
+    wallet_id = db_manager.add_wallet()
+    try:
+      seed, xpub = cmd_manager.create_wallet(wallet_id, wallet_password)
+    except Exception as e:
+      db_manager.remove_wallet(wallet_id)
+      raise e
+  print('Wallet created\nID: {}\nPassword: {}\nSeed: {}\nxPub: {}'.format(wallet_id, wallet_password, xpub, seed))
+
+def _connect_service():
+  '''Admin socket of the running service, None if no service is running'''
+  import admin_socket
+  return admin_socket.connect(config['SYSTEM'].get('admin_socket', 'admin.sock'))
+
+def _request(service, command, *args):
+  import admin_socket
+  return admin_socket.request(service, command, *args)
 
 def get_wallet_info(wallet_id, wallet_password):
-  cmd_manager = ElectrumCmdUtil()
-  wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
-  xpub = wallet.get_master_public_key()
-  seed = wallet.get_seed(wallet_password)
+  service = _connect_service()
+  if service:
+    info = _request(service, 'getinfo', wallet_id, wallet_password)
+    xpub, seed = info['xpub'], info['seed']
+  else:
+    cmd_manager = _electrum_cmd_util()
+    wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
+    xpub = wallet.get_master_public_key()
+    seed = wallet.get_seed(wallet_password)
   print('xPub: {}\nSeed: {}'.format(xpub, seed))
 
 def get_wallet_balance(wallet_id, wallet_password):
-  cmd_manager = ElectrumCmdUtil()
-  wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
-  print('Connecting to network and syncing wallet...')
-  cmd_manager.wait_for_wallet_sync(wallet, True)
-  balance = cmd_manager.get_balance(wallet)
+  service = _connect_service()
+  if service:
+    # Synced by the service on its own network connection
+    balance = _request(service, 'getbalance', wallet_id, wallet_password)
+  else:
+    cmd_manager = _electrum_cmd_util()
+    wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
+    print('Connecting to network and syncing wallet...')
+    cmd_manager.wait_for_wallet_sync(wallet, True)
+    balance = cmd_manager.get_balance(wallet)
   print('Confirmed: {}\nUnconfirmed: {}'.format(balance[0], balance[1]))
 
 def get_wallet_history(wallet_id, wallet_password):
-  cmd_manager = ElectrumCmdUtil()
-  wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
-  print('Connecting to network and syncing wallet...')
-  cmd_manager.wait_for_wallet_sync(wallet, True)
-  history = cmd_manager.get_history(wallet)
-  for tx in list(history.items()):
-    if not tx[1]['date']:
-      tx[1]['date'] = 'Waiting for confirmation'
-    print('txid: {}, date: {}, amount: {}'\
-      .format(tx[1]['txid'], tx[1]['date'], tx[1]['bc_value']))
+  service = _connect_service()
+  if service:
+    history = _request(service, 'gethistory', wallet_id, wallet_password)
+  else:
+    cmd_manager = _electrum_cmd_util()
+    wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
+    print('Connecting to network and syncing wallet...')
+    cmd_manager.wait_for_wallet_sync(wallet, True)
+    history = [[tx['txid'], tx['date'], tx['bc_value']] for tx in cmd_manager.get_history(wallet).values()]
+  for txid, date, amount in history:
+    print('txid: {}, date: {}, amount: {}'.format(txid, date or 'Waiting for confirmation', amount))
 
 def send_to_address(wallet_id, wallet_password, btc_address, btc_amount):
-  cmd_manager = ElectrumCmdUtil()
+  service = _connect_service()
+  if service:
+    txid = _request(service, 'sendtoaddress', wallet_id, wallet_password, btc_address, btc_amount)
+    print('Sent {} BTC from wallet {}, txid: {}'.format(btc_amount, wallet_id, txid))
+    return
+  cmd_manager = _electrum_cmd_util()
   wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
   print('Connecting to network and syncing wallet...')
   cmd_manager.wallet = wallet
   cmd_manager.wallet_password = wallet_password
   cmd_manager.send_to(btc_address, btc_amount)
 
+def send_bulk(wallet_id, wallet_password, outputs_file):
+  ''' Queue sends listed in a JSON file [{"addr": ..., "btc_amount": ...}, ...]
+      through the running service, so they are batched like API sends
+  '''
+  import requests
+  with open(outputs_file) as f:
+    outputs = json.load(f)
+  response = requests.post(API_URL + '/api/send_bulk', json = {
+    'outputs': outputs,
+    'wallet_id': wallet_id,
+    'wallet_password': wallet_password,
+    'api_password': config['USER']['api_password']
+  })
+  result = response.json()
+  if response.status_code != 200:
+    raise Exception(result.get('error'))
+  for send in result:
+    print('sr_id: {}, estimated_fee: {}'.format(send['sr_id'], send['estimated_fee']))
+
+def export_history(export_format, wallet_id = None):
+  ''' Write every sent transaction to stdout as NDJSON or CSV, newest first.
+      Rows are streamed from the DB so any history size exports in flat memory
+  '''
+  import history_export
+  from db_manager import DbManager
+  with DbManager() as db_manager:
+    history_export.export(db_manager, sys.stdout.write, wallet_id, export_format)
+
 def get_unused(wallet_id, wallet_password):
   ''' This command is used to fetch next unused address of a wallet.
       Designed to help testing by providing easy access of addresses for
       sending test transactions
   '''
-  cmd_manager = ElectrumCmdUtil()
-  wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
-  addr = wallet.get_unused_address()
+  service = _connect_service()
+  if service:
+    addr = _request(service, 'getunusedaddress', wallet_id, wallet_password)
+  else:
+    cmd_manager = _electrum_cmd_util()
+    wallet = cmd_manager.load_wallet(wallet_id, wallet_password)
+    addr = wallet.get_unused_address()
   print(addr)
 
 if __name__ == '__main__':
@@ -99,13 +193,15 @@ if __name__ == '__main__':
       description='Available commands:\n\n'
                   'getapiconfig\n'
                   'setapiconfig <param> <value>\n'
-                  'listwallets\n'
+                  'listwallets [verbose]\n'
                   'createwallet <wallet_password>\n'
                   'getinfo <wallet_id> <wallet_password>\n'
                   'getbalance <wallet_id> <wallet_password>\n'
                   'gethistory <wallet_id> <wallet_password>\n'
                   'sendtoaddress <wallet_id> <wallet_password> <btc_address> <btc_amount>\n'
-                  'getunusedaddress <wallet_id> <wallet_password>\n',
+                  'sendbulk <wallet_id> <wallet_password> <outputs_json_file>\n'
+                  'getunusedaddress <wallet_id> <wallet_password>\n'
+                  'exporthistory <ndjson|csv> [wallet_id]\n',
       formatter_class=argparse.RawTextHelpFormatter
     )
   ap.add_argument('command', help='command to run')
@@ -126,9 +222,9 @@ if __name__ == '__main__':
     set_config(param, value)
 
   elif args['command'].lower() == 'listwallets':
-    if len(args['options']) != 0:
-      ap.error('listwallets takes no options')
-    list_wallets()
+    if len(args['options']) > 1 or args['options'][:1] not in ([], ['verbose']):
+      ap.error('listwallets takes at most 1 option: [verbose]')
+    list_wallets(verbose = bool(args['options']))
 
   elif args['command'].lower() == 'createwallet':
     if len(args['options']) != 1:
@@ -166,6 +262,14 @@ if __name__ == '__main__':
     btc_amount = args['options'][3]
     send_to_address(wallet_id, wallet_password, btc_address, btc_amount)
 
+  elif args['command'].lower() == 'sendbulk':
+    if len(args['options']) != 3:
+      ap.error('sendbulk takes exactly 3 options: <wallet_id> <wallet_password> <outputs_json_file>')
+    wallet_id = args['options'][0]
+    wallet_password = args['options'][1]
+    outputs_file = args['options'][2]
+    send_bulk(wallet_id, wallet_password, outputs_file)
+
   elif args['command'] == 'getunusedaddress':
     if len(args['options']) != 2:
       ap.error('getunusedaddress takes exactly 2 option: <wallet_id> <wallet_password>')
@@ -173,5 +277,12 @@ if __name__ == '__main__':
     wallet_password = args['options'][1]
     get_unused(wallet_id, wallet_password)
 
+  elif args['command'].lower() == 'exporthistory':
+    if len(args['options']) not in (1, 2):
+      ap.error('exporthistory takes 1 or 2 options: <ndjson|csv> [wallet_id]')
+    export_format = args['options'][0]
+    wallet_id = args['options'][1] if len(args['options']) == 2 else None
+    export_history(export_format, wallet_id)
+
   else:
     ap.error('No command found')
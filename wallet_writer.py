@@ -0,0 +1,98 @@
+import time
+import asyncio
+import logging
+import threading
+import metrics
+
+class WalletWriter:
+  '''Write-behind of wallet files
+
+    Saves of a wallet, ours and the ones electrum makes itself while
+    syncing, only mark it dirty. Dirty wallets are written every interval
+    seconds and on shutdown, so all changes of a wallet between two flushes
+    cost one encrypted whole-file write. flush_wallet writes one right
+    away, before a tx it holds is broadcast. Until start, saves are written
+    right away (CLI). Once started, saves of wallets for which writable
+    returns False are dropped, their file is written by another process
+  '''
+
+  def __init__(self, wallet_cache, interval = 1, writable = None):
+    self.wallet_cache = wallet_cache
+    self.interval = interval
+    self.writable = writable or (lambda wallet: True)
+    # wallet path -> (wallet, function writing its file)
+    self.dirty = {}
+    self.lock = threading.Lock()
+    # Held while a wallet file is written, so a flush waits for one in progress
+    self.path_locks = {}
+    self.running = False
+
+  def attach(self, wallet):
+    '''Defer the writes electrum makes itself too'''
+    save_db = wallet.save_db
+    wallet.save_db = lambda: self.save(wallet, save_db)
+
+  def save(self, wallet, write):
+    if not self.running:
+      self._write(wallet, write)
+      return
+    if not self.writable(wallet):
+      # Kept in memory only, the copy loaded here is reloaded once its writer changes the file
+      return
+    with self.lock:
+      if wallet.storage.path in self.dirty:
+        metrics.WALLET_WRITES_SAVED.inc()
+      self.dirty[wallet.storage.path] = (wallet, write)
+
+  def _path_lock(self, wallet_path):
+    with self.lock:
+      return self.path_locks.setdefault(wallet_path, threading.Lock())
+
+  def _write(self, wallet, write):
+    start = time.perf_counter()
+    write()
+    # Keep the cached copy valid, this write is our own
+    self.wallet_cache.refresh(wallet.storage.path)
+    metrics.WALLET_FLUSH_SECONDS.observe(time.perf_counter() - start)
+
+  def flush_path(self, wallet_path):
+    '''Write the wallet of wallet_path if it is dirty, returns when its file is up to date'''
+    with self._path_lock(wallet_path):
+      with self.lock:
+        entry = self.dirty.pop(wallet_path, None)
+      if not entry:
+        return
+      try:
+        self._write(*entry)
+      except Exception as e:
+        with self.lock:
+          # Retried on the next flush, unless saved again meanwhile
+          self.dirty.setdefault(wallet_path, entry)
+        raise e
+
+  def flush_wallet(self, wallet):
+    self.flush_path(wallet.storage.path)
+
+  def flush(self):
+    for wallet_path in list(self.dirty):
+      try:
+        self.flush_path(wallet_path)
+      except Exception as e:
+        logging.error('Writing wallet %s failed: %s', wallet_path, e)
+
+  def start(self, executor):
+    self.running = True
+    asyncio.ensure_future(self.run(executor))
+
+  async def run(self, executor):
+    while self.running:
+      await asyncio.sleep(self.interval)
+      if self.dirty:
+        await executor.run(self.flush)
+
+  async def stop(self, executor):
+    '''Write every dirty wallet, later saves are written right away'''
+    self.running = False
+    # Twice, for saves that were deferred while the first flush ran
+    await executor.run(self.flush)
+    await executor.run(self.flush)